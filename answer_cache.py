@@ -0,0 +1,140 @@
+import time
+import hashlib
+import logging
+import sqlite3
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Tuple, Callable
+
+from knowledge import normalize_query
+
+
+class AnswerCache:
+    """
+    Кэш ответов LLM: LRU в памяти + TTL, поверх — SQLite на диске (переживает рестарт).
+
+    Ключ — нормализованный запрос + модель + хэш системного промпта, так что
+    правка промпта или смена модели сама обходит старые ответы. SQLite живёт
+    в отдельном потоке: event loop не ждёт диск, запись идёт в фоне.
+
+    Файл тоже ограничен: каждые `prune_every` записей тот же поток удаляет
+    истёкшие строки и всё сверх `max_rows`, начиная с ближайших к истечению.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_items: int = 1000, ttl_s: float = 7 * 24 * 3600,
+                 clock: Callable[[], float] = time.time, max_rows: int = 50000, prune_every: int = 500):
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self.max_rows = max_rows
+        self.prune_every = max(1, prune_every)
+        self._clock = clock
+        self._puts = 0
+        self._mem: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()  # ключ -> (истекает, текст)
+        self.stats: Dict[str, int] = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "prunes": 0}
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, text TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS answers_expires ON answers (expires_at)")
+                self._db_prune()
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="answer-cache")
+            except sqlite3.Error as e:
+                logging.warning(f"Answer cache disk store disabled ({path}): {e}")
+                self._db = None
+
+    @staticmethod
+    def key(user_text: str, model: str, prompt: str) -> Optional[str]:
+        norm = normalize_query(user_text)
+        if not norm:
+            return None
+        prompt_version = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:12]
+        return f"{model}|{prompt_version}|{norm}"
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.stats["hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def _remember(self, key: str, expires_at: float, text: str) -> None:
+        self._mem[key] = (expires_at, text)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        now = self._clock()
+        item = self._mem.get(key)
+        if item is not None:
+            if item[0] > now:
+                self._mem.move_to_end(key)
+                self.stats["hits"] += 1
+                return item[1]
+            del self._mem[key]
+
+        if self._db is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                row = await loop.run_in_executor(self._executor, self._db_get, key)
+            except sqlite3.Error as e:
+                logging.warning(f"Answer cache read failed: {e}")
+                row = None
+            if row is not None and row[1] > now:
+                self._remember(key, row[1], row[0])
+                self.stats["disk_hits"] += 1
+                return row[0]
+
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key: Optional[str], text: str) -> None:
+        """Сразу в память; на диск — в фоне, без ожидания."""
+        if key is None or not text:
+            return
+        expires_at = self._clock() + self.ttl_s
+        self._remember(key, expires_at, text)
+        self.stats["stores"] += 1
+        if self._db is not None:
+            self._puts += 1
+            prune = self._puts % self.prune_every == 0
+            fut = asyncio.get_running_loop().run_in_executor(self._executor, self._db_put, key, text, expires_at, prune)
+            fut.add_done_callback(_log_failure)
+
+    def _db_get(self, key: str) -> Optional[Tuple[str, float]]:
+        return self._db.execute("SELECT text, expires_at FROM answers WHERE key = ?", (key,)).fetchone()
+
+    def _db_put(self, key: str, text: str, expires_at: float, prune: bool = False) -> None:
+        self._db.execute("INSERT OR REPLACE INTO answers (key, text, expires_at) VALUES (?, ?, ?)",
+                         (key, text, expires_at))
+        if prune:
+            self._db_prune()
+        self._db.commit()
+
+    def _db_prune(self) -> None:
+        """Истёкшие — вон; из оставшихся — не больше `max_rows` с самым поздним сроком."""
+        self._db.execute("DELETE FROM answers WHERE expires_at < ?", (self._clock(),))
+        self._db.execute("DELETE FROM answers WHERE key NOT IN "
+                         "(SELECT key FROM answers ORDER BY expires_at DESC LIMIT ?)", (self.max_rows,))
+        self._db.commit()
+        self.stats["prunes"] += 1
+
+    def close(self) -> None:
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def _log_failure(fut: "asyncio.Future") -> None:
+    if not fut.cancelled() and fut.exception():
+        logging.warning(f"Answer cache write failed: {fut.exception()}")
@@ -0,0 +1,283 @@
+"""
+Бенчмарк поиска: реальные и синтетические FAQ/EXAM (100 … 100k записей).
+
+Запуск без TELEGRAM_TOKEN и сети:
+    python bench.py                          # все размеры, JSON в stdout
+    python bench.py --sizes 100,1000 --out bench.json
+    python bench.py --engines rapidfuzz,intent --queries 300
+    python bench.py --startup                # холодный старт: import bot с kb.bin и без
+
+Движки: legacy (knowledge.best_match, полный перебор), difflib/rapidfuzz
+(KnowledgeIndex), intent (match_intent.IntentMatcher), bm25 (retrieval.SparseIndex). Медленные движки
+по умолчанию ограничены размером базы (ENGINE_LIMITS, --limit legacy=1000).
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from knowledge import ALIASES, SCORERS, KnowledgeIndex, best_match
+from entries import load_entries
+from match_intent import IntentMatcher
+from retrieval import SparseIndex
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ENGINES = ("legacy",) + SCORERS + ("intent", "bm25")
+# макс. размер базы по умолчанию: дальше прогон занимает минуты
+ENGINE_LIMITS = {"legacy": 100, "difflib": 1000, "intent": 10000}
+
+_CONS = "бвгджзклмнпрстфхцчш"
+_VOWELS = "аеиоуыя"
+_FILLER = [
+    "подскажите пожалуйста", "что делать если", "в поликлинике", "у меня ситуация",
+    "можно ли", "куда обращаться", "врач сказал что", "по закону", "вчера в больнице",
+]
+
+
+def load(name: str) -> Any:
+    with open(os.path.join(BASE_DIR, name), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def fake_word(rnd: random.Random) -> str:
+    return "".join(rnd.choice(_CONS) + rnd.choice(_VOWELS) for _ in range(rnd.randint(2, 4)))
+
+
+def typo(rnd: random.Random, w: str) -> str:
+    if len(w) < 4:
+        return w
+    i = rnd.randrange(1, len(w) - 2)
+    kind = rnd.randrange(3)
+    if kind == 0:
+        return w[:i] + w[i + 1:]                      # пропуск
+    if kind == 1:
+        return w[:i] + w[i + 1] + w[i] + w[i + 2:]    # перестановка
+    return w[:i] + rnd.choice(_VOWELS) + w[i + 1:]    # замена
+
+
+def scale_entries(templates: List[Dict[str, Any]], size: int, seed: int) -> List[Dict[str, Any]]:
+    """Синтетическая база: копии реальных записей, часть keywords заменена на новые слова."""
+    rnd = random.Random(seed)
+    out = []
+    for i in range(size):
+        e = dict(templates[i % len(templates)])
+        kws = list(e.get("keywords") or [])
+        if i >= len(templates):
+            kws = [kw if rnd.random() < 0.4 else fake_word(rnd) for kw in kws]
+            if rnd.random() < 0.3:
+                kws.append(f"{fake_word(rnd)} {fake_word(rnd)}")
+        e["keywords"] = kws
+        out.append(e)
+    return out
+
+
+def scale_intents(intents: Dict[str, Any], size: int, seed: int) -> Dict[str, Any]:
+    rnd = random.Random(seed)
+    out = dict(intents)
+    templates = list(intents.values())
+    i = 0
+    while len(out) < size:
+        t = templates[i % len(templates)]
+        out[f"SYNTH_{i}"] = {
+            "keywords": [fake_word(rnd) for _ in t.get("keywords", [])],
+            "examples": [f"{fake_word(rnd)} {fake_word(rnd)} {ex}" for ex in t.get("examples", [])],
+        }
+        i += 1
+    return out
+
+
+def query_corpus(entries: List[Dict[str, Any]], n: int, seed: int) -> Dict[str, List[str]]:
+    """Запросы по категориям: опечатки, обрубки, длинные вопросы свободным текстом."""
+    rnd = random.Random(seed)
+    kws = [kw for e in entries for kw in (e.get("keywords") or []) if isinstance(kw, str) and kw]
+    questions = [e.get("question") or e.get("answer", "")[:120] for e in entries]
+
+    typos = list(ALIASES)
+    while len(typos) < n:
+        typos.append(" ".join(typo(rnd, w) for w in rnd.choice(kws).split()))
+    fragments = [rnd.choice(kws)[:rnd.randint(3, 6)] for _ in range(n)]
+    long_texts = []
+    for _ in range(n):
+        parts = [rnd.choice(_FILLER), rnd.choice(kws), rnd.choice(_FILLER), rnd.choice(questions)]
+        long_texts.append(" ".join(p for p in parts if p))
+    return {"typo": typos[:n], "fragment": fragments, "long": long_texts}
+
+
+def percentile(sorted_ms: List[float], q: float) -> float:
+    if not sorted_ms:
+        return 0.0
+    k = min(len(sorted_ms) - 1, max(0, int(round(q / 100 * len(sorted_ms) + 0.5)) - 1))
+    return sorted_ms[k]
+
+
+def build_engine(engine: str, entries: List[Dict[str, Any]], intents_path: str) -> Tuple[Callable[[str], Any], float, float]:
+    """(функция запроса, время построения, пик памяти при построении в МБ)."""
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    if engine == "legacy":
+        fn = lambda q: best_match(entries, q)  # noqa: E731
+    elif engine == "intent":
+        fn = IntentMatcher(intents_path).match
+    elif engine == "bm25":
+        fn = SparseIndex(load_entries(entries, "BENCH")).match
+    else:
+        fn = KnowledgeIndex(load_entries(entries, "BENCH"), scorer=engine).best_match
+    build_s = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return fn, build_s, peak / 2 ** 20
+
+
+def run_queries(fn: Callable[[str], Any], queries: List[str]) -> Dict[str, float]:
+    lat = []
+    t_start = time.perf_counter()
+    for q in queries:
+        t0 = time.perf_counter()
+        fn(q)
+        lat.append((time.perf_counter() - t0) * 1000)
+    total = time.perf_counter() - t_start
+    lat.sort()
+    return {
+        "n": len(lat),
+        "p50_ms": round(percentile(lat, 50), 4),
+        "p95_ms": round(percentile(lat, 95), 4),
+        "p99_ms": round(percentile(lat, 99), 4),
+        "max_ms": round(lat[-1], 4) if lat else 0.0,
+        "qps": round(len(lat) / total, 1) if total else 0.0,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return ""
+
+
+_STARTUP_PROBE = (
+    "import time, sys; t = time.perf_counter(); import bot; "
+    "print(time.perf_counter() - t, 'openai' in sys.modules)"
+)
+
+
+def startup_bench(runs: int) -> List[Dict[str, Any]]:
+    """`import bot` в отдельных процессах: с собранной базой и без неё. Артефакт — во временном каталоге, kb.bin не трогаем."""
+    tmp = tempfile.mkdtemp(prefix="bench-startup-")
+    artifact = os.path.join(tmp, "kb.bin")
+    subprocess.check_call([sys.executable, "kb.py", "--out", artifact], cwd=BASE_DIR)
+    env = dict(os.environ, TELEGRAM_TOKEN="123456:" + "A" * 35, OPENAI_API_KEY="sk-bench",
+               USER_STATE_PATH="", ANSWER_CACHE_PATH="", REQUEST_LOG_PATH="")
+    results = []
+    for mode, path in (("artifact", artifact), ("json", "")):
+        times, openai_loaded = [], False
+        for _ in range(runs):
+            out = subprocess.check_output([sys.executable, "-c", _STARTUP_PROBE], cwd=BASE_DIR, text=True,
+                                          env=dict(env, KB_ARTIFACT_PATH=path), stderr=subprocess.DEVNULL)
+            t, loaded = out.split()[-2:]
+            times.append(float(t) * 1000)
+            openai_loaded = openai_loaded or loaded == "True"
+        times.sort()
+        rec = {"mode": mode, "runs": runs, "import_p50_ms": round(times[len(times) // 2], 1),
+               "import_min_ms": round(times[0], 1), "openai_imported": openai_loaded}
+        results.append(rec)
+        print(f"startup {mode:8} p50={rec['import_p50_ms']}ms min={rec['import_min_ms']}ms", file=sys.stderr)
+    shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="real,100,1000,10000,100000",
+                        help="размеры баз через запятую; real — исходные faq.json/exam.json")
+    parser.add_argument("--datasets", default="faq,exam")
+    parser.add_argument("--engines", default=",".join(ENGINES))
+    parser.add_argument("--queries", type=int, default=200, help="запросов на категорию")
+    parser.add_argument("--limit", action="append", default=[], metavar="ENGINE=SIZE",
+                        help="макс. размер базы для движка (0 — без ограничения)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="файл для JSON (по умолчанию stdout)")
+    parser.add_argument("--startup", type=int, nargs="?", const=5, default=0, metavar="RUNS",
+                        help="вместо поиска мерить холодный старт (import bot), RUNS запусков")
+    args = parser.parse_args()
+
+    if args.startup:
+        report = {"commit": git_commit(), "python": platform.python_version(),
+                  "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "startup": startup_bench(args.startup)}
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                f.write(text)
+        else:
+            print(text)
+        return 0
+
+    engines = [e for e in args.engines.split(",") if e]
+    unknown = set(engines) - set(ENGINES)
+    if unknown:
+        parser.error(f"unknown engines: {sorted(unknown)}")
+    limits = dict(ENGINE_LIMITS)
+    for item in args.limit:
+        engine, _, size = item.partition("=")
+        if engine not in ENGINES or not size.isdigit():
+            parser.error(f"bad --limit: {item!r}")
+        limits[engine] = int(size)
+
+    intents = load("intents.json")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for dataset in [d for d in args.datasets.split(",") if d]:
+            templates = load(f"{dataset}.json")
+            for size_s in args.sizes.split(","):
+                entries = templates if size_s == "real" else scale_entries(templates, int(size_s), args.seed)
+                size = len(entries)
+                corpus = query_corpus(entries, args.queries, args.seed)
+
+                intents_path = os.path.join(tmp, f"intents_{size}.json")
+                with open(intents_path, "w", encoding="utf-8") as f:
+                    json.dump(intents if size_s == "real" else scale_intents(intents, size, args.seed), f, ensure_ascii=False)
+
+                for engine in engines:
+                    # интенты одни на бота — меряем их вместе с FAQ
+                    if engine == "intent" and dataset != "faq":
+                        continue
+                    if limits.get(engine) and size > limits[engine]:
+                        continue
+                    fn, build_s, build_mb = build_engine(engine, entries, intents_path)
+                    for category, queries in corpus.items():
+                        rec = {"dataset": dataset, "size": size, "engine": engine, "category": category,
+                               "build_s": round(build_s, 4), "build_peak_mb": round(build_mb, 2)}
+                        rec.update(run_queries(fn, queries))
+                        results.append(rec)
+                        print(f"{dataset:5} {size:>7} {engine:10} {category:9} "
+                              f"p50={rec['p50_ms']:.3f}ms p99={rec['p99_ms']:.3f}ms qps={rec['qps']}", file=sys.stderr)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "queries_per_category": args.queries,
+        # ru_maxrss в Linux — килобайты
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,76 +1,119 @@
 import os
-import json
-import re
+import time
 import logging
 import asyncio
-from difflib import SequenceMatcher
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
-
-# OpenAI (fallback brain)
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None  # если пакет не установлен
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.bot.api import TelegramAPIServer
+
+from knowledge import DEFAULT_SCORER, normalize_query
+from prompt import PromptBuilder, with_disclaimer
+from streaming import StreamingReply
+from router import Router, Route
+from outbox import SendQueue, broadcast, LOW
+from exam_session import ExamDeck, ExamSessions
+from kb import KnowledgeStore, MatchCache, load_artifact
+from scoring import MatchPool, HAS_FORK
+from match_intent import IntentMatcher
+from llm import LLMClient, CircuitBreaker
+from answer_cache import AnswerCache
+from user_state import UserStateStore
+from throttling import TokenBuckets, FloodControl
+from request_log import RequestLog, RequestTrace
+from metrics import Metrics, HandlerTimer, LoopLag, SCORE_BUCKETS, RETRIEVAL_BUCKETS, rss_bytes, name_handler
+from serving import InFlightTracker, build_webhook_app, run_webhook
 
 logging.basicConfig(level=logging.INFO)
 
 TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # другой Bot API сервер (например, заглушка из fakes.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")  # публичный https://... ; пусто — вебхук уже выставлен снаружи
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))  # Render передаёт PORT
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))  # сек на дообработку апдейтов
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")  # добавим в Render позже
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None  # например, локальная заглушка из fakes.py
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "4"))  # одновременных запросов к OpenAI
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "18"))  # дедлайн на вызов, сек
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+OPENAI_MAX_OUTPUT_TOKENS = int(os.getenv("OPENAI_MAX_OUTPUT_TOKENS", "600"))  # потолок длины ответа модели
+LLM_STREAM = os.getenv("LLM_STREAM", "1") == "1"  # ответ модели дописывается в сообщение по мере генерации
+LLM_STREAM_EDIT_INTERVAL = float(os.getenv("LLM_STREAM_EDIT_INTERVAL", "1.0"))  # сек между правками сообщения
+LLM_PROMPT_TOKENS = int(os.getenv("LLM_PROMPT_TOKENS", "1200"))  # инструкция + материалы + вопрос
+LLM_CONTEXT_SNIPPETS = int(os.getenv("LLM_CONTEXT_SNIPPETS", "3"))  # записей FAQ/EXAM в промпте
+OPENAI_BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", "5"))  # ошибок подряд до размыкания
+OPENAI_BREAKER_RESET = float(os.getenv("OPENAI_BREAKER_RESET", "30"))  # сек до пробного вызова
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))  # ответов LLM в памяти
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))  # сек
+ANSWER_CACHE_ROWS = int(os.getenv("ANSWER_CACHE_ROWS", "50000"))  # ответов в файле SQLite
+MATCH_SCORER = os.getenv("MATCH_SCORER", DEFAULT_SCORER)  # difflib | rapidfuzz
+KB_RELOAD_INTERVAL = float(os.getenv("KB_RELOAD_INTERVAL", "30"))  # сек; 0 — не следить за файлами
+MATCH_WORKERS = int(os.getenv("MATCH_WORKERS", "0"))  # процессов для поиска; 0 — в event loop
+MATCH_BATCH = int(os.getenv("MATCH_BATCH", "32"))  # запросов в одной пачке к воркеру
+MATCH_CACHE_SIZE = int(os.getenv("MATCH_CACHE_SIZE", "4096"))  # готовых результатов поиска; 0 — без кэша
+RETRIEVAL_THRESHOLD = float(os.getenv("RETRIEVAL_THRESHOLD", "0.18"))  # 0..1, BM25 по текстам; > 1 — выключить
+INTENT_THRESHOLD = float(os.getenv("INTENT_THRESHOLD", "85"))  # 0..100, token_set_ratio лучшей фразы интента
+REQUEST_LOG_MAX_MB = float(os.getenv("REQUEST_LOG_MAX_MB", "10"))  # размер файла до ротации
+REQUEST_LOG_BACKUPS = int(os.getenv("REQUEST_LOG_BACKUPS", "3"))  # сколько старых файлов хранить
+USER_STATE_SIZE = int(os.getenv("USER_STATE_SIZE", "10000"))  # студентов в памяти
+USER_STATE_FLUSH = float(os.getenv("USER_STATE_FLUSH", "2"))  # сек между записями на диск
+# флуд-контроль: сообщений в секунду и запас подряд; 0 в *_RATE / *_PER_MIN — без ограничения
+FLOOD_USER_RATE = float(os.getenv("FLOOD_USER_RATE", "1"))
+FLOOD_USER_BURST = float(os.getenv("FLOOD_USER_BURST", "5"))
+FLOOD_GLOBAL_RATE = float(os.getenv("FLOOD_GLOBAL_RATE", "50"))
+FLOOD_GLOBAL_BURST = float(os.getenv("FLOOD_GLOBAL_BURST", "100"))
+LLM_USER_PER_MIN = float(os.getenv("LLM_USER_PER_MIN", "5"))  # вопросов к OpenAI от студента в минуту
+LLM_GLOBAL_PER_MIN = float(os.getenv("LLM_GLOBAL_PER_MIN", "120"))  # и от всех вместе
+# исходящие: лимиты Telegram ~30 сообщений/с на бота и ~1/с в один чат; 0 в *_RATE — без ограничения
+SEND_RATE = float(os.getenv("SEND_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))  # попыток при сетевых ошибках и 429
+SEND_LOW_SHARE = float(os.getenv("SEND_LOW_SHARE", "0.8"))  # доля SEND_RATE для рассылки, остальное — ответам
+BROADCAST_WINDOW = int(os.getenv("BROADCAST_WINDOW", "200"))  # сообщений рассылки в очереди одновременно
+
+def parse_ids(env_var: str) -> set:
+    return {int(x) for x in os.getenv(env_var, "").replace(" ", "").split(",") if x.isdigit()}
+
+# Telegram ID администраторов через запятую (/reload, /pro и т.п.)
+ADMIN_IDS = parse_ids("ADMIN_IDS")
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # --- OpenAI client ---
-oa_client = OpenAI(api_key=OPENAI_API_KEY) if (OpenAI and OPENAI_API_KEY) else None
-
-AI_SYSTEM_PROMPT = """
-Ты — ассистент кафедры медицинского права Республики Казахстан.
-
-Отвечай:
-• официально-деловым стилем;
-• нейтрально, без оценок и эмоций;
-• с учётом законодательства Республики Казахстан;
-• кратко и структурировано.
-
-Алгоритм ответа:
-1) Кратко объясни суть ситуации (1–2 предложения).
-2) Укажи, к какому разделу медицинского права относится вопрос.
-3) Дай общий алгоритм действий (пункты).
-4) При необходимости упомяни нормативные акты (без цитирования статей).
-
-НЕ давай персональных советов и категоричных выводов.
-
-Всегда завершай ответ дисклеймером:
-«Ответ носит информационный характер и не является официальным юридическим заключением. Для индивидуальной ситуации используйте кнопку “Задать вопрос преподавателю”.»
-"""
-
-DISCLAIMER = (
-    "⚠️ Ответ носит информационный характер и не является официальным юридическим заключением. "
-    "Для индивидуальной ситуации используйте кнопку «✉️ Задать вопрос преподавателю»."
-
-   )
-AI_SYSTEM_PROMPT = """
-Ты — ассистент кафедры медицинского права Республики Казахстан.
-
-Отвечай:
-• официально-деловым стилем;
-• нейтрально, без оценок и эмоций;
-• с учётом законодательства Республики Казахстан;
-• кратко и структурировано.
-
-Алгоритм ответа:
-1) Кратко объясни суть ситуации (1–2 предложения).
-2) Укажи, к какому разделу медицинского права относится вопрос.
-3) Дай общий алгоритм действий (пункты).
-4) При необходимости упомяни нормативные акты (без цитирования статей).
-
-НЕ давай персональных советов и категоричных выводов.
-
-Всегда завершай ответ дисклеймером:
-«Ответ носит информационный характер и не является официальным юридическим заключением. Для индивидуальной ситуации используйте кнопку “Задать вопрос преподавателю”.»
-"""
+LLM = LLMClient(
+    OPENAI_API_KEY,
+    base_url=OPENAI_BASE_URL,
+    concurrency=OPENAI_CONCURRENCY,
+    timeout_s=OPENAI_TIMEOUT,
+    breaker=CircuitBreaker(OPENAI_BREAKER_FAILURES, OPENAI_BREAKER_RESET),
+)
+# счётчики и гистограммы: /stats для админов, /metrics в webhook-режиме
+METRICS = Metrics()
+METRICS.set_buckets("bot_match_score", SCORE_BUCKETS)
+METRICS.set_buckets("bot_retrieval_score", RETRIEVAL_BUCKETS)
+LOOP_LAG = LoopLag(METRICS)
+# что спрашивают и сколько занимает каждая стадия; "" в REQUEST_LOG_PATH — не писать
+REQUEST_LOG = RequestLog(
+    os.getenv("REQUEST_LOG_PATH", os.path.join(BASE_DIR, "request_log.jsonl")) or None,
+    max_bytes=int(REQUEST_LOG_MAX_MB * 2 ** 20),
+    backups=REQUEST_LOG_BACKUPS,
+)
+PROMPTS = PromptBuilder(budget=LLM_PROMPT_TOKENS, max_snippets=LLM_CONTEXT_SNIPPETS)
+# повторный вопрос не идёт в OpenAI; "" в ANSWER_CACHE_PATH — только память
+ANSWER_CACHE = AnswerCache(
+    os.getenv("ANSWER_CACHE_PATH", os.path.join(BASE_DIR, "answer_cache.sqlite3")) or None,
+    max_items=ANSWER_CACHE_SIZE,
+    ttl_s=ANSWER_CACHE_TTL,
+    max_rows=ANSWER_CACHE_ROWS,
+)
+
 SECTIONS = [
     "⚖️ Медицинские ошибки",
     "🚨 Инциденты",
@@ -90,17 +133,48 @@ menu.add(KeyboardButton(SECTIONS[2]), KeyboardButton(SECTIONS[3]))
 menu.add(KeyboardButton(SECTIONS[4]), KeyboardButton(SECTIONS[5]))
 menu.add(KeyboardButton(SECTIONS[6]))
 menu.add(KeyboardButton(SECTIONS[7]), KeyboardButton(SECTIONS[8]))
+# кнопки экзамен-режима: callback "exam:<действие>", раздел — "exam:s<номер>" (в callback_data не больше 64 байт)
+EXAM_ACTIONS = ("next", "random", "sections", "reset")
+exam_start_keyboard = InlineKeyboardMarkup()
+exam_start_keyboard.add(InlineKeyboardButton("🎲 Случайная карточка", callback_data="exam:random"),
+                        InlineKeyboardButton("📚 Разделы", callback_data="exam:sections"))
+exam_keyboard = InlineKeyboardMarkup()
+exam_keyboard.add(InlineKeyboardButton("➡️ Следующая", callback_data="exam:next"),
+                  InlineKeyboardButton("🎲 Случайная", callback_data="exam:random"))
+exam_keyboard.add(InlineKeyboardButton("📚 Разделы", callback_data="exam:sections"))
+exam_done_keyboard = InlineKeyboardMarkup()
+exam_done_keyboard.add(InlineKeyboardButton("📚 Разделы", callback_data="exam:sections"),
+                       InlineKeyboardButton("🔄 Начать заново", callback_data="exam:reset"))
+# текст кнопки -> маршрут; у трёх последних кнопок свои хэндлеры
+ROUTER = Router({
+    **{s: "section" for s in SECTIONS},
+    "📄 Нормативная база": "law_base",
+    "✉️ Задать вопрос преподавателю": "ask_teacher",
+    "🧪 Мини-тесты": "mini_tests",
+})
 
 # ---------- Modes ----------
-USER_MODE: Dict[int, str] = {}  # "exam" or ""
-# --- PRO доступ для студентов (v1) ---
-PRO_USERS = {
-    # сюда добавляй Telegram ID студентов с PRO-доступом
-    # пример: 123456789,
-}
+# --- PRO доступ для студентов ---
+# Telegram ID через запятую в PRO_USERS; без редеплоя — командой /pro <id>
+PRO_USERS = parse_ids("PRO_USERS")
 
 DEMO_EXAM_LIMIT = 5  # сколько экзамен-карточек доступно в демо
-DEMO_EXAM_COUNTER: Dict[int, int] = {}  # сколько карточек уже выдано каждому
+DEMO_LIMIT_TEXT = (
+    "🔒 Экзаменационный режим (демо)\n\n"
+    "Доступный лимит карточек в демо исчерпан.\n"
+    "Чтобы подключить полный доступ, напишите: «Хочу PRO-доступ»."
+)
+# выдача карточек по темам без повторов; демо тратят только новые карточки
+EXAM = ExamSessions(DEMO_EXAM_LIMIT)
+
+# режим ("exam" или ""), выданные демо-карточки и PRO каждого студента;
+# "" в USER_STATE_PATH — только память (сбрасывается при рестарте)
+USER_STATE = UserStateStore(
+    os.getenv("USER_STATE_PATH", os.path.join(BASE_DIR, "user_state.sqlite3")) or None,
+    max_users=USER_STATE_SIZE,
+    flush_interval=USER_STATE_FLUSH,
+    pro_users=PRO_USERS,
+)
 
 # ---------- Paths ----------
 def resolve_path(env_var: str, filename: str) -> str:
@@ -124,241 +198,127 @@ def resolve_path(env_var: str, filename: str) -> str:
 
 FAQ_PATH = resolve_path("FAQ_PATH", "faq.json")
 EXAM_PATH = resolve_path("EXAM_PATH", "exam.json")
-
-def load_json_list(path: str, label: str) -> List[Dict[str, Any]]:
+INTENTS_PATH = resolve_path("INTENTS_PATH", "intents.json")
+# собранная база (`python kb.py`): без разбора JSON и построения индексов на старте;
+# нет файла или исходники поменялись — собираем из JSON как раньше
+KB_ARTIFACT_PATH = os.getenv("KB_ARTIFACT_PATH", os.path.join(BASE_DIR, "kb.bin"))
+ARTIFACT = load_artifact(KB_ARTIFACT_PATH, FAQ_PATH, EXAM_PATH, INTENTS_PATH, scorer=MATCH_SCORER)
+
+# данные, индексы и готовые ответы; подменяются целиком при правке файлов
+KB_STORE = KnowledgeStore(FAQ_PATH, EXAM_PATH, scorer=MATCH_SCORER, initial=ARTIFACT["kb"] if ARTIFACT else None)
+# интенты: "reply" — ответ сразу, до FAQ; "section" — ответ раздела, если FAQ не нашёл
+INTENTS: Optional[IntentMatcher] = ARTIFACT["intents"] if ARTIFACT else None
+if INTENTS is None:
     try:
-        logging.info(f"Loading {label} from: {path} (exists={os.path.exists(path)})")
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if not isinstance(data, list):
-            logging.warning(f"{label} is not a list -> empty.")
-            return []
-        logging.info(f"{label} loaded: {len(data)} entries")
-        return data
+        INTENTS = IntentMatcher(INTENTS_PATH)
     except Exception as e:
-        logging.exception(f"Failed to load {label}: %s", e)
-        return []
-
-FAQ = load_json_list(FAQ_PATH, "FAQ")
-EXAM = load_json_list(EXAM_PATH, "EXAM")
-
-# ---------- Normalization / fuzzy ----------
-_WORD_RE = re.compile(r"[a-zа-я0-9]+", re.IGNORECASE)
-
-ALIASES = {
-    # твои частые "обрубки/опечатки"
-    "жлба": "жалоба",
-    "жлб": "жалоба",
-    "жба": "жалоба",
-    "жалоб": "жалоба",
-    "хам": "грубость",
-    "хамит": "грубость",
-    "грубит": "грубость",
-    "конфл": "конфликт",
-    "скандал": "конфликт",
-    "диагн": "диагноз",
-    "диаг": "диагноз",
-    "тайна": "врачебная тайна",
-    "согласие": "информированное согласие",
-    "ошибка": "медицинская ошибка",
-    "ответственность": "ответственность медработников",
-}
-
-STOP_WORDS = {"и", "в", "во", "на", "по", "за", "к", "ко", "о", "об", "от", "это", "что", "как", "ли"}
+        logging.warning(f"Intents disabled ({INTENTS_PATH}): {e}")
+if INTENTS is not None:
+    logging.info(f"Intents loaded: {len(INTENTS.names)} intents, {len(INTENTS.phrases)} phrases")
+
+# воркеры форкаются здесь, пока процесс однопоточный, и наследуют уже построенные индексы
+MATCH_POOL = MatchPool(KB_STORE.current, MATCH_WORKERS, max_batch=MATCH_BATCH) if MATCH_WORKERS > 0 and HAS_FORK else None
+if MATCH_WORKERS > 0 and not HAS_FORK:
+    logging.warning("MATCH_WORKERS ignored: the match pool needs the fork start method")
+if MATCH_POOL is not None:
+    KB_STORE.on_reload = MATCH_POOL.start  # пул под новую версию — при перезагрузке, а не на первом запросе
+MATCH_CACHE = MatchCache(MATCH_CACHE_SIZE)
+
+async def kb_match(kb, dataset: str, text: str):
+    """(позиция, балл) в kb.faq / kb.exam: из кэша, иначе в пуле процессов (если включён) или здесь."""
+    key = MatchCache.key(dataset, text, kb.version)
+    res = MATCH_CACHE.get(key)
+    if res is not None:
+        return res
+    if MATCH_POOL is not None:
+        res = await MATCH_POOL.match(kb, dataset, text)
+    if res is None:
+        index = kb.faq_index if dataset == "faq" else kb.exam_index
+        res = index.match(text)
+    MATCH_CACHE.put(key, res)
+    return res
+
+def kb_search(kb, dataset: str, text: str):
+    """(позиция, нормированный балл) второго этапа — BM25 по текстам записей; доли мс, без пула."""
+    key = MatchCache.key(dataset + ":text", text, kb.version)
+    res = MATCH_CACHE.get(key)
+    if res is None:
+        res = (kb.faq_search if dataset == "faq" else kb.exam_search).match(text)
+        MATCH_CACHE.put(key, res)
+    return res
 
-def clean_text(s: str) -> str:
-    s = (s or "").lower().replace("ё", "е").strip()
-    s = re.sub(r"[^0-9a-zа-я\s-]+", " ", s, flags=re.IGNORECASE)
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
-
-def normalize_query(s: str) -> str:
-    s = clean_text(s)
-    if s in ALIASES:
-        s = ALIASES[s]
-    return s
-
-def tokens(s: str) -> List[str]:
-    s = normalize_query(s)
-    tks = _WORD_RE.findall(s)
-    return [t for t in tks if t and t not in STOP_WORDS]
-
-def sim(a: str, b: str) -> float:
-    return SequenceMatcher(None, a, b).ratio()
-
-def score_entry(entry: Dict[str, Any], user_text: str, keyword_field: str = "keywords") -> float:
+# ---------- OpenAI fallback ----------
+async def openai_answer(user_text: str, kb, timeout_s: float = OPENAI_TIMEOUT, uid: Optional[int] = None,
+                        trace: Optional[RequestTrace] = None, stream: Optional[StreamingReply] = None) -> Optional[str]:
     """
-    Баллы:
-      +3.0 если keyword (фраза) входит в текст
-      +1.6 если похожесть токена >= 0.78
-      +1.1 если обрубок входит (tk in kw or kw in tk) при длине >= 4
+    Ответ модели по промпту с ближайшими записями базы; None — вызова не было или он не удался.
+    Со `stream` перед настоящим вызовом модели студенту уходит заглушка, и текст
+    дописывается в неё по мере генерации (ответ из кэша — сразу целиком).
     """
-    text = normalize_query(user_text)
-    tks = tokens(text)
-    kws = entry.get(keyword_field) or []
-    if not isinstance(kws, list):
-        return 0.0
-
-    total = 0.0
-    for kw in kws:
-        if not isinstance(kw, str) or not kw.strip():
-            continue
-        kw_n = normalize_query(kw)
-
-        if kw_n and kw_n in text:
-            total += 3.0
-            continue
-
-        # fuzzy по словам
-        best_local = 0.0
-        for tk in tks:
-            if not tk or not kw_n:
-                continue
-            r = sim(tk, kw_n)
-            if r > best_local:
-                best_local = r
-            # обрубки
-            if len(tk) >= 4 and len(kw_n) >= 4 and (tk in kw_n or kw_n in tk):
-                best_local = max(best_local, 0.80)
-
-        if best_local >= 0.78:
-            total += 1.6
-        elif best_local >= 0.70:
-            total += 0.9
-
-    # маленький бонус, если это "card" (чтобы ответы чаще находились)
-    if entry.get("type") in ("card", "answer"):
-        total += 0.1
-
-    return total
-
-def best_match(entries: List[Dict[str, Any]], user_text: str, keyword_field: str = "keywords") -> Tuple[Optional[Dict[str, Any]], float]:
-    best = None
-    best_score = 0.0
-    for e in entries:
-        sc = score_entry(e, user_text, keyword_field=keyword_field)
-        if sc > best_score:
-            best_score = sc
-            best = e
-    return best, best_score
-
-# ---------- Formatters ----------
-def format_faq(entry: Dict[str, Any]) -> str:
-    answer = (entry.get("answer") or entry.get("a") or "").strip()
-    law = (entry.get("law") or "").strip()
-    if law:
-        answer += f"\n\n🔷 Нормативная база: {law}"
-    answer += f"\n\n{DISCLAIMER}"
-    return answer
-
-def format_exam(entry: Dict[str, Any]) -> str:
-    q = (entry.get("question") or "").strip()
-    ideal = (entry.get("ideal_answer") or "").strip()
-    comment = (entry.get("comment") or "").strip()
-    mistake = (entry.get("common_mistake") or "").strip()
-    law = (entry.get("law") or "").strip()
-
-    out = "🎓 Экзаменационная карточка"
-    if q:
-        out += f"\n\n📌 Вопрос:\n{q}"
-    if ideal:
-        out += f"\n\n✅ Эталонный ответ:\n{ideal}"
-    if comment:
-        out += f"\n\n💡 Комментарий:\n{comment}"
-    if mistake:
-        out += f"\n\n⚠️ Типичная ошибка:\n{mistake}"
-    if law:
-        out += f"\n\n🔷 Нормативная база:\n{law}"
-    out += f"\n\n{DISCLAIMER}"
-    return out
-
-def find_intro(section_key: str) -> Optional[Dict[str, Any]]:
-    return next((e for e in FAQ if e.get("section") == section_key and e.get("type") == "intro"), None)
-
-def find_definition(section_key: str) -> Optional[Dict[str, Any]]:
-    # поддерживаем оба варианта: type="def" или role="lead"
-    lead = next((e for e in FAQ if e.get("section") == section_key and e.get("type") in ("def",) ), None)
-    if lead:
-        return lead
-    lead2 = next((e for e in FAQ if e.get("section") == section_key and e.get("type") in ("card", "answer") and e.get("role") == "lead"), None)
-    return lead2
-
-# ---------- OpenAI fallback ----------
-client = OpenAI(api_key=OPENAI_API_KEY) if (OpenAI and OPENAI_API_KEY) else None
-
-def _openai_sync_answer(user_text: str) -> Optional[str]:
-    if not client:
-        return None
-
-    system_rules = (
-        "Ты помощник кафедры медицинского права (Казахстан). "
-        "Стиль: официально-деловой, кратко, по шагам. "
-        "Не придумывай номера статей/приказов и точные реквизиты, если их нет. "
-        "Если требуется уточнение — задай 2-3 коротких уточняющих вопроса. "
-        "В конце предложи кнопку «✉️ Задать вопрос преподавателю» для индивидуального кейса."
-    )
-
-    # Responses API (рекомендуемый)
-    resp = client.responses.create(
-        model="gpt-4o-mini",
-        input=[
-            {"role": "system", "content": system_rules},
-            {"role": "user", "content": user_text},
-        ],
-        # store по умолчанию не обязателен; оставляем false-логикой (без сохранения контекста)
-        store=False,
-    )
-    return (resp.output_text or "").strip() or None
-
-async def openai_answer(user_text: str, timeout_s: int = 18) -> Optional[str]:
-    if not client:
-        return None
-    loop = asyncio.get_event_loop()
-    try:
-        return await asyncio.wait_for(loop.run_in_executor(None, _openai_sync_answer, user_text), timeout=timeout_s)
-    except Exception as e:
-        logging.warning(f"OpenAI fallback failed: {e}")
+    prompt = PROMPTS.build(kb, user_text)
+    if trace is not None:
+        trace.fields.update(prompt_tokens=prompt.tokens, context=[f"{d}:{p}" for d, p in prompt.sources])
+    # материалы в ключе: после правки базы старые ответы не отдаются
+    key = AnswerCache.key(user_text, OPENAI_MODEL, prompt.system)
+    cached = await ANSWER_CACHE.get(key)
+    if cached:
+        return cached
+    # ответ из кэша бесплатен; лимит — только на настоящие вызовы модели
+    if not FLOOD.allow_llm(uid):
         return None
-async def ask_ai(user_text: str) -> str:
-    """Fallback-ответ через OpenAI, когда FAQ не нашёл."""
-    if not oa_client:
-        return (
-            "AI сейчас недоступен.\n"
-            "Попробуйте позже или нажмите «✉️ Задать вопрос преподавателю»."
-        )
 
-    def _call() -> str:
-        resp = oa_client.responses.create(
-            model="gpt-5-mini",
-            input=[
-                {"role": "system", "content": AI_SYSTEM_PROMPT},
-                {"role": "user", "content": user_text},
-            ],
-        )
-        return (getattr(resp, "output_text", "") or "").strip()
-
-    try:
-        text = await asyncio.to_thread(_call)
-        if not text:
-            return (
-                "Не удалось сформировать ответ.\n"
-                "Попробуйте написать проще (1–2 ключевых слова) "
-                "или нажмите «✉️ Задать вопрос преподавателю»."
-            )
-        return text
-    except Exception as e:
-        logging.exception("OpenAI error: %s", e)
-        return (
-            "AI временно недоступен.\n"
-            "Попробуйте позже или нажмите «✉️ Задать вопрос преподавателю»."
-        )
+    # Responses API (рекомендуемый); store=False — без сохранения контекста.
+    # None и при разомкнутом breaker: хэндлер сразу предложит спросить преподавателя
+    on_delta = None
+    if stream is not None and LLM.available and LLM.breaker.ready():
+        await stream.start()
+        on_delta = stream.feed
+    text = await LLM.complete(prompt.system, prompt.user, model=OPENAI_MODEL, timeout_s=timeout_s,
+                              on_delta=on_delta, max_output_tokens=OPENAI_MAX_OUTPUT_TOKENS, store=False)
+    if text:
+        ANSWER_CACHE.put(key, text)
+    return text or None
 
 # ---------- Aiogram ----------
 if not TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN is not set.")
 
-bot = Bot(token=TOKEN)
+bot = Bot(token=TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else Bot(token=TOKEN)
 dp = Dispatcher(bot)
+IN_FLIGHT = InFlightTracker()
+dp.middleware.setup(IN_FLIGHT)
+
+async def flood_notice(message: types.Message, text: str) -> None:
+    """
+    «Подождите» флудеру — через OUTBOX с низким приоритетом: поток уведомлений
+    сам подчиняется лимитам Telegram. Не ждём отправки: лишний апдейт не держит соединение вебхука.
+    """
+    chat_id = message.chat.id
+    task = asyncio.create_task(OUTBOX.send(chat_id, lambda: bot.send_message(chat_id, text), priority=LOW))
+    task.add_done_callback(lambda t: t.cancelled() or t.exception() is None
+                           or logging.info(f"Flood notice to {chat_id} failed: {t.exception()!r}"))
+
+FLOOD = FloodControl(
+    user=TokenBuckets(FLOOD_USER_RATE, FLOOD_USER_BURST, max_keys=USER_STATE_SIZE),
+    total=TokenBuckets(FLOOD_GLOBAL_RATE, FLOOD_GLOBAL_BURST),
+    llm_user=TokenBuckets(LLM_USER_PER_MIN / 60, LLM_USER_PER_MIN, max_keys=USER_STATE_SIZE),
+    llm_total=TokenBuckets(LLM_GLOBAL_PER_MIN / 60, LLM_GLOBAL_PER_MIN),
+    exempt=ADMIN_IDS,
+    notify=flood_notice,
+)
+dp.middleware.setup(FLOOD)
+dp.middleware.setup(HandlerTimer(METRICS))
+# все ответы и рассылки — через одну очередь с лимитами Telegram
+OUTBOX = SendQueue(SEND_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, max_attempts=SEND_MAX_ATTEMPTS,
+                   max_chats=USER_STATE_SIZE, low_share=SEND_LOW_SHARE)
+BROADCAST: Optional[asyncio.Task] = None
+
+async def reply(message: types.Message, text: str, **kwargs) -> types.Message:
+    """
+    То же, что message.answer, но через OUTBOX: ответ студенту идёт раньше рассылки и переживает 429.
+    bot — явно: отправка выполняется в задаче очереди, где контекста апдейта (Bot.get_current) нет.
+    """
+    return await OUTBOX.send(message.chat.id, lambda: bot.send_message(message.chat.id, text, **kwargs))
 
 @dp.message_handler(commands=["start"])
 async def start(message: types.Message):
@@ -368,14 +328,76 @@ async def start(message: types.Message):
         "информированное согласие, врачебная тайна, ответственность.\n\n"
         "Выберите раздел кнопками ниже или просто напишите вопрос текстом."
     )
-    await message.answer(text, reply_markup=menu)
+    await reply(message, text, reply_markup=menu)
 
 @dp.message_handler(commands=["help", "menu"])
 async def help_cmd(message: types.Message):
-    await message.answer("Выберите раздел кнопками или напишите вопрос текстом.", reply_markup=menu)
+    await reply(message, "Выберите раздел кнопками или напишите вопрос текстом.", reply_markup=menu)
+
+@dp.message_handler(commands=["reload"])
+async def reload_cmd(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    changed = await KB_STORE.reload(force=True)
+    kb = KB_STORE.current
+    if changed:
+        text = f"✅ База знаний перезагружена: v{kb.version}, FAQ {len(kb.faq)}, EXAM {len(kb.exam)}."
+    else:
+        text = f"⚠️ Перезагрузка не удалась, работает v{kb.version}:\n{KB_STORE.last_error}"
+    await reply(message, text)
+
+@dp.message_handler(commands=["stats"])
+async def stats_cmd(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await reply(message, stats_text())
 
-@dp.message_handler(lambda m: (m.text or "").strip() == "📄 Нормативная база")
-async def law_base(message: types.Message):
+@dp.message_handler(commands=["pro", "unpro"])
+async def pro_cmd(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    arg = message.get_args().strip()
+    if not arg.isdigit():
+        await reply(message, "Формат: /pro <Telegram ID> или /unpro <Telegram ID>")
+        return
+    grant = message.get_command(pure=True) == "pro"
+    if not grant and int(arg) in USER_STATE.pro_users:
+        # is_pro = флаг в базе ИЛИ PRO_USERS: снятый флаг доступа не отнимет
+        await reply(message, f"⚠️ {arg} получает PRO из переменной окружения PRO_USERS — "
+                             f"командой не снять: уберите ID из PRO_USERS и перезапустите бота.")
+        return
+    await USER_STATE.set_pro(int(arg), grant)
+    await reply(message, f"✅ PRO-доступ для {arg} {'выдан' if grant else 'снят'}.")
+
+async def run_broadcast(admin_chat: int, text: str) -> None:
+    started = time.perf_counter()
+    res = await broadcast(OUTBOX, USER_STATE.iter_user_ids(), lambda uid: lambda: bot.send_message(uid, text),
+                          window=BROADCAST_WINDOW)
+    took = time.perf_counter() - started
+    logging.info(f"Broadcast done in {took:.1f}s: {res}")
+    for k, v in res.items():
+        METRICS.inc("bot_broadcast_total", (("result", k),), v)
+    await OUTBOX.send(admin_chat, lambda: bot.send_message(
+        admin_chat, f"📣 Рассылка завершена за {took:.0f} сек: доставлено {res['sent']}, "
+                    f"заблокировали бота {res['blocked']}, ошибок {res['failed']}."))
+
+@dp.message_handler(commands=["broadcast"])
+async def broadcast_cmd(message: types.Message):
+    global BROADCAST
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    text = message.get_args().strip()
+    if not text:
+        await reply(message, "Формат: /broadcast <текст сообщения для всех студентов>")
+        return
+    if BROADCAST is not None and not BROADCAST.done():
+        await reply(message, f"⚠️ Предыдущая рассылка ещё идёт: в очереди {OUTBOX.backlog()} сообщений.")
+        return
+    # в фоне: хэндлер не держит апдейт, ответы студентам идут вперёд рассылки
+    BROADCAST = asyncio.create_task(run_broadcast(message.chat.id, text))
+    await reply(message, "📣 Рассылка запущена, итог пришлю сюда.")
+
+async def law_base(message: types.Message, route: Route):
     text = (
         "📄 Нормативная база (ориентиры):\n"
         "• Кодекс РК «О здоровье народа и системе здравоохранения»\n"
@@ -383,11 +405,11 @@ async def law_base(message: types.Message):
         "• Внутренние регламенты медорганизации и приказы уполномоченного органа\n\n"
         "Если напишете тему (например, «врачебная тайна»), я подскажу типовой блок норм."
     )
-    await message.answer(text, reply_markup=menu)
+    await reply(message, text, reply_markup=menu)
 
-@dp.message_handler(lambda m: (m.text or "").strip() == "✉️ Задать вопрос преподавателю")
-async def ask_teacher(message: types.Message):
-    await message.answer(
+async def ask_teacher(message: types.Message, route: Route):
+    await reply(
+        message,
         "Напишите ваш вопрос одним сообщением.\n"
         "Формат: *Тема* → *Суть вопроса*.\n"
         "Не указывайте лишние персональные данные.",
@@ -395,16 +417,19 @@ async def ask_teacher(message: types.Message):
         reply_markup=menu,
     )
 
-@dp.message_handler(lambda m: (m.text or "").strip() == "🧪 Мини-тесты")
-async def mini_tests(message: types.Message):
+async def mini_tests(message: types.Message, route: Route):
     uid = message.from_user.id
-    USER_MODE[uid] = "exam"
+    state = await USER_STATE.get(uid)
+    state.mode = "exam"
+    EXAM.sync(KB_STORE.current.deck, state)
+    USER_STATE.save(uid, state)
 
-    if uid in PRO_USERS:
+    if USER_STATE.is_pro(uid, state):
         text = (
             "🧪 Экзаменационный режим PRO\n\n"
             "Доступ активен.\n"
-            "Напишите тему или ключевые слова (например: «ответственность», «уголовная»).\n\n"
+            "Напишите тему или ключевые слова (например: «ответственность», «уголовная») "
+            "или выберите карточку кнопками ниже.\n\n"
             "Чтобы выйти из режима — напишите: выход"
         )
     else:
@@ -416,10 +441,69 @@ async def mini_tests(message: types.Message):
             "Чтобы выйти из режима — напишите: выход"
         )
 
-    await message.answer(text, reply_markup=menu)
+    await reply(message, text, reply_markup=exam_start_keyboard)
+
+def sections_keyboard(deck: ExamDeck, seen: bytearray) -> InlineKeyboardMarkup:
+    keyboard = InlineKeyboardMarkup()
+    for i, name in enumerate(deck.sections):
+        done, total = deck.progress(f"s{i}", seen)
+        keyboard.add(InlineKeyboardButton(f"{name} · {done}/{total}", callback_data=f"exam:s{i}"))
+    return keyboard
+
+async def send_card(message: types.Message, kb, state, uid: int, card: Optional[int], is_pro: bool) -> str:
+    """Карточка с кнопками навигации или «тема просмотрена»; ветка для журнала."""
+    if card is None:
+        await reply(message, f"✅ Все карточки просмотрены ({kb.deck.title(state.topic)}).\n"
+                             "Выберите другой раздел, напишите новую тему или начните заново.",
+                    reply_markup=exam_done_keyboard)
+        return "exam_done"
+    EXAM.show(state, card, is_pro)
+    USER_STATE.save(uid, state)
+    await reply(message, kb.exam_replies[card], reply_markup=exam_keyboard)
+    return "exam"
+
+# кнопки под карточками: следующая / случайная / раздел — по спискам ExamDeck, без поиска
+@dp.callback_query_handler(lambda call: (call.data or "").startswith("exam:"))
+async def exam_button(call: types.CallbackQuery):
+    uid = call.from_user.id
+    action = call.data[len("exam:"):]
+    state = await USER_STATE.get(uid)
+    if state.mode != "exam":
+        await call.answer("Экзаменационный режим выключен — нажмите «🧪 Мини-тесты».", show_alert=True)
+        return
+    await call.answer()
+    kb = KB_STORE.current
+    deck = kb.deck
+    is_pro = USER_STATE.is_pro(uid, state)
+    EXAM.sync(deck, state)
+    section = action[1:] if action[:1] == "s" and action[1:].isdigit() else None
+    # callback data приходит от клиента: в метку — только известные действия, иначе число серий не ограничено
+    label = "section" if section is not None else action if action in EXAM_ACTIONS else "other"
+    METRICS.inc("bot_exam_buttons_total", (("action", label),))
+
+    if action == "sections":
+        await reply(call.message, "📚 Разделы экзаменационного банка (просмотрено / всего):",
+                    reply_markup=sections_keyboard(deck, state.seen))
+        return
+    if action == "reset":
+        EXAM.reset(state)
+        USER_STATE.save(uid, state)
+        await reply(call.message, "🔄 Отметки о просмотренных карточках сброшены.", reply_markup=exam_start_keyboard)
+        return
+    if EXAM.limited(state, is_pro):
+        await reply(call.message, DEMO_LIMIT_TEXT, reply_markup=menu)
+        return
+    if action == "next":
+        card = EXAM.next_card(deck, state)
+    elif action == "random":
+        card = EXAM.random_card(deck, state)
+    elif section is not None:
+        card = EXAM.open_topic(deck, state, f"s{section}")
+    else:
+        return
+    await send_card(call.message, kb, state, uid, card, is_pro)
 
-@dp.message_handler(lambda m: (m.text or "").strip().lower() in {"хочу pro-доступ", "хочу pro доступ", "pro-доступ", "pro доступ"})
-async def want_pro(message: types.Message):
+async def want_pro(message: types.Message, route: Route):
     text = (
         "🔒 Экзаменационный режим PRO\n\n"
         "Полный доступ включает:\n"
@@ -430,169 +514,320 @@ async def want_pro(message: types.Message):
         "Доступ предоставляется обучающимся кафедры.\n"
         "Для подключения напишите администратору кафедры или преподавателю, курирующему дисциплину."
     )
-    await message.answer(text, reply_markup=menu)
+    await reply(message, text, reply_markup=menu)
 
 # Кнопка раздела: intro + def (если есть)
-@dp.message_handler(lambda m: (m.text or "").strip() in SECTIONS)
-async def handle_section_buttons(message: types.Message):
-    key = (message.text or "").strip()
-
-    # для трёх спец-кнопок уже есть отдельные хэндлеры выше
-    if key in ("📄 Нормативная база", "✉️ Задать вопрос преподавателю", "🧪 Мини-тесты"):
-        return
-
-    intro = find_intro(key)
-    definition = find_definition(key)
-
-    parts = []
-    if intro:
-        parts.append((intro.get("answer") or "").strip())
-    if definition and definition is not intro:
-        parts.append((definition.get("answer") or "").strip())
-
-    if parts:
-        out = "\n\n".join([p for p in parts if p])
-        out += f"\n\n{DISCLAIMER}"
-        await message.answer(out, reply_markup=menu)
+async def handle_section_buttons(message: types.Message, route: Route):
+    out = KB_STORE.current.sections.replies.get(route.text)
+    if out:
+        await reply(message, out, reply_markup=menu)
         return
 
-    await message.answer(
+    await reply(
+        message,
         "Раздел открыт. Напишите 1–2 ключевых слова по теме (например: «жалоба», «отказали», «тайна»).",
         reply_markup=menu
     )
 
-# ЕДИНСТВЕННЫЙ текстовый хэндлер (чтобы не было тишины/конфликтов)
-@dp.message_handler(lambda m: m.text and (not m.text.startswith("/")) and ((m.text or "").strip() not in SECTIONS))
-async def handle_text(message: types.Message):
+async def handle_text(message: types.Message, route: Route):
+    trace = RequestTrace(uid=message.from_user.id, kb_version=KB_STORE.current.version)
+    try:
+        await answer_text(message, route, trace)
+    finally:
+        record = trace.record()
+        REQUEST_LOG.write(record)
+        observe_request(record)
+
+def observe_request(record: dict) -> None:
+    METRICS.inc("bot_requests_total", (("branch", record.get("branch", "error")),))
+    if "dataset" in record:
+        METRICS.observe("bot_match_score", record["score"], (("dataset", record["dataset"]),))
+    if "text_score" in record:
+        METRICS.observe("bot_retrieval_score", record["text_score"], (("dataset", record["dataset"]),))
+    for stage, ms in record["ms"].items():
+        METRICS.observe("bot_stage_seconds", ms / 1000, (("stage", stage),))
+
+def observe_stream(stream: StreamingReply, trace: RequestTrace) -> None:
+    """Время до первого текста модели у студента (правка заглушки) — от получения сообщения."""
+    trace.fields.update(stream_deltas=stream.stats["deltas"], stream_edits=stream.stats["edits"])
+    if stream.first_content_at is not None:
+        ttfc = stream.first_content_at - trace.started
+        trace.fields["ttfc_ms"] = round(ttfc * 1000, 3)
+        METRICS.observe("bot_llm_first_content_seconds", ttfc)
+
+async def answer_text(message: types.Message, route: Route, trace: RequestTrace):
     uid = message.from_user.id
-    raw = (message.text or "").strip()
+    raw = route.text
+    kb = KB_STORE.current  # одна версия базы на всё сообщение
+    trace.fields["query"] = normalize_query(raw)
+    trace.mark("normalize")
+    state = await USER_STATE.get(uid)
+    trace.mark("state")
     # 0) приветствия — не запускаем ни FAQ, ни EXAM, ни AI
-    greetings = {"привет", "прив", "hello", "hi", "здарова", "здрасьте", "ку", "салам", "салем", "здравствуйте"}
-    norm = raw.lower().strip(" .,!?:;")
-    if norm in greetings:
-        await message.answer(
+    if route.kind == "greeting":
+        trace.fields["branch"] = "greeting"
+        await reply(
+            message,
             "Привет! 🙂\n\n"
             "Можешь:\n"
             "• нажать кнопку нужного раздела ниже,\n"
             "• или написать вопрос 1–2 словами (например: «жалоба», «хамство врача», «отказ в помощи»).",
             reply_markup=menu
         )
+        trace.mark("send")
         return
 
-    # выход из экзамен-режима
-    if USER_MODE.get(uid) == "exam" and raw.lower() in ("выход", "выйти", "exit"):
-        USER_MODE.pop(uid, None)
-        await message.answer("Экзаменационный режим выключён. Можете задавать обычные вопросы.", reply_markup=menu)
+    # выход из экзамен-режима; вне режима «выход» — обычный текст
+    if state.mode == "exam" and route.kind == "exit":
+        state.mode = ""
+        EXAM.leave(state)
+        USER_STATE.save(uid, state)
+        trace.fields["branch"] = "exam_exit"
+        await reply(message, "Экзаменационный режим выключён. Можете задавать обычные вопросы.", reply_markup=menu)
+        trace.mark("send")
         return
 
     # 1) если включен exam-режим — сначала EXAM
-    if USER_MODE.get(uid) == "exam":
+    if state.mode == "exam":
+        is_pro = USER_STATE.is_pro(uid, state)
+        deck = kb.deck
+        EXAM.sync(deck, state)
         # ДЕМО-ограничение: если пользователь не PRO — даём только DEMO_EXAM_LIMIT карточек
-        if uid not in PRO_USERS:
-            used = DEMO_EXAM_COUNTER.get(uid, 0)
-            if used >= DEMO_EXAM_LIMIT:
-                await message.answer(
-                    "🔒 Экзаменационный режим (демо)\n\n"
-                    "Доступный лимит карточек в демо исчерпан.\n"
-                    "Чтобы подключить полный доступ, напишите: «Хочу PRO-доступ».",
-                    reply_markup=menu,
-                )
-                return
-
-        exam_entry, exam_score = best_match(EXAM, raw, keyword_field="keywords")
-        if exam_entry and exam_score >= 1.0:
-            if uid not in PRO_USERS:
-                DEMO_EXAM_COUNTER[uid] = DEMO_EXAM_COUNTER.get(uid, 0) + 1
-
-            await message.answer(format_exam(exam_entry), reply_markup=menu)
+        if EXAM.limited(state, is_pro):
+            trace.fields["branch"] = "exam_limit"
+            await reply(message, DEMO_LIMIT_TEXT, reply_markup=menu)
+            trace.mark("send")
             return
 
-        await message.answer(
-            "По этому запросу экзаменационная карточка не найдена.\n"
-            "Попробуйте проще: «ответственность», «дисциплинарная», «уголовная».",
-            reply_markup=menu,
-        )
-        return
-    uid = message.from_user.id
-    raw = (message.text or "").strip()
-
-    # 0) выход из exam-режима
-    if USER_MODE.get(uid) == "exam" and raw.lower() in ("выход", "выйти", "exit"):
-        USER_MODE.pop(uid, None)
-        await message.answer("Экзаменационный режим выключён. Можете задавать обычные вопросы.", reply_markup=menu)
-        return
-
-    # 1) Если включен exam-режим — отвечаем ТОЛЬКО из EXAM
-    if USER_MODE.get(uid) == "exam":
-        exam_entry, exam_score = best_match(EXAM, raw, keyword_field="keywords")
-
-        # порог можно держать высоким, чтобы не стрелять в мусор
-        if exam_entry and exam_score >= 1.0:
-            await message.answer(format_exam(exam_entry), reply_markup=menu)
+        query = trace.fields["query"]
+        keyword_topic = deck.keyword_topic(query)
+        card = None
+        if query and query == state.query:
+            # та же тема ещё раз — следующая непросмотренная карточка темы, без поиска
+            card = EXAM.next_card(deck, state)
+            trace.fields["exam_via"] = "repeat"
+        elif keyword_topic:
+            # тема — точный keyword: список его карточек готов с загрузки
+            card = EXAM.open_topic(deck, state, keyword_topic, query)
+            trace.fields["exam_via"] = "keyword"
+        else:
+            # новая тема своими словами — нечёткий поиск, дальше по разделу найденной карточки
+            exam_pos, exam_score = await kb_match(kb, "exam", raw)
+            trace.mark("match")
+            trace.fields.update(dataset="exam", entry=exam_pos, score=round(exam_score, 3))
+            if exam_pos is None or exam_score < 1.0:
+                # вопрос своими словами: ищем по тексту вопросов и ответов карточек
+                exam_pos, text_score = kb_search(kb, "exam", raw)
+                trace.mark("retrieval")
+                trace.fields.update(text_entry=exam_pos, text_score=text_score)
+                if exam_pos is not None and text_score < RETRIEVAL_THRESHOLD:
+                    exam_pos = None
+            if exam_pos is not None:
+                card = EXAM.open_topic(deck, state, deck.section_topic(exam_pos), query, first=exam_pos)
+                trace.fields["exam_via"] = "text" if "text_entry" in trace.fields else "search"
+        if "exam_via" in trace.fields:
+            trace.fields.update(exam_topic=state.topic, exam_card=card)
+            trace.fields["branch"] = await send_card(message, kb, state, uid, card, is_pro)
+            trace.mark("send")
             return
 
-        await message.answer(
+        trace.fields["branch"] = "exam_none"
+        await reply(
+            message,
             "По этому запросу экзаменационная карточка не найдена.\n"
             "Попробуйте проще: «ответственность», «дисциплинарная», «уголовная».",
             reply_markup=menu,
         )
+        trace.mark("send")
         return
 
-    # 2) Обычный режим — ТОЛЬКО FAQ (EXAM тут вообще не участвует)
-    faq_entry, faq_score = best_match(FAQ, raw, keyword_field="keywords")
-
-    # Порог для FAQ: можно чуть ниже, чтобы ловил короткие/кривые слова
-    if faq_entry and faq_score >= 0.8:
-        section = (faq_entry.get("section") or "").strip()
-        definition = find_definition(section) if section else None
-
-        parts = []
-        if definition and definition is not faq_entry:
-            parts.append((definition.get("answer") or "").strip())
+    # 2) Интенты: маршрут до поиска по FAQ (один вызов cdist, ниже порога — пусто)
+    intent, intent_score = INTENTS.match(raw, INTENT_THRESHOLD) if INTENTS else (None, 0)
+    intent_route = INTENTS.intents[intent] if intent else {}
+    if intent:
+        trace.fields.update(intent=intent, intent_score=round(intent_score, 1))
+    if intent_route.get("reply"):
+        trace.mark("match")
+        trace.fields["branch"] = "intent"
+        await reply(message, intent_route["reply"], reply_markup=menu)
+        trace.mark("send")
+        return
 
-        parts.append((faq_entry.get("answer") or faq_entry.get("a") or "").strip())
+    # 3) Обычный режим — ТОЛЬКО FAQ (EXAM тут вообще не участвует)
+    faq_pos, faq_score = await kb_match(kb, "faq", raw)
+    trace.mark("match")
+    # балл пишем и для промахов: по журналу подбирается порог 0.8
+    trace.fields.update(dataset="faq", entry=faq_pos, score=round(faq_score, 3))
 
-        out = "\n\n".join([p for p in parts if p])
-        law = (faq_entry.get("law") or "").strip()
-        if law:
-            out += f"\n\n🔷 Нормативная база: {law}"
-        out += f"\n\n{DISCLAIMER}"
+    # Порог для FAQ: можно чуть ниже, чтобы ловил короткие/кривые слова
+    if faq_pos is not None and faq_score >= 0.8:
+        trace.fields["branch"] = "faq"
+        await reply(message, kb.faq_replies[faq_pos], reply_markup=menu)
+        trace.mark("send")
+        return
 
-        await message.answer(out, reply_markup=menu)
+    # keywords не сработали — BM25 по полным текстам записей, до раздела и OpenAI
+    text_pos, text_score = kb_search(kb, "faq", raw)
+    trace.mark("retrieval")
+    trace.fields.update(text_entry=text_pos, text_score=text_score)
+    if text_pos is not None and text_score >= RETRIEVAL_THRESHOLD:
+        trace.fields["branch"] = "faq_text"
+        await reply(message, kb.faq_replies[text_pos], reply_markup=menu)
+        trace.mark("send")
         return
 
-    # 3) Если FAQ не нашёл — AI fallback (если ключ есть)
-    ai_text = await openai_answer(raw)
-    if ai_text:
-        out = ai_text.strip() + f"\n\n{DISCLAIMER}"
-        await message.answer(out, reply_markup=menu)
+    # интент узнал тему — ответ раздела вместо вызова OpenAI
+    section_reply = kb.sections.replies.get(intent_route.get("section"))
+    if section_reply:
+        trace.fields["branch"] = "section"
+        await reply(message, section_reply, reply_markup=menu)
+        trace.mark("send")
         return
 
-    # 4) Совсем ничего
-    await message.answer(
-        "Не нашёл точного ответа в базе знаний.\n"
-        "Попробуйте переформулировать вопрос проще (1–2 ключевых слова) "
-        "или нажмите «✉️ Задать вопрос преподавателю».",
-        reply_markup=menu,
-    )
-    return
- 
-    # 3) если базы не нашли — подключаем меня (AI-fallback), если ключ задан
-    ai_text = await openai_answer(raw)
+    # 4) Если FAQ не нашёл — AI fallback (если ключ есть)
+    stream = StreamingReply(message, interval=LLM_STREAM_EDIT_INTERVAL, reply_markup=menu, send=reply) if LLM_STREAM else None
+    ai_text = await openai_answer(raw, kb, uid=uid, trace=trace, stream=stream)
+    trace.mark("llm")
     if ai_text:
-        out = ai_text.strip() + f"\n\n{DISCLAIMER}"
-        await message.answer(out, reply_markup=menu)
+        trace.fields["branch"] = "llm"
+        if stream is not None and stream.started:
+            await stream.finish(with_disclaimer(ai_text))
+            observe_stream(stream, trace)
+        else:
+            await reply(message, with_disclaimer(ai_text), reply_markup=menu)
+        trace.mark("send")
         return
 
-    # 4) совсем ничего
-    await message.answer(
+    # 5) Совсем ничего
+    trace.fields["branch"] = "none"
+    nothing = (
         "Не нашёл точного ответа в базе знаний.\n"
         "Попробуйте переформулировать вопрос проще (1–2 ключевых слова) "
-        "или нажмите «✉️ Задать вопрос преподавателю».",
-        reply_markup=menu,
+        "или нажмите «✉️ Задать вопрос преподавателю»."
     )
-    return
-    
+    if stream is not None and stream.started:
+        await stream.finish(nothing)  # заглушка или оборванный черновик не должны остаться
+    else:
+        await reply(message, nothing, reply_markup=menu)
+    trace.mark("send")
+
+ROUTES = {
+    "law_base": law_base,
+    "ask_teacher": ask_teacher,
+    "mini_tests": mini_tests,
+    "pro": want_pro,
+    "section": handle_section_buttons,
+    "greeting": handle_text,
+    "exit": handle_text,
+    "text": handle_text,
+}
+
+# ЕДИНСТВЕННЫЙ хэндлер текста после команд: маршрут — один проход Router, без цепочки фильтров
+@dp.message_handler(content_types=types.ContentType.TEXT)
+async def on_text(message: types.Message):
+    route = ROUTER.route(message.text)
+    handler = ROUTES.get(route.kind)  # команды без своего хэндлера и пустой текст — без ответа
+    if handler is not None:
+        name_handler(handler.__name__)
+        await handler(message, route)
+
+async def on_startup(dp: Dispatcher):
+    if MATCH_POOL is not None:
+        await MATCH_POOL.start(KB_STORE.current)
+    if KB_RELOAD_INTERVAL > 0:
+        asyncio.create_task(KB_STORE.watch(KB_RELOAD_INTERVAL))
+    asyncio.create_task(USER_STATE.run())
+    asyncio.create_task(REQUEST_LOG.run())
+    asyncio.create_task(LOOP_LAG.run())
+    OUTBOX.start()
+    asyncio.create_task(LLM.warm_up())
+    if BOT_MODE == "webhook" and WEBHOOK_HOST:
+        await bot.set_webhook(
+            WEBHOOK_HOST.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+
+async def on_shutdown(dp: Dispatcher):
+    # сначала дожидаемся начатых ответов, потом закрываем клиентов
+    await IN_FLIGHT.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    if BROADCAST is not None:
+        BROADCAST.cancel()  # недошедшее — не досылаем
+    await OUTBOX.close()
+    await LLM.close()
+    ANSWER_CACHE.close()
+    await USER_STATE.close()
+    await REQUEST_LOG.close()
+    if MATCH_POOL is not None:
+        MATCH_POOL.close()
+
+def health() -> dict:
+    return {
+        "mode": BOT_MODE,
+        "kb_version": KB_STORE.current.version,
+        "in_flight": IN_FLIGHT.count,
+        "updates": IN_FLIGHT.total,
+        "users_cached": len(USER_STATE),
+        "flood_dropped": FLOOD.stats["dropped"],
+        "match_cache_hit_rate": round(MATCH_CACHE.hit_rate, 3),
+    }
+
+def _series(stats: dict, label: str) -> dict:
+    return {((label, k),): v for k, v in stats.items()}
+
+METRICS.collect("bot_uptime_seconds", "gauge", lambda: time.time() - METRICS.started)
+METRICS.collect("bot_resident_memory_bytes", "gauge", rss_bytes)
+METRICS.collect("bot_updates_total", "counter", lambda: IN_FLIGHT.total)
+METRICS.collect("bot_updates_in_flight", "gauge", lambda: IN_FLIGHT.count)
+METRICS.collect("bot_event_loop_lag_max_seconds", "gauge", lambda: LOOP_LAG.max)
+METRICS.collect("bot_kb_version", "gauge", lambda: KB_STORE.current.version)
+METRICS.collect("bot_openai_calls_total", "counter", lambda: _series(LLM.stats, "result"))
+METRICS.collect("bot_openai_breaker_open", "gauge", lambda: float(LLM.breaker.state != "closed"))
+METRICS.collect("bot_answer_cache_total", "counter", lambda: _series(ANSWER_CACHE.stats, "event"))
+METRICS.collect("bot_match_cache_total", "counter", lambda: _series(MATCH_CACHE.stats, "event"))
+METRICS.collect("bot_flood_total", "counter", lambda: _series(FLOOD.stats, "event"))
+METRICS.collect("bot_user_state_total", "counter", lambda: _series(USER_STATE.stats, "event"))
+METRICS.collect("bot_request_log_total", "counter", lambda: _series(REQUEST_LOG.stats, "event"))
+METRICS.collect("bot_send_total", "counter", lambda: _series(OUTBOX.stats, "result"))
+METRICS.collect("bot_send_queue", "gauge", lambda: len(OUTBOX))
+METRICS.collect("bot_exam_total", "counter", lambda: _series(EXAM.stats, "event"))
+METRICS.add_histogram("bot_openai_seconds", LLM.latency)
+METRICS.add_histogram("bot_openai_first_token_seconds", LLM.first_token)
+
+def stats_text() -> str:
+    """Короткая сводка для /stats: квантили — верхние границы корзин гистограмм."""
+    def ms(h) -> str:
+        return f"p50 {h.quantile(0.5) * 1000:.0f} / p95 {h.quantile(0.95) * 1000:.0f} мс" if h.count else "—"
+
+    branches = METRICS.counters.get("bot_requests_total", {})
+    handlers = METRICS.histograms.get("bot_handler_seconds", {})
+    lag = METRICS.histograms.get("bot_event_loop_lag_seconds", {}).get(())
+    lines = [
+        f"📊 Аптайм {(time.time() - METRICS.started) / 3600:.1f} ч, апдейтов {IN_FLIGHT.total}, "
+        f"память {rss_bytes() / 2 ** 20:.0f} МБ, база v{KB_STORE.current.version}",
+        "Ветки: " + (", ".join(f"{dict(k)['branch']} {int(v)}" for k, v in sorted(branches.items())) or "—"),
+        "Хэндлеры:",
+        *(f"• {dict(k)['handler']} ×{h.count}: {ms(h)}" for k, h in sorted(handlers.items())),
+        f"OpenAI: {LLM.stats['ok']} ок, {LLM.stats['errors']} ошибок, {LLM.stats['rejected'] + LLM.stats['shed']} отказов, "
+        f"{ms(LLM.latency)}, breaker {LLM.breaker.state}",
+        f"Кэш поиска {MATCH_CACHE.hit_rate:.0%}, кэш ответов {ANSWER_CACHE.hit_rate:.0%}, "
+        f"флуд отсечено {FLOOD.stats['dropped']}",
+        f"Отправка: {OUTBOX.stats['sent']} ок, в очереди {len(OUTBOX)}, 429 {OUTBOX.stats['retry_after']}, "
+        f"повторов {OUTBOX.stats['retries']}, не доставлено {OUTBOX.stats['failed']}",
+        f"Экзамен: карточек {EXAM.stats['shown']}, тем {EXAM.stats['topics']}, «следующая» {EXAM.stats['next']}, "
+        f"«случайная» {EXAM.stats['random']}, тема просмотрена {EXAM.stats['exhausted']}",
+        f"Лаг event loop: {ms(lag) if lag else '—'}, max {LOOP_LAG.max * 1000:.0f} мс",
+    ]
+    return "\n".join(lines)
+
+def make_webhook_app():
+    return build_webhook_app(dp, WEBHOOK_PATH, on_startup=on_startup, on_shutdown=on_shutdown,
+                             health=health, secret=WEBHOOK_SECRET, metrics=METRICS.render)
+
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True)
+    if BOT_MODE == "webhook":
+        # вебхук не снимаем при остановке: Telegram придержит апдейты до рестарта
+        run_webhook(make_webhook_app(), WEBAPP_HOST, WEBAPP_PORT, shutdown_timeout=SHUTDOWN_DRAIN_TIMEOUT + 5)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
 
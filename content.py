@@ -0,0 +1,97 @@
+from typing import Optional, Dict, List
+
+from entries import Entry
+
+DISCLAIMER = (
+    "⚠️ Ответ носит информационный характер и не является официальным юридическим заключением. "
+    "Для индивидуальной ситуации используйте кнопку «✉️ Задать вопрос преподавателю»."
+)
+
+# ---------- Formatters ----------
+def format_faq(entry: Entry, definition: Optional[Entry] = None) -> str:
+    parts = []
+    if definition and definition is not entry:
+        parts.append(definition.answer)
+    parts.append(entry.answer)
+
+    answer = "\n\n".join([p for p in parts if p])
+    if entry.law:
+        answer += f"\n\n🔷 Нормативная база: {entry.law}"
+    answer += f"\n\n{DISCLAIMER}"
+    return answer
+
+def format_exam(entry: Entry) -> str:
+    q = entry.question
+    ideal = entry.ideal_answer
+    comment = entry.comment
+    mistake = entry.common_mistake
+    law = entry.law
+
+    out = "🎓 Экзаменационная карточка"
+    if q:
+        out += f"\n\n📌 Вопрос:\n{q}"
+    if ideal:
+        out += f"\n\n✅ Эталонный ответ:\n{ideal}"
+    if comment:
+        out += f"\n\n💡 Комментарий:\n{comment}"
+    if mistake:
+        out += f"\n\n⚠️ Типичная ошибка:\n{mistake}"
+    if law:
+        out += f"\n\n🔷 Нормативная база:\n{law}"
+    out += f"\n\n{DISCLAIMER}"
+    return out
+
+# ---------- Sections ----------
+class SectionTable:
+    """
+    Раздел -> intro / определение / готовый ответ на кнопку раздела.
+    Строится одним проходом по FAQ при загрузке, дальше только dict-поиск.
+    """
+
+    def __init__(self, faq: List[Entry]):
+        self.intro: Dict[str, Entry] = {}
+        self.definition: Dict[str, Entry] = {}
+        self.replies: Dict[str, str] = {}
+
+        leads: Dict[str, Entry] = {}
+        for e in faq:
+            key = e.section
+            if not key:
+                continue
+            t = e.type
+            if t == "intro":
+                self.intro.setdefault(key, e)
+            # поддерживаем оба варианта: type="def" или role="lead"
+            elif t == "def":
+                self.definition.setdefault(key, e)
+            elif t in ("card", "answer") and e.role == "lead":
+                leads.setdefault(key, e)
+        for key, e in leads.items():
+            self.definition.setdefault(key, e)
+
+        for key in set(self.intro) | set(self.definition):
+            self.replies[key] = self._render(key)
+
+    def _render(self, key: str) -> str:
+        intro = self.intro.get(key)
+        definition = self.definition.get(key)
+
+        parts = []
+        if intro:
+            parts.append(intro.answer)
+        if definition and definition is not intro:
+            parts.append(definition.answer)
+
+        out = "\n\n".join([p for p in parts if p])
+        out += f"\n\n{DISCLAIMER}"
+        return out
+
+    def definition_for(self, entry: Entry) -> Optional[Entry]:
+        return self.definition.get(entry.section) if entry.section else None
+
+def render_faq(faq: List[Entry], sections: SectionTable) -> List[str]:
+    """Готовые ответы FAQ по позициям записей (определение раздела + ответ + норма)."""
+    return [format_faq(e, sections.definition_for(e)) for e in faq]
+
+def render_exam(exam: List[Entry]) -> List[str]:
+    return [format_exam(e) for e in exam]
@@ -0,0 +1,163 @@
+import sys
+import logging
+from typing import Dict, Any, List, Tuple, Iterable
+
+from knowledge import normalize_query
+
+# строковые поля записи FAQ/EXAM; всё прочее из JSON не используется и не хранится
+TEXT_FIELDS = ("section", "type", "role", "question", "answer", "ideal_answer", "comment", "common_mistake", "law")
+_ANSWER = TEXT_FIELDS.index("answer")
+
+class Entry:
+    """
+    Запись FAQ/EXAM после загрузки: строки уже без пробелов по краям ("" вместо
+    отсутствующего поля), keywords — кортеж нормализованных `normalize_query`
+    фраз (пустые отброшены, повторы сохранены: повтор keyword дважды входит в балл).
+
+    Одинаковые строки (sys.intern) и кортежи keywords в базе — один объект (см. `load_entries`),
+    `__slots__` — без словаря на запись. Записи не меняются после загрузки.
+    """
+
+    __slots__ = TEXT_FIELDS + ("keywords",)
+
+    def __init__(self, section: str = "", type: str = "", role: str = "", question: str = "", answer: str = "",
+                 ideal_answer: str = "", comment: str = "", common_mistake: str = "", law: str = "",
+                 keywords: Tuple[str, ...] = ()):
+        self.section = section
+        self.type = type
+        self.role = role
+        self.question = question
+        self.answer = answer
+        self.ideal_answer = ideal_answer
+        self.comment = comment
+        self.common_mistake = common_mistake
+        self.law = law
+        self.keywords = keywords
+
+    def __repr__(self) -> str:
+        return f"Entry({self.section!r}, {self.type!r}, {(self.question or self.answer)[:40]!r})"
+
+    def __getstate__(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+    def __setstate__(self, state) -> None:
+        for f, v in zip(self.__slots__, state):
+            setattr(self, f, v)
+
+    def to_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {f: getattr(self, f) for f in TEXT_FIELDS if getattr(self, f)}
+        if self.keywords:
+            out["keywords"] = list(self.keywords)
+        return out
+
+_STRING_FIELDS = frozenset(TEXT_FIELDS + ("a",))
+
+def check_entry(e: Any, label: str, i: int) -> None:
+    """ValueError с позицией, если запись нельзя загрузить."""
+    if not isinstance(e, dict):
+        raise ValueError(f"{label}[{i}]: expected an object, got {type(e).__name__}")
+    kws = e.get("keywords")
+    if kws is not None and not (isinstance(kws, list) and all(isinstance(k, str) for k in kws)):
+        raise ValueError(f"{label}[{i}]: keywords must be a list of strings")
+    # по полям записи, а не по всем известным: их в записи обычно меньше
+    for field, v in e.items():
+        if v is not None and field in _STRING_FIELDS and not isinstance(v, str):
+            raise ValueError(f"{label}[{i}]: {field} must be a string")
+
+def load_entries(data: Iterable[Any], label: str, strict: bool = True) -> List[Entry]:
+    """
+    Проверить и перевести записи из JSON в Entry за один проход.
+    `strict` — первая плохая запись даёт ValueError; иначе она пропускается с предупреждением.
+    """
+    intern = sys.intern
+    kw_norm: Dict[str, str] = {}  # keyword как в JSON -> нормализованный: normalize_query раз на строку
+    kw_pool: Dict[Tuple[str, ...], Tuple[str, ...]] = {}  # одна копия одинаковых кортежей keywords
+    out: List[Entry] = []
+    for i, e in enumerate(data):
+        try:
+            check_entry(e, label, i)
+        except ValueError as err:
+            if strict:
+                raise
+            logging.warning(f"{err} -> skipped")
+            continue
+        values = [e.get(f) for f in TEXT_FIELDS]
+        if not values[_ANSWER]:
+            values[_ANSWER] = e.get("a")  # "a" — старое имя answer
+        kws = []
+        for kw in e.get("keywords") or ():
+            kw_n = kw_norm.get(kw)
+            if kw_n is None:
+                kw_n = kw_norm[kw] = intern(normalize_query(kw))
+            if kw_n:
+                kws.append(kw_n)
+        kws_t = tuple(kws)
+        out.append(Entry(*[intern(v.strip()) if v else "" for v in values], keywords=kw_pool.setdefault(kws_t, kws_t)))
+    return out
+
+if __name__ == "__main__":
+    import argparse
+    import gc
+    import json
+    import os
+    import sys
+    import time
+    import tracemalloc
+
+    from bench import scale_entries
+
+    parser = argparse.ArgumentParser(description="Память и доступ: Entry против словарей из JSON на синтетической базе")
+    parser.add_argument("--dataset", default="exam.json")
+    parser.add_argument("--size", type=int, default=100000)
+    args = parser.parse_args()
+
+    base = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(base, args.dataset), "r", encoding="utf-8") as f:
+        templates = json.load(f)
+    # через JSON: у загруженной базы у каждой записи свои копии строк, как после json.load
+    raw = json.dumps(scale_entries(templates, args.size, 1), ensure_ascii=False)
+
+    def measure(build):
+        # время — без tracemalloc (он в разы замедляет выделение памяти), память — вторым прогоном
+        gc.collect()
+        t0 = time.perf_counter()
+        build()
+        took = time.perf_counter() - t0
+        gc.collect()
+        tracemalloc.start()
+        value = build()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return value, took, size / 2 ** 20
+
+    dicts, dict_s, dict_mb = measure(lambda: json.loads(raw))
+    entries, entry_s, entry_mb = measure(lambda: load_entries(json.loads(raw), "BENCH"))
+
+    # как раньше на каждой записи: get + isinstance + strip + нормализация keywords
+    def dict_pass():
+        n = 0
+        for e in dicts:
+            kws = e.get("keywords") or []
+            if isinstance(kws, list):
+                n += len([normalize_query(k) for k in kws if isinstance(k, str) and k.strip()])
+            n += len((e.get("answer") or "").strip()) + len((e.get("law") or "").strip())
+            n += len((e.get("question") or "").strip()) + (e.get("type") in ("card", "answer"))
+        return n
+
+    def entry_pass():
+        n = 0
+        for e in entries:
+            n += len(e.keywords) + len(e.answer) + len(e.law) + len(e.question) + (e.type in ("card", "answer"))
+        return n
+
+    timings = {}
+    for name, fn in (("dict", dict_pass), ("Entry", entry_pass)):
+        t0 = time.perf_counter()
+        fn()
+        timings[name] = (time.perf_counter() - t0) / len(dicts) * 1e6
+    print(f"{args.dataset} x{args.size}")
+    print(f"dict : load {dict_s:.2f}s, {dict_mb:.1f} MB, pass {timings['dict']:.2f} µs/entry")
+    print(f"Entry: load {entry_s:.2f}s, {entry_mb:.1f} MB, pass {timings['Entry']:.2f} µs/entry")
+    same = all(e.to_dict().get("question", "") == (d.get("question") or "").strip() for d, e in zip(dicts, entries))
+    sys.exit(0 if same and len(entries) == len(dicts) else 1)
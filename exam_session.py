@@ -0,0 +1,313 @@
+import random
+import hashlib
+from typing import Optional, Dict, List, Tuple
+
+from entries import Entry
+
+# тема сессии: "" — весь банк, "s<номер раздела>", "k<нормализованный keyword>"
+TOPIC_ALL = ""
+
+def is_seen(seen: bytearray, card: int) -> bool:
+    byte = card >> 3
+    return byte < len(seen) and bool(seen[byte] >> (card & 7) & 1)
+
+def mark_seen(seen: bytearray, card: int) -> bool:
+    """Отметить карточку в битсете; True — раньше студент её не видел."""
+    byte = card >> 3
+    if byte >= len(seen):
+        seen.extend(bytes(byte + 1 - len(seen)))
+    bit = 1 << (card & 7)
+    if seen[byte] & bit:
+        return False
+    seen[byte] |= bit
+    return True
+
+class ExamDeck:
+    """
+    Банк экзаменационных карточек, разложенный при загрузке: позиции карточек
+    по разделам и по keywords (нормализованным, как в `Entry`). Тема студента —
+    один из этих списков; следующая, случайная и карточка раздела берутся
+    из списка по индексу, без поиска по банку.
+
+    `digest` — отпечаток вопросов банка: после правки exam.json позиции
+    карточек могут сдвинуться, и просмотренные у студента сбрасываются.
+    """
+
+    def __init__(self, exam: List[Entry]):
+        self.all: List[int] = list(range(len(exam)))
+        self.sections: List[str] = []
+        self.by_section: List[List[int]] = []
+        self.section_of: List[int] = []  # карточка -> номер раздела
+        self.rank: List[int] = []  # карточка -> место в списке своего раздела
+        self.by_keyword: Dict[str, List[int]] = {}
+        numbers: Dict[str, int] = {}
+        digest = hashlib.sha1()
+        for pos, e in enumerate(exam):
+            s = numbers.get(e.section)
+            if s is None:
+                s = numbers[e.section] = len(self.sections)
+                self.sections.append(e.section or "Без раздела")
+                self.by_section.append([])
+            self.section_of.append(s)
+            self.rank.append(len(self.by_section[s]))
+            self.by_section[s].append(pos)
+            for kw in dict.fromkeys(e.keywords):  # повтор keyword в карточке — одна позиция в списке
+                self.by_keyword.setdefault(kw, []).append(pos)
+            digest.update(e.question.encode("utf-8") + b"\0")
+        self.digest = digest.hexdigest()[:12]
+
+    def __len__(self) -> int:
+        return len(self.all)
+
+    def cards(self, topic: str) -> List[int]:
+        """Карточки темы; тема, которой после перезагрузки базы нет, — весь банк."""
+        if topic[:1] == "s" and topic[1:].isdigit() and int(topic[1:]) < len(self.by_section):
+            return self.by_section[int(topic[1:])]
+        if topic[:1] == "k":
+            return self.by_keyword.get(topic[1:], self.all)
+        return self.all
+
+    def keyword_topic(self, query: str) -> Optional[str]:
+        return "k" + query if query in self.by_keyword else None
+
+    def section_topic(self, card: int) -> str:
+        return f"s{self.section_of[card]}"
+
+    def title(self, topic: str) -> str:
+        if topic[:1] == "s" and topic[1:].isdigit() and int(topic[1:]) < len(self.sections):
+            return self.sections[int(topic[1:])]
+        if topic[:1] == "k" and topic[1:] in self.by_keyword:
+            return f"«{topic[1:]}»"
+        return "весь банк"
+
+    @staticmethod
+    def next_unseen(cards: List[int], seen: bytearray, start: int = 0) -> Optional[int]:
+        """Место в `cards` первой непросмотренной карточки от `start` по кругу; None — просмотрены все."""
+        n = len(cards)
+        for step in range(n):
+            j = (start + step) % n
+            if not is_seen(seen, cards[j]):
+                return j
+        return None
+
+    @staticmethod
+    def random_unseen(cards: List[int], seen: bytearray, rnd: random.Random, tries: int = 8) -> Optional[int]:
+        """
+        Место в `cards` случайной непросмотренной карточки, все равновероятны; None — просмотрены все.
+        Сначала несколько случайных проб (пока непросмотренных много, хватает одной-двух), потом —
+        случайная из оставшихся непросмотренных проходом по `cards`.
+        """
+        n = len(cards)
+        for _ in range(tries if n else 0):
+            j = rnd.randrange(n)
+            if not is_seen(seen, cards[j]):
+                return j
+        unseen = [j for j in range(n) if not is_seen(seen, cards[j])]
+        return rnd.choice(unseen) if unseen else None
+
+    def progress(self, topic: str, seen: bytearray) -> Tuple[int, int]:
+        cards = self.cards(topic)
+        return sum(1 for c in cards if is_seen(seen, c)), len(cards)
+
+class ExamSessions:
+    """
+    Выдача карточек экзамен-режима поверх `ExamDeck` и состояния студента
+    (`UserState`: seen — битсет просмотренных карточек, topic/cursor — тема
+    и место в ней, query — запрос, открывший тему).
+
+    Каждый метод выбора возвращает позицию карточки в kb.exam или None, если
+    в теме не осталось непросмотренных; `show` отмечает карточку и ведёт
+    демо-учёт: лимит `demo_limit` тратят только новые карточки, повторов выдача не делает.
+    """
+
+    def __init__(self, demo_limit: int, rnd: Optional[random.Random] = None):
+        self.demo_limit = demo_limit
+        self.rnd = rnd or random.Random()
+        self.stats: Dict[str, int] = {"shown": 0, "topics": 0, "next": 0, "random": 0, "exhausted": 0, "resets": 0}
+
+    def sync(self, deck: ExamDeck, state) -> None:
+        """Просмотренные — от другой версии банка: позиции уже не те, начинаем заново."""
+        if state.deck != deck.digest:
+            if state.deck:
+                self.stats["resets"] += 1
+            state.seen = bytearray()
+            state.deck = deck.digest
+            self.leave(state)
+
+    def limited(self, state, is_pro: bool) -> bool:
+        return not is_pro and state.demo_used >= self.demo_limit
+
+    def leave(self, state) -> None:
+        state.topic = TOPIC_ALL
+        state.cursor = -1
+        state.query = ""
+
+    def open_topic(self, deck: ExamDeck, state, topic: str, query: str = "",
+                   first: Optional[int] = None) -> Optional[int]:
+        """Новая тема; `first` — найденная поиском карточка: с неё, если студент её ещё не видел."""
+        self.stats["topics"] += 1
+        state.topic = topic
+        state.query = query
+        state.cursor = -1  # место в прежней теме к новой не относится
+        start = deck.rank[first] if first is not None and topic == deck.section_topic(first) else 0
+        return self._pick(deck, state, start)
+
+    def next_card(self, deck: ExamDeck, state) -> Optional[int]:
+        self.stats["next"] += 1
+        return self._pick(deck, state, state.cursor + 1)
+
+    def random_card(self, deck: ExamDeck, state) -> Optional[int]:
+        """Случайная непросмотренная из всего банка, каждая равновероятно; «следующая» после неё — по банку."""
+        self.stats["random"] += 1
+        state.topic = TOPIC_ALL
+        state.query = ""
+        j = deck.random_unseen(deck.all, state.seen, self.rnd)
+        if j is None:
+            self.stats["exhausted"] += 1
+            return None
+        state.cursor = j
+        return deck.all[j]
+
+    def _pick(self, deck: ExamDeck, state, start: int) -> Optional[int]:
+        cards = deck.cards(state.topic)
+        j = deck.next_unseen(cards, state.seen, start) if cards else None
+        if j is None and state.topic[:1] == "k" and cards:
+            # у keyword обычно две-три карточки: кончились — дальше по разделу последней из них
+            last = cards[state.cursor] if 0 <= state.cursor < len(cards) else cards[0]
+            state.topic = deck.section_topic(last)
+            cards = deck.cards(state.topic)
+            j = deck.next_unseen(cards, state.seen, deck.rank[last] + 1)
+        if j is None:
+            self.stats["exhausted"] += 1
+            return None
+        state.cursor = j
+        return cards[j]
+
+    def show(self, state, card: int, is_pro: bool) -> None:
+        self.stats["shown"] += 1
+        if mark_seen(state.seen, card) and not is_pro:
+            state.demo_used += 1
+
+    def reset(self, state) -> None:
+        state.seen = bytearray()
+        self.leave(state)
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import time
+    import argparse
+
+    from kb import read_json_list
+    from knowledge import KnowledgeIndex, normalize_query
+    from user_state import UserState
+
+    parser = argparse.ArgumentParser(description="Сессии экзамен-режима на exam.json: обход без повторов и цена выдачи карточки")
+    parser.add_argument("--exam", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "exam.json"))
+    args = parser.parse_args()
+
+    exam = read_json_list(args.exam, "EXAM")
+    deck = ExamDeck(exam)
+    sessions = ExamSessions(demo_limit=5, rnd=random.Random(1))
+    failed = []
+
+    # «следующая» обходит тему без повторов и сообщает, когда карточки кончились
+    state = UserState()
+    sessions.sync(deck, state)
+    for s in range(len(deck.sections)):
+        topic = f"s{s}"
+        got = [sessions.open_topic(deck, state, topic)]
+        while got[-1] is not None:
+            sessions.show(state, got[-1], is_pro=True)
+            got.append(sessions.next_card(deck, state))
+        if got[:-1] != deck.by_section[s]:
+            failed.append(f"section {s}: {got}")
+    if sessions.random_card(deck, state) is not None or state.demo_used:
+        failed.append("all seen: random card returned or PRO spent demo")
+
+    # та же тема дважды — разные карточки; демо тратят только новые
+    state = UserState()
+    sessions.sync(deck, state)
+    query = normalize_query("ответственность")
+    first = sessions.open_topic(deck, state, deck.keyword_topic(query), query)
+    sessions.show(state, first, is_pro=False)
+    second = sessions.next_card(deck, state)
+    sessions.show(state, second, is_pro=False)
+    sessions.show(state, first, is_pro=False)
+    if first == second or state.demo_used != 2:
+        failed.append(f"repeat topic: {first}, {second}, demo_used {state.demo_used}")
+
+    # место в прежней теме не переносится в новую: просмотренный keyword расширяется до раздела своей первой карточки
+    state = UserState()
+    sessions.sync(deck, state)
+    kw = max(deck.by_keyword, key=lambda k: len({deck.section_of[c] for c in deck.by_keyword[k]}))
+    for c in deck.by_keyword[kw]:
+        mark_seen(state.seen, c)
+    state.cursor = len(deck.by_keyword[kw]) - 1
+    card = sessions.open_topic(deck, state, "k" + kw, kw)
+    if state.topic != deck.section_topic(deck.by_keyword[kw][0]):
+        failed.append(f"stale cursor: keyword {kw!r} widened to {state.topic}, card {card}")
+
+    # случайные — без повторов, пока банк не кончится
+    state = UserState()
+    sessions.sync(deck, state)
+    drawn = []
+    card = sessions.random_card(deck, state)
+    while card is not None:
+        sessions.show(state, card, is_pro=True)
+        drawn.append(card)
+        card = sessions.random_card(deck, state)
+    if sorted(drawn) != deck.all:
+        failed.append(f"random: {len(drawn)} of {len(deck)}, {len(set(drawn))} distinct")
+
+    # случайная — равновероятно среди непросмотренных, как бы ни шли просмотренные вокруг них:
+    # хи-квадрат по 12000 выдач; порог ~ p = 0.001 для 5 степеней свободы
+    state = UserState()
+    sessions.sync(deck, state)
+    unseen = [0, 1, 2, 10, len(deck) // 2, len(deck) - 1]
+    for c in deck.all:
+        if c not in unseen:
+            mark_seen(state.seen, c)
+    draws = 12000
+    counts = dict.fromkeys(unseen, 0)
+    for _ in range(draws):
+        card = sessions.random_card(deck, state)
+        counts[card] = counts.get(card, 0) + 1
+    expected = draws / len(unseen)
+    chi2 = sum((n - expected) ** 2 / expected for n in counts.values())
+    if len(counts) != len(unseen) or chi2 > 20.5:
+        failed.append(f"random not uniform: chi2 {chi2:.1f}, counts {counts}")
+
+    # другой банк — просмотренные сбрасываются, демо-счётчик нет
+    state.demo_used = 3
+    sessions.sync(ExamDeck(exam[1:]), state)
+    if state.seen or state.demo_used != 3:
+        failed.append("digest change: seen kept or demo reset")
+
+    # цена выдачи: «следующая» по теме против нечёткого поиска на каждую карточку, как раньше
+    index = KnowledgeIndex(exam)
+    queries = [kw for e in exam for kw in e.keywords]
+    state = UserState()
+    sessions.sync(deck, state)
+    t0 = time.perf_counter()
+    for q in queries:
+        index.match(q)
+    search_us = (time.perf_counter() - t0) / len(queries) * 1e6
+    n = 0
+    t0 = time.perf_counter()
+    for q in queries:
+        card = sessions.open_topic(deck, state, deck.keyword_topic(q), q)
+        for _ in range(3):
+            n += 1
+            if card is None:
+                state.seen = bytearray()
+                card = sessions.next_card(deck, state)
+            sessions.show(state, card, is_pro=True)
+            card = sessions.next_card(deck, state)
+    deck_us = (time.perf_counter() - t0) / n * 1e6
+    print(f"{len(deck)} cards, {len(deck.sections)} sections, {len(deck.by_keyword)} keywords, "
+          f"seen bitset {len(state.seen)} bytes")
+    print(f"fuzzy search per card {search_us:.1f} µs, deck pick per card {deck_us:.2f} µs")
+    for f in failed:
+        print("FAIL", f)
+    sys.exit(1 if failed else 0)
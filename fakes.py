@@ -0,0 +1,338 @@
+"""
+Локальные заглушки внешних API для проверки бота без сети.
+
+    api = FakeResponsesAPI(latency=0.5, fail_rate=0.2)
+    base_url = await api.start()          # http://127.0.0.1:<port>/v1
+    client = LLMClient("test", base_url=base_url)
+    ...
+    await api.stop()
+
+    tg = FakeBotAPI()
+    api_url = await tg.start()            # TELEGRAM_API_URL для бота
+    await tg.wait_messages(10)            # дождаться 10 sendMessage
+
+Запуск отдельно: `python fakes.py openai --port 8090 --latency 1`,
+`python fakes.py telegram --port 8081`.
+"""
+import json
+import time
+import random
+import asyncio
+from typing import Optional, Dict, Any, List, Iterable
+
+from aiohttp import web
+
+
+class FakeServer:
+    """Базовый aiohttp-сервер на 127.0.0.1 со случайным или заданным портом."""
+
+    def __init__(self):
+        self.app = web.Application()
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        real_port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{real_port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class FakeAPIError(Exception):
+    def __init__(self, code: int, description: str, retry_after: int = 0):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class FakeResponsesAPI(FakeServer):
+    """
+    Имитация OpenAI Responses API (POST /v1/responses) с задержкой и долей ошибок.
+    `fail_rate` — доля ответов 500; `down=True` — все ответы 503.
+    С `"stream": true` ответ идёт событиями SSE: `latency` — до первого куска
+    текста, дальше кусками по `chunk_chars` символов раз в `chunk_delay` секунд.
+    """
+
+    def __init__(self, latency: float = 0.0, fail_rate: float = 0.0, reply: str = "Тестовый ответ ассистента.",
+                 chunk_chars: int = 8, chunk_delay: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.reply = reply
+        self.chunk_chars = max(1, chunk_chars)
+        self.chunk_delay = chunk_delay
+        self.down = False
+        self.requests: List[Dict[str, Any]] = []
+        self.errors = 0  # ответов 500/503
+        self.app.router.add_post("/v1/responses", self._responses)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        return await super().start(host, port) + "/v1"
+
+    async def _responses(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests.append(body)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.down or random.random() < self.fail_rate:
+            self.errors += 1
+            return web.json_response({"error": {"message": "fake upstream error", "type": "server_error"}},
+                                     status=503 if self.down else 500)
+        if body.get("stream"):
+            return await self._stream(request, body.get("model", "fake"))
+        return web.json_response(self._payload(body.get("model", "fake"), self.reply))
+
+    async def _stream(self, request: web.Request, model: str) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await resp.prepare(request)
+        seq = 0
+
+        async def event(data: Dict[str, Any]) -> None:
+            nonlocal seq
+            data["sequence_number"] = seq
+            seq += 1
+            await resp.write(f"event: {data['type']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        payload = self._payload(model, self.reply)
+        await event({"type": "response.created", "response": dict(payload, status="in_progress", output=[])})
+        for i in range(0, len(self.reply), self.chunk_chars):
+            if i and self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            await event({"type": "response.output_text.delta", "item_id": "msg_fake", "output_index": 0,
+                         "content_index": 0, "delta": self.reply[i:i + self.chunk_chars], "logprobs": []})
+        await event({"type": "response.output_text.done", "item_id": "msg_fake", "output_index": 0,
+                     "content_index": 0, "text": self.reply, "logprobs": []})
+        await event({"type": "response.completed", "response": payload})
+        await resp.write_eof()
+        return resp
+
+    @staticmethod
+    def _payload(model: str, text: str) -> Dict[str, Any]:
+        return {
+            "id": f"resp_{int(time.time() * 1000)}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": model,
+            "status": "completed",
+            "output": [{
+                "type": "message",
+                "id": "msg_fake",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+            "parallel_tool_calls": False,
+            "tool_choice": "auto",
+            "tools": [],
+        }
+
+
+class FakeBotAPI(FakeServer):
+    """
+    Имитация Telegram Bot API (`/bot<token>/<method>`): getMe, sendMessage,
+    editMessageText, setWebhook/deleteWebhook, getUpdates (из очереди `push_update`).
+    Все исходящие сообщения складываются в `sent` с отметкой времени;
+    `expect(chat_id)` — дождаться следующего сообщения в конкретный чат.
+    Правки одного сообщения чаще раза в `min_edit_interval` секунд получают 429
+    с retry_after, как у Telegram; правка тем же текстом — 400 «message is not modified».
+    `send_rate`/`chat_rate` — лимиты sendMessage на бота (запас — секунда) и на чат
+    (запас — 3 сообщения подряд), сверх них тоже 429; чаты из `blocked` отвечают 403, как заблокировавший бота.
+    """
+
+    def __init__(self, latency: float = 0.0, min_edit_interval: float = 0.0,
+                 send_rate: float = 0.0, chat_rate: float = 0.0, blocked: Iterable[int] = ()):
+        super().__init__()
+        self.latency = latency
+        self.min_edit_interval = min_edit_interval
+        self.send_rate = send_rate
+        self.chat_rate = chat_rate
+        self.blocked = set(blocked)
+        self.rejected: Dict[str, int] = {"too_many_requests": 0, "not_modified": 0, "blocked": 0}
+        self._buckets: Dict[Any, Any] = {}
+        self._edited: Dict[Any, float] = {}
+        self._texts: Dict[Any, str] = {}
+        self.sent: List[Dict[str, Any]] = []
+        self.calls: Dict[str, int] = {}
+        self._message_id = 0
+        self._updates: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self._sent_changed = asyncio.Condition()
+        self._expect: Dict[int, List[asyncio.Future]] = {}
+        self.app.router.add_route("*", "/bot{token}/{method}", self._dispatch)
+
+    async def _dispatch(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params: Dict[str, Any] = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == "application/json":
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+        handler = getattr(self, f"_m_{method.lower()}", None)
+        if handler is None:
+            return web.json_response({"ok": True, "result": True})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        try:
+            return web.json_response({"ok": True, "result": await handler(params)})
+        except FakeAPIError as e:
+            return web.json_response({"ok": False, "error_code": e.code, "description": e.description,
+                                      **({"parameters": {"retry_after": e.retry_after}} if e.retry_after else {})},
+                                     status=e.code)
+
+    async def _m_getme(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+    def _take(self, key: Any, rate: float, burst: float) -> bool:
+        if rate <= 0:
+            return True
+        now = time.monotonic()
+        tokens, last = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        self._buckets[key] = (tokens - 1, now) if tokens >= 1 else (tokens, now)
+        return tokens >= 1
+
+    async def _m_sendmessage(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = int(params.get("chat_id") or 0)
+        if chat_id in self.blocked:
+            self.rejected["blocked"] += 1
+            raise FakeAPIError(403, "Forbidden: bot was blocked by the user")
+        if not (self._take(("chat", chat_id), self.chat_rate, 3.0) and self._take(None, self.send_rate, max(1.0, self.send_rate))):
+            self.rejected["too_many_requests"] += 1
+            raise FakeAPIError(429, "Too Many Requests: retry after 1", retry_after=1)
+        self._message_id += 1
+        self._texts[(params.get("chat_id"), self._message_id)] = params.get("text")
+        return await self._record("sendMessage", params, self._message_id)
+
+    async def _m_editmessagetext(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        key = (params.get("chat_id"), int(params.get("message_id") or 0))
+        now = time.monotonic()
+        if self.min_edit_interval and now - self._edited.get(key, -1e9) < self.min_edit_interval:
+            self.rejected["too_many_requests"] += 1
+            raise FakeAPIError(429, "Too Many Requests: retry after 1", retry_after=1)
+        if self._texts.get(key) == params.get("text"):
+            self.rejected["not_modified"] += 1
+            raise FakeAPIError(400, "Bad Request: message is not modified")
+        self._edited[key] = now
+        self._texts[key] = params.get("text")
+        return await self._record("editMessageText", params, key[1])
+
+    async def _m_getupdates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        timeout = float(params.get("timeout") or 0)
+        out = []
+        try:
+            out.append(await asyncio.wait_for(self._updates.get(), timeout) if timeout else self._updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        limit = int(params.get("limit") or 100)
+        while len(out) < limit and not self._updates.empty():
+            out.append(self._updates.get_nowait())
+        return out
+
+    async def _record(self, method: str, params: Dict[str, Any], message_id: int) -> Dict[str, Any]:
+        chat_id = int(params.get("chat_id") or 0)
+        text = params.get("text") or ""
+        async with self._sent_changed:
+            record = {"method": method, "chat_id": chat_id, "text": text,
+                      "message_id": message_id, "at": time.perf_counter()}
+            self.sent.append(record)
+            self._sent_changed.notify_all()
+        if method == "sendMessage":
+            for fut in self._expect.pop(chat_id, ()):
+                if not fut.done():
+                    fut.set_result(record)
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": text}
+
+    def expect(self, chat_id: int) -> "asyncio.Future[Dict[str, Any]]":
+        """Future следующего sendMessage в чат (запись из `sent`); взять до отправки апдейта."""
+        fut = asyncio.get_running_loop().create_future()
+        self._expect.setdefault(chat_id, []).append(fut)
+        return fut
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        self._updates.put_nowait(update)
+
+    async def wait_messages(self, n: int, timeout: float = 30.0) -> bool:
+        async with self._sent_changed:
+            try:
+                await asyncio.wait_for(self._sent_changed.wait_for(lambda: len(self.sent) >= n), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+
+def text_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    """Минимальный апдейт Telegram с текстовым сообщением от студента."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Student"},
+            "text": text,
+        },
+    }
+
+
+def callback_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> Dict[str, Any]:
+    """Нажатие inline-кнопки `data` под сообщением бота `message_id`."""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "Student"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Fake"},
+                "text": "",
+            },
+        },
+    }
+
+
+async def _serve(server: FakeServer, port: int) -> None:
+    url = await server.start(port=port)
+    print(f"{type(server).__name__} listening on {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Локальные заглушки внешних API")
+    sub = parser.add_subparsers(dest="kind", required=True)
+    p_oa = sub.add_parser("openai", help="Responses API (OPENAI_BASE_URL=http://127.0.0.1:<port>/v1)")
+    p_oa.add_argument("--port", type=int, default=8090)
+    p_oa.add_argument("--latency", type=float, default=0.0)
+    p_oa.add_argument("--fail-rate", type=float, default=0.0)
+    p_tg = sub.add_parser("telegram", help="Bot API (TELEGRAM_API_URL=http://127.0.0.1:<port>)")
+    p_tg.add_argument("--port", type=int, default=8081)
+    p_tg.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.kind == "openai":
+        srv = FakeResponsesAPI(latency=args.latency, fail_rate=args.fail_rate)
+    else:
+        srv = FakeBotAPI(latency=args.latency)
+    try:
+        asyncio.run(_serve(srv, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import asyncio
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple, Callable, Awaitable
+
+from knowledge import KnowledgeIndex, DEFAULT_SCORER, normalize_query
+from entries import Entry, load_entries
+from retrieval import SparseIndex
+from content import SectionTable, render_faq, render_exam
+from exam_session import ExamDeck
+from match_intent import IntentMatcher
+
+Signature = Dict[str, Optional[Tuple[int, int]]]  # путь -> (mtime_ns, size) или None
+Match = Tuple[Optional[int], float]  # (позиция записи, балл) как у KnowledgeIndex.match
+ARTIFACT_FORMAT = 4  # менять при правке формата заголовка/тела артефакта
+# модули, из объектов и функций которых собран артефакт (индексы, нормализация, готовые ответы,
+# интенты): их исходники входят в ключ — правка кода пересобирает базу и без смены ARTIFACT_FORMAT
+ARTIFACT_MODULES = ("kb", "knowledge", "phrases", "retrieval", "content", "entries", "exam_session", "match_intent")
+
+def load_json_list(path: str, label: str) -> List[Entry]:
+    try:
+        logging.info(f"Loading {label} from: {path} (exists={os.path.exists(path)})")
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, list):
+            logging.warning(f"{label} is not a list -> empty.")
+            return []
+        entries = load_entries(data, label, strict=False)  # плохие записи пропускаются, остальные работают
+        logging.info(f"{label} loaded: {len(entries)} entries")
+        return entries
+    except Exception as e:
+        logging.exception(f"Failed to load {label}: %s", e)
+        return []
+
+def read_json_list(path: str, label: str) -> List[Entry]:
+    """Строгая загрузка для перезагрузки на лету: любая проблема — ValueError."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"{label}: {e}") from e
+    validate_entries(data, label)
+    return load_entries(data, label)
+
+def validate_entries(data: Any, label: str) -> None:
+    """Форма файла; записи проверяет load_entries в том же проходе, что и переводит в Entry."""
+    if not isinstance(data, list):
+        raise ValueError(f"{label}: expected a list, got {type(data).__name__}")
+    if not data:
+        raise ValueError(f"{label}: empty list")
+
+def file_signature(*paths: str) -> Signature:
+    out: Signature = {}
+    for p in paths:
+        try:
+            st = os.stat(p)
+            out[p] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            out[p] = None
+    return out
+
+class KnowledgeBase:
+    """Снимок базы знаний одной версии: данные, индексы и готовые ответы. После сборки не меняется."""
+
+    def __init__(self, faq: List[Entry], exam: List[Entry], scorer: str = DEFAULT_SCORER,
+                 version: int = 1, signature: Optional[Signature] = None):
+        self.version = version
+        self.signature = signature or {}
+        self.faq = faq
+        self.exam = exam
+        self.faq_index = KnowledgeIndex(faq, scorer=scorer)
+        self.exam_index = KnowledgeIndex(exam, scorer=scorer)
+        # второй этап: BM25 по полным текстам, когда keywords не сработали
+        self.faq_search = SparseIndex(faq)
+        self.exam_search = SparseIndex(exam)
+        # разделы и готовые ответы: кнопки и найденные записи отдаются без поиска и сборки строк
+        self.sections = SectionTable(faq)
+        self.faq_replies = render_faq(faq, self.sections)
+        self.exam_replies = render_exam(exam)
+        # карточки экзамен-режима по разделам и keywords: следующая/случайная — без поиска
+        self.deck = ExamDeck(exam)
+
+# ---------- Compiled artifact ----------
+def source_digests(*paths: str) -> List[Optional[str]]:
+    """sha1 содержимого файлов: mtime после COPY в образ другой, содержимое — то же."""
+    out: List[Optional[str]] = []
+    for p in paths:
+        try:
+            with open(p, "rb") as f:
+                out.append(hashlib.sha1(f.read()).hexdigest())
+        except OSError:
+            out.append(None)
+    return out
+
+def code_digest() -> str:
+    """sha1 исходников ARTIFACT_MODULES: `DISCLAIMER`, `normalize_query`/ALIASES, BM25, рендер ответов."""
+    base = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha1()
+    for name in ARTIFACT_MODULES:
+        with open(os.path.join(base, name + ".py"), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def compile_artifact(out_path: str, faq_path: str, exam_path: str, intents_path: str,
+                     scorer: str = DEFAULT_SCORER) -> Dict[str, Any]:
+    """
+    Собрать базу (индексы, готовые ответы, интенты) и сохранить одним pickle-файлом.
+    Файл из двух pickle подряд: короткий заголовок (формат, скорер, хэши исходников и кода)
+    и сама сборка — устаревший артефакт отбрасывается без чтения тела.
+    """
+    digests = source_digests(faq_path, exam_path, intents_path)
+    kb = KnowledgeBase(read_json_list(faq_path, "FAQ"), read_json_list(exam_path, "EXAM"), scorer=scorer)
+    intents = IntentMatcher(intents_path) if os.path.exists(intents_path) else None
+    header = {"format": ARTIFACT_FORMAT, "scorer": scorer, "sources": digests, "code": code_digest(),
+              "built_at": time.time()}
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump({"kb": kb, "intents": intents}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, out_path)
+    return header
+
+def load_artifact(path: str, faq_path: str, exam_path: str, intents_path: str,
+                  scorer: str = DEFAULT_SCORER) -> Optional[Dict[str, Any]]:
+    """{"kb": KnowledgeBase, "intents": IntentMatcher | None} или None, если артефакта нет или он устарел."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            header = pickle.load(f)
+            expected = {"format": ARTIFACT_FORMAT, "scorer": scorer,
+                        "sources": source_digests(faq_path, exam_path, intents_path), "code": code_digest()}
+            stale = [k for k, v in expected.items() if header.get(k) != v]
+            if stale:
+                logging.info(f"Knowledge base artifact {path} is stale ({', '.join(stale)}), building from JSON")
+                return None
+            body = pickle.load(f)
+    except Exception as e:
+        logging.warning(f"Knowledge base artifact {path} unreadable, building from JSON: {e!r}")
+        return None
+    # подпись для слежения за файлами — от текущих файлов, а не от машины, где собирали
+    body["kb"].signature = file_signature(faq_path, exam_path)
+    logging.info(f"Knowledge base loaded from artifact {path}: FAQ {len(body['kb'].faq)}, EXAM {len(body['kb'].exam)}")
+    return body
+
+class KnowledgeStore:
+    """
+    Держит текущий KnowledgeBase и перезагружает faq.json / exam.json на лету.
+
+    Новая версия читается, проверяется и индексируется в пуле потоков, затем
+    подменяется одним присваиванием `current`. Хэндлер берёт `current` один
+    раз в начале и работает с целостным снимком. Если новые файлы битые,
+    остаётся старая версия. `on_reload(kb)` вызывается с новой версией до
+    подмены — например, поднять под неё пул поиска (scoring.MatchPool) вне пути запроса.
+    """
+
+    def __init__(self, faq_path: str, exam_path: str, scorer: str = DEFAULT_SCORER,
+                 initial: Optional[KnowledgeBase] = None):
+        self.faq_path = faq_path
+        self.exam_path = exam_path
+        self.scorer = scorer
+        self.last_error: Optional[str] = None
+        self._failed_signature: Optional[Signature] = None  # не перечитываем тот же битый файл
+        self._lock = asyncio.Lock()
+        self.on_reload: Optional[Callable[[KnowledgeBase], Awaitable[None]]] = None
+
+        if initial is not None:  # уже собранная версия из артефакта
+            self.current = initial
+            return
+        signature = file_signature(faq_path, exam_path)
+        self.current = KnowledgeBase(
+            load_json_list(faq_path, "FAQ"),
+            load_json_list(exam_path, "EXAM"),
+            scorer=scorer,
+            signature=signature,
+        )
+
+    def _build(self, version: int) -> KnowledgeBase:
+        # подпись снимаем до чтения: правка во время сборки вызовет ещё одну перезагрузку
+        signature = file_signature(self.faq_path, self.exam_path)
+        faq = read_json_list(self.faq_path, "FAQ")
+        exam = read_json_list(self.exam_path, "EXAM")
+        return KnowledgeBase(faq, exam, scorer=self.scorer, version=version, signature=signature)
+
+    async def reload(self, force: bool = False) -> bool:
+        """True, если подменили версию. Ошибка разбора — в last_error, текущая версия остаётся."""
+        async with self._lock:
+            signature = file_signature(self.faq_path, self.exam_path)
+            if not force and signature in (self.current.signature, self._failed_signature):
+                return False
+            loop = asyncio.get_running_loop()
+            try:
+                kb = await loop.run_in_executor(None, self._build, self.current.version + 1)
+            except Exception as e:
+                self.last_error = str(e)
+                self._failed_signature = signature
+                logging.warning(f"Knowledge base reload failed, keeping v{self.current.version}: {e}")
+                return False
+            if self.on_reload is not None:
+                try:
+                    await self.on_reload(kb)
+                except Exception as e:
+                    logging.exception("Knowledge base reload hook failed: %s", e)
+            self.current = kb
+            self.last_error = None
+            logging.info(f"Knowledge base v{kb.version} loaded: FAQ {len(kb.faq)}, EXAM {len(kb.exam)}")
+            return True
+
+    async def watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logging.exception("Knowledge base watcher error: %s", e)
+
+class MatchCache:
+    """
+    LRU готовых результатов поиска: (набор, нормализованный запрос, версия базы) -> (позиция, балл).
+
+    Частые запросы («жалоба», «тайна», кнопочные фразы) не доходят до fuzzy-поиска.
+    Версия базы в ключе: после перезагрузки старые результаты просто перестают
+    находиться и вытесняются как давно не нужные.
+    """
+
+    def __init__(self, max_items: int = 4096):
+        self.max_items = max_items
+        self._items: "OrderedDict[Tuple[str, str, int], Match]" = OrderedDict()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @staticmethod
+    def key(dataset: str, user_text: str, version: int) -> Tuple[str, str, int]:
+        return dataset, normalize_query(user_text), version
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    def get(self, key: Tuple[str, str, int]) -> Optional[Match]:
+        res = self._items.get(key)
+        if res is None:
+            self.stats["misses"] += 1
+            return None
+        self._items.move_to_end(key)
+        self.stats["hits"] += 1
+        return res
+
+    def put(self, key: Tuple[str, str, int], res: Match) -> None:
+        if self.max_items <= 0:
+            return
+        self._items[key] = res
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+            self.stats["evictions"] += 1
+
+if __name__ == "__main__":
+    import argparse
+
+    base = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Собрать артефакт базы знаний (kb.bin) из faq.json/exam.json/intents.json")
+    parser.add_argument("--faq", default=os.path.join(base, "faq.json"))
+    parser.add_argument("--exam", default=os.path.join(base, "exam.json"))
+    parser.add_argument("--intents", default=os.path.join(base, "intents.json"))
+    parser.add_argument("--scorer", default=os.getenv("MATCH_SCORER", DEFAULT_SCORER))
+    parser.add_argument("--out", default=os.path.join(base, "kb.bin"))
+    args = parser.parse_args()
+
+    # через импорт: классы в pickle должны называться kb.KnowledgeBase, а не __main__.KnowledgeBase
+    import kb
+
+    t0 = time.perf_counter()
+    kb.compile_artifact(args.out, args.faq, args.exam, args.intents, scorer=args.scorer)
+    print(f"{args.out}: {os.path.getsize(args.out)} bytes, scorer {args.scorer}, {time.perf_counter() - t0:.2f}s")
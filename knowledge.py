@@ -0,0 +1,403 @@
+import re
+import logging
+from difflib import SequenceMatcher
+from typing import Optional, Dict, Any, List, Tuple, Set
+
+from phrases import PhraseAutomaton
+
+# rapidfuzz (пакетный скорер) — опционально, без него работает difflib
+try:
+    import numpy as np
+    from rapidfuzz import fuzz as rf_fuzz, process as rf_process
+except Exception:
+    np = None
+    rf_process = None  # если пакеты не установлены
+
+# ---------- Normalization / fuzzy ----------
+_WORD_RE = re.compile(r"[a-zа-я0-9]+", re.IGNORECASE)
+_PUNCT_RE = re.compile(r"[^0-9a-zа-я\s-]+", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+
+ALIASES = {
+    # твои частые "обрубки/опечатки"
+    "жлба": "жалоба",
+    "жлб": "жалоба",
+    "жба": "жалоба",
+    "жалоб": "жалоба",
+    "хам": "грубость",
+    "хамит": "грубость",
+    "грубит": "грубость",
+    "конфл": "конфликт",
+    "скандал": "конфликт",
+    "диагн": "диагноз",
+    "диаг": "диагноз",
+    "тайна": "врачебная тайна",
+    "согласие": "информированное согласие",
+    "ошибка": "медицинская ошибка",
+    "ответственность": "ответственность медработников",
+}
+
+STOP_WORDS = {"и", "в", "во", "на", "по", "за", "к", "ко", "о", "об", "от", "это", "что", "как", "ли"}
+
+def clean_text(s: str) -> str:
+    s = (s or "").lower().replace("ё", "е").strip()
+    s = _PUNCT_RE.sub(" ", s)
+    s = _SPACE_RE.sub(" ", s).strip()
+    return s
+
+def normalize_query(s: str) -> str:
+    s = clean_text(s)
+    if s in ALIASES:
+        s = ALIASES[s]
+    return s
+
+def tokens(s: str) -> List[str]:
+    s = normalize_query(s)
+    tks = _WORD_RE.findall(s)
+    return [t for t in tks if t and t not in STOP_WORDS]
+
+def sim(a: str, b: str) -> float:
+    return SequenceMatcher(None, a, b).ratio()
+
+def score_entry(entry: Dict[str, Any], user_text: str, keyword_field: str = "keywords") -> float:
+    """
+    Баллы:
+      +3.0 если keyword (фраза) входит в текст
+      +1.6 если похожесть токена >= 0.78
+      +1.1 если обрубок входит (tk in kw or kw in tk) при длине >= 4
+    """
+    text = normalize_query(user_text)
+    tks = tokens(text)
+    kws = entry.get(keyword_field) or []
+    if not isinstance(kws, list):
+        return 0.0
+
+    total = 0.0
+    for kw in kws:
+        if not isinstance(kw, str) or not kw.strip():
+            continue
+        kw_n = normalize_query(kw)
+
+        if kw_n and kw_n in text:
+            total += 3.0
+            continue
+
+        # fuzzy по словам
+        best_local = 0.0
+        for tk in tks:
+            if not tk or not kw_n:
+                continue
+            r = sim(tk, kw_n)
+            if r > best_local:
+                best_local = r
+            # обрубки
+            if len(tk) >= 4 and len(kw_n) >= 4 and (tk in kw_n or kw_n in tk):
+                best_local = max(best_local, 0.80)
+
+        if best_local >= 0.78:
+            total += 1.6
+        elif best_local >= 0.70:
+            total += 0.9
+
+    # маленький бонус, если это "card" (чтобы ответы чаще находились)
+    if entry.get("type") in ("card", "answer"):
+        total += 0.1
+
+    return total
+
+def best_match(entries: List[Dict[str, Any]], user_text: str, keyword_field: str = "keywords") -> Tuple[Optional[Dict[str, Any]], float]:
+    best = None
+    best_score = 0.0
+    for e in entries:
+        sc = score_entry(e, user_text, keyword_field=keyword_field)
+        if sc > best_score:
+            best_score = sc
+            best = e
+    return best, best_score
+
+# ---------- Precompiled index ----------
+NGRAM = 2
+# при блоках длиной 1: 2M / (len(a) + len(b)) <= 2M / (3M - 1), что >= 0.70 лишь при M <= 7
+FUZZY_MAX_NO_GRAM_LEN = 20
+TOKEN_CACHE_SIZE = 4096
+
+# "difflib" — SequenceMatcher, баллы 1:1 с best_match;
+# "rapidfuzz" — вся матрица токены × keywords одним вызовом cdist (Indel ratio)
+SCORERS = ("difflib", "rapidfuzz")
+DEFAULT_SCORER = "difflib"
+
+def _length_ok(la: int, lb: int) -> bool:
+    # ratio <= 2 * min / (la + lb); 20 * min >= 7 * (la + lb) <=> граница 0.70
+    return 20 * min(la, lb) >= 7 * (la + lb)
+
+def ngrams(s: str, n: int = NGRAM) -> Set[str]:
+    return {s[i:i + n] for i in range(len(s) - n + 1)}
+
+class KnowledgeIndex:
+    """
+    Индекс над FAQ/EXAM, строится один раз при загрузке.
+
+    Ключевые слова нормализуются заранее и дедуплицируются по всей базе,
+    так что пара (токен, keyword) считается один раз на сообщение, а не
+    для каждой записи. Кандидатов отбирает инвертированный индекс по
+    токенам и символьным биграммам: обрубок требует общих биграмм.
+    Похожесть >= 0.70 без общей биграммы возможна только при
+    len(tk) + len(kw) <= 20 (каждый совпавший символ — отдельный блок,
+    см. FUZZY_MAX_NO_GRAM_LEN), такие короткие пары добираются по индексу
+    длин. Вхождение фраз (+3.0) ищет автомат Ахо–Корасик за один проход.
+    Баллы и выбор записи совпадают с `best_match` (`python knowledge.py`).
+
+    scorer="rapidfuzz" считает похожесть через rapidfuzz (LCS-ratio). Он
+    не ниже ratio у SequenceMatcher, поэтому изредка засчитывает пары,
+    которые difflib отбрасывает; расхождения показывает
+    `python knowledge.py --scorer rapidfuzz`.
+    """
+
+    def __init__(self, entries: List["Entry"], scorer: str = DEFAULT_SCORER):
+        if scorer not in SCORERS:
+            raise ValueError(f"Unknown scorer: {scorer!r} (expected one of {SCORERS})")
+        if scorer == "rapidfuzz" and rf_process is None:
+            logging.warning("rapidfuzz/numpy not installed -> difflib scorer")
+            scorer = "difflib"
+        self.entries = entries
+        self.scorer = scorer
+
+        self.keywords: List[str] = []             # уникальные нормализованные keywords
+        self.keyword_tokens: List[frozenset] = []
+        self.keyword_entries: List[List[int]] = []  # keyword id -> позиции записей
+        self.entry_keywords: List[Tuple[int, ...]] = []  # позиция -> keyword ids (с повторами, по порядку)
+        self.entry_bonus: List[float] = []
+        self.gram_index: Dict[str, List[int]] = {}  # n-грамма -> keyword ids
+        self.token_index: Dict[str, List[int]] = {}  # токен -> keyword ids
+        self.length_index: Dict[int, List[int]] = {}  # длина -> keyword ids
+        self._token_cache: Dict[str, Dict[int, float]] = {}
+        self.first_bonus_pos: Optional[int] = None  # первая запись с бонусом (счёт без совпадений)
+
+        kw_ids: Dict[str, int] = {}
+        for pos, e in enumerate(entries):
+            ids: List[int] = []
+            bonus = 0.0
+            # keywords записи уже нормализованы и без пустых (entries.load_entries)
+            for kw_n in e.keywords:
+                kid = kw_ids.get(kw_n)
+                if kid is None:
+                    kid = kw_ids[kw_n] = self._add_keyword(kw_n)
+                if pos not in self.keyword_entries[kid][-1:]:
+                    self.keyword_entries[kid].append(pos)
+                ids.append(kid)
+            if e.type in ("card", "answer"):
+                bonus = 0.1
+                if self.first_bonus_pos is None:
+                    self.first_bonus_pos = pos
+            self.entry_keywords.append(tuple(ids))
+            self.entry_bonus.append(bonus)
+
+        # +3.0 за вхождение фразы: все keywords за один проход по тексту
+        self.phrases = PhraseAutomaton((kw_n, kid) for kid, kw_n in enumerate(self.keywords))
+
+    def _add_keyword(self, kw_n: str) -> int:
+        kid = len(self.keywords)
+        self.keywords.append(kw_n)
+        toks = frozenset(_WORD_RE.findall(kw_n))
+        self.keyword_tokens.append(toks)
+        self.keyword_entries.append([])
+        for tk in toks:
+            self.token_index.setdefault(tk, []).append(kid)
+        self.length_index.setdefault(len(kw_n), []).append(kid)
+        for g in ngrams(kw_n):
+            self.gram_index.setdefault(g, []).append(kid)
+        return kid
+
+    def _candidates(self, s: str) -> Set[int]:
+        out: Set[int] = set(self.token_index.get(s, ()))
+        for g in ngrams(s):
+            out.update(self.gram_index.get(g, ()))
+        return out
+
+    def _difflib_sims(self, tk: str) -> Dict[int, float]:
+        la = len(tk)
+        cand = self._candidates(tk)
+        for lb in range(1, FUZZY_MAX_NO_GRAM_LEN - la + 1):
+            if _length_ok(la, lb):
+                cand.update(self.length_index.get(lb, ()))
+
+        out: Dict[int, float] = {}
+        for kid in cand:
+            kw_n = self.keywords[kid]
+            r = sim(tk, kw_n)
+            if la >= 4 and len(kw_n) >= 4 and (tk in kw_n or kw_n in tk):
+                r = max(r, 0.80)
+            if r >= 0.70:
+                out[kid] = r
+        return out
+
+    def _rapidfuzz_sims(self, tks: List[str]) -> Dict[str, Dict[int, float]]:
+        if not self.keywords:
+            return {tk: {} for tk in tks}
+        # всё, что ниже 70, cdist сразу обнуляет
+        matrix = rf_process.cdist(tks, self.keywords, scorer=rf_fuzz.ratio, score_cutoff=70)
+
+        result: Dict[str, Dict[int, float]] = {}
+        for i, tk in enumerate(tks):
+            row = matrix[i]
+            out = {int(kid): float(row[kid]) / 100 for kid in np.flatnonzero(row)}
+            # обрубки: подстрока длиной >= 4 всегда делит биграммы с keyword
+            if len(tk) >= 4:
+                for kid in self._candidates(tk):
+                    kw_n = self.keywords[kid]
+                    if len(kw_n) >= 4 and (tk in kw_n or kw_n in tk) and out.get(kid, 0.0) < 0.80:
+                        out[kid] = 0.80
+            result[tk] = out
+        return result
+
+    def token_sims(self, tks: List[str]) -> Dict[str, Dict[int, float]]:
+        """токен -> {keyword id: похожесть с учётом обрубков}, только значения >= 0.70."""
+        result: Dict[str, Dict[int, float]] = {}
+        missing: List[str] = []
+        for tk in set(tks):
+            cached = self._token_cache.get(tk)
+            if cached is None:
+                missing.append(tk)
+            else:
+                result[tk] = cached
+        if not missing:
+            return result
+
+        if self.scorer == "rapidfuzz":
+            computed = self._rapidfuzz_sims(missing)
+        else:
+            computed = {tk: self._difflib_sims(tk) for tk in missing}
+
+        if len(self._token_cache) + len(computed) > TOKEN_CACHE_SIZE:
+            self._token_cache.clear()
+        self._token_cache.update(computed)
+        result.update(computed)
+        return result
+
+    def keyword_scores(self, text: str, tks: List[str]) -> Dict[int, float]:
+        """keyword id -> вклад в балл (3.0 / 1.6 / 0.9) для уже нормализованного текста."""
+        scores: Dict[int, float] = {}
+
+        for kid in self.phrases.find(text):
+            scores[kid] = 3.0
+
+        # fuzzy — только для keywords без точного вхождения
+        best_local: Dict[int, float] = {}
+        for sims in self.token_sims(tks).values():
+            for kid, r in sims.items():
+                if kid not in scores and r > best_local.get(kid, 0.0):
+                    best_local[kid] = r
+
+        for kid, r in best_local.items():
+            if r >= 0.78:
+                scores[kid] = 1.6
+            elif r >= 0.70:
+                scores[kid] = 0.9
+        return scores
+
+    def phrase_hits(self, user_text: str) -> Dict[str, List["Entry"]]:
+        """Фразы, найденные в тексте дословно, и записи, которым они принадлежат."""
+        text = normalize_query(user_text)
+        return {
+            self.keywords[kid]: [self.entries[pos] for pos in self.keyword_entries[kid]]
+            for kid in sorted(self.phrases.find(text))
+        }
+
+    def score(self, pos: int, kw_scores: Dict[int, float]) -> float:
+        total = 0.0
+        for kid in self.entry_keywords[pos]:
+            sc = kw_scores.get(kid)
+            if sc:
+                total += sc
+        return total + self.entry_bonus[pos]
+
+    def match(self, user_text: str) -> Tuple[Optional[int], float]:
+        """(позиция лучшей записи или None, балл) — как best_match, но без самой записи."""
+        text = normalize_query(user_text)
+        kw_scores = self.keyword_scores(text, tokens(text))
+
+        positions: Set[int] = set()
+        for kid in kw_scores:
+            positions.update(self.keyword_entries[kid])
+        # записи без совпадений дают только бонус, из них важна лишь первая
+        if self.first_bonus_pos is not None:
+            positions.add(self.first_bonus_pos)
+
+        best_pos = None
+        best_score = 0.0
+        for pos in sorted(positions):
+            sc = self.score(pos, kw_scores)
+            if sc > best_score:
+                best_score = sc
+                best_pos = pos
+        return best_pos, best_score
+
+    def best_match(self, user_text: str) -> Tuple[Optional["Entry"], float]:
+        pos, score = self.match(user_text)
+        return (self.entries[pos] if pos is not None else None), score
+
+# ---------- Parity check ----------
+def parity_queries(entries: List[Dict[str, Any]], keyword_field: str = "keywords") -> List[str]:
+    """Набор запросов для сверки: keywords, их обрубки и опечатки, ALIASES, фразы."""
+    out: List[str] = list(ALIASES) + ["", "привет", "что делать если врач хамит", "?!"]
+    for e in entries:
+        kws = e.get(keyword_field) if isinstance(e, dict) else None
+        if not isinstance(kws, list):
+            continue
+        for kw in kws:
+            if not isinstance(kw, str):
+                continue
+            out.append(kw)
+            if len(kw) > 3:
+                out.append(kw[:-2])                    # обрубок
+                out.append(kw[1:])                     # потерянная первая буква
+                out.append(kw[:2] + kw[3:])            # пропуск буквы
+                out.append(kw[:1] + kw[2] + kw[1] + kw[3:])  # перестановка
+            out.append(f"как быть если {kw} в поликлинике")
+        q = e.get("question")
+        if isinstance(q, str):
+            out.append(q)
+    return out
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import os
+    import sys
+
+    parser = argparse.ArgumentParser(description="Сверка KnowledgeIndex с эталонным best_match на faq.json/exam.json")
+    parser.add_argument("--scorer", choices=SCORERS, default=DEFAULT_SCORER)
+    args = parser.parse_args()
+
+    from entries import load_entries
+
+    base = os.path.dirname(os.path.abspath(__file__))
+    failed = 0
+    # пороги из handle_text: FAQ >= 0.8, EXAM >= 1.0
+    for fname, threshold in (("faq.json", 0.8), ("exam.json", 1.0)):
+        with open(os.path.join(base, fname), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # эталон — по сырым словарям из JSON, индекс — по загруженным Entry (позиции те же)
+        idx = KnowledgeIndex(load_entries(data, fname), scorer=args.scorer)
+        position = {id(e): pos for pos, e in enumerate(data)}
+        queries = parity_queries(data)
+        exact = same_answer = 0
+        for q in queries:
+            legacy_e, legacy_score = best_match(data, q)
+            legacy = position[id(legacy_e)] if legacy_e is not None else None
+            fast, fast_score = idx.match(q)
+            legacy_out = legacy if legacy_score >= threshold else None
+            fast_out = fast if fast_score >= threshold else None
+            if legacy == fast and legacy_score == fast_score:
+                exact += 1
+            if legacy_out == fast_out:
+                same_answer += 1
+            else:
+                print(f"DIFF {fname}: {q!r}: legacy={legacy_score:.1f} {args.scorer}={fast_score:.1f}")
+        print(f"{fname}: {len(queries)} queries, exact {exact}, same answer {same_answer}")
+        # difflib обязан совпадать полностью, rapidfuzz — по выданному ответу
+        if args.scorer == "difflib":
+            failed += len(queries) - exact
+        else:
+            failed += len(queries) - same_answer
+    sys.exit(1 if failed else 0)
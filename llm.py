@@ -0,0 +1,237 @@
+import time
+import logging
+import asyncio
+import importlib
+import importlib.util
+from typing import Optional, Dict, Any, Callable
+
+from metrics import Histogram
+
+# OpenAI (fallback brain): SDK импортируется при первом вызове — это ~0.6 с холодного старта
+HAS_OPENAI = importlib.util.find_spec("openai") is not None
+
+
+class CircuitBreaker:
+    """
+    После `failure_threshold` ошибок подряд размыкается на `reset_timeout` секунд:
+    вызовы сразу отклоняются. Затем пропускает один пробный вызов (half-open),
+    остальные отклоняются, пока он не завершится: успех замыкает цепь, ошибка
+    размыкает её снова. Иначе все накопившиеся вопросы разом ушли бы в апстрим, который, может быть, ещё лежит.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False  # пробный вызов half-open в полёте
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self._clock() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def ready(self) -> bool:
+        """Пропустит ли `allow` вызов сейчас — без занятия пробы."""
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def allow(self) -> bool:
+        """Можно ли вызывать; в half-open True получает только первый — он и есть проба."""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open" or self.probing:
+            return False
+        self.probing = True
+        return True
+
+    def abandon(self) -> None:
+        """Разрешённый вызов не состоялся (не дождался слота, отменён) — пробу может сделать следующий."""
+        self.probing = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.probing = False
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logging.warning(f"OpenAI circuit opened after {self.failures} failures")
+            self.opened_at = self._clock()
+
+
+class LLMClient:
+    """
+    Один AsyncOpenAI на процесс: общий пул keep-alive соединений SDK, без потоков.
+
+    Семафор ограничивает число одновременных запросов; `timeout_s` — дедлайн
+    на весь вызов, включая ожидание в очереди. Ожидание, не дождавшееся слота,
+    не считается ошибкой апстрима. Ретраи SDK выключены: при сбоях решает
+    CircuitBreaker, и пока он разомкнут, `complete` сразу возвращает None.
+    """
+
+    def __init__(self, api_key: Optional[str], base_url: Optional[str] = None, concurrency: int = 4,
+                 timeout_s: float = 18.0, breaker: Optional[CircuitBreaker] = None):
+        self._api_key = api_key
+        self._base_url = base_url
+        self._enabled = bool(HAS_OPENAI and api_key)
+        self._client = None  # AsyncOpenAI, создаётся при первом вызове или в warm_up
+        self._sem = asyncio.Semaphore(max(1, concurrency))
+        self.timeout_s = timeout_s
+        self.breaker = breaker or CircuitBreaker()
+        self.stats: Dict[str, int] = {"calls": 0, "ok": 0, "errors": 0, "rejected": 0, "shed": 0}
+        self.latency = Histogram()  # сек на сам вызов апстрима, без ожидания слота; и успехи, и ошибки
+        self.first_token = Histogram()  # сек от вызова до первого куска текста (только потоковые вызовы)
+
+    @property
+    def available(self) -> bool:
+        return self._enabled
+
+    def _get_client(self):
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(api_key=self._api_key, base_url=self._base_url,
+                                       timeout=self.timeout_s, max_retries=0)
+        return self._client
+
+    async def warm_up(self) -> None:
+        """Импортировать SDK в потоке после старта, чтобы первый вопрос не ждал импорта."""
+        if self._enabled and self._client is None:
+            await asyncio.get_running_loop().run_in_executor(None, importlib.import_module, "openai")
+            self._get_client()
+
+    async def complete(self, system: str, user_text: str, model: str, timeout_s: Optional[float] = None,
+                       on_delta: Optional[Callable[[str], None]] = None, **kwargs: Any) -> Optional[str]:
+        """
+        Текст ответа ("" если модель ничего не вернула) или None, если вызов не состоялся/упал.
+        С `on_delta` ответ запрашивается потоком, и каждый кусок текста сразу
+        передаётся в `on_delta` (синхронно, без await — поток не ждёт получателя).
+        """
+        if not self._enabled:
+            return None
+        if not self.breaker.allow():
+            self.stats["rejected"] += 1
+            return None
+
+        loop = asyncio.get_running_loop()
+        deadline = timeout_s or self.timeout_s
+        started = loop.time()
+        try:
+            await asyncio.wait_for(self._sem.acquire(), deadline)
+        except asyncio.TimeoutError:
+            self.breaker.abandon()
+            self.stats["shed"] += 1
+            logging.warning("OpenAI fallback skipped: all slots busy")
+            return None
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+
+        self.stats["calls"] += 1
+        called = loop.time()
+        request = dict(
+            model=model,
+            input=[
+                {"role": "system", "content": system},
+                {"role": "user", "content": user_text},
+            ],
+            **kwargs,
+        )
+        try:
+            text = await asyncio.wait_for(
+                self._request(request) if on_delta is None else self._stream(request, on_delta, called),
+                max(0.0, deadline - (loop.time() - started)),
+            )
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+        except Exception as e:
+            self.latency.observe(loop.time() - called)
+            self.stats["errors"] += 1
+            self.breaker.record_failure()
+            logging.warning(f"OpenAI fallback failed: {e!r}")
+            return None
+        finally:
+            self._sem.release()
+
+        self.latency.observe(loop.time() - called)
+        self.stats["ok"] += 1
+        self.breaker.record_success()
+        return text.strip()
+
+    async def _request(self, request: Dict[str, Any]) -> str:
+        resp = await self._get_client().responses.create(**request)
+        return getattr(resp, "output_text", "") or ""
+
+    async def _stream(self, request: Dict[str, Any], on_delta: Callable[[str], None], called: float) -> str:
+        parts = []
+        stream = await self._get_client().responses.create(stream=True, **request)
+        try:
+            async for event in stream:
+                if event.type == "response.output_text.delta" and event.delta:
+                    if not parts:
+                        self.first_token.observe(asyncio.get_running_loop().time() - called)
+                    parts.append(event.delta)
+                    on_delta(event.delta)
+                elif event.type in ("response.failed", "error"):
+                    raise RuntimeError(f"stream {event.type}")
+        finally:
+            await stream.close()
+        return "".join(parts)
+
+    async def close(self) -> None:
+        if self._client:
+            await self._client.close()
+
+if __name__ == "__main__":
+    import sys
+
+    # CircuitBreaker на ручных часах: размыкание, одна проба в half-open, замыкание и повторное размыкание
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30.0, clock=lambda: now[0])
+    failed = []
+    checks = 0
+
+    def check(name: str, ok: bool) -> None:
+        global checks
+        checks += 1
+        if not ok:
+            failed.append(name)
+            print(f"FAIL {name}: state {breaker.state}, probing {breaker.probing}, failures {breaker.failures}")
+
+    for _ in range(2):
+        breaker.record_failure()
+    check("closed below threshold", breaker.state == "closed" and breaker.allow())
+    breaker.record_failure()
+    check("opens at threshold", breaker.state == "open" and not breaker.allow() and not breaker.ready())
+    now[0] = 29.9
+    check("open until reset_timeout", not breaker.allow())
+    now[0] = 30.0
+    check("half_open ready", breaker.state == "half_open" and breaker.ready())
+    check("one probe", [breaker.allow() for _ in range(5)] == [True, False, False, False, False])
+    check("not ready while probing", not breaker.ready())
+    breaker.record_success()
+    check("probe success closes", breaker.state == "closed" and breaker.allow() and breaker.failures == 0)
+
+    for _ in range(3):
+        breaker.record_failure()
+    now[0] = 60.0
+    check("probe after second opening", breaker.allow() and not breaker.allow())
+    breaker.record_failure()
+    check("probe failure reopens", breaker.state == "open" and not breaker.allow())
+    now[0] = 90.0
+    check("next probe after reset_timeout", breaker.allow() and not breaker.allow())
+    breaker.abandon()
+    check("abandoned probe frees the slot", breaker.allow() and not breaker.allow())
+
+    print(f"CircuitBreaker: {checks - len(failed)}/{checks} checks")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,439 @@
+"""
+Нагрузочный прогон бота против локальных заглушек Telegram Bot API и OpenAI.
+
+    python loadtest.py --updates 500 --concurrency 50
+    python loadtest.py --openai-latency 1.5 --updates 200
+    python loadtest.py --broadcast 3000 --updates 100
+    python loadtest.py --students 10,50,200 --transport polling --think 0.5
+
+Поднимает FakeBotAPI и FakeResponsesAPI (fakes.py), импортирует bot.py с
+TELEGRAM_API_URL/OPENAI_BASE_URL на них, запускает webhook-приложение на
+случайном порту и шлёт в него апдейты. Задержка апдейта — от POST до ответа
+вебхука (хэндлер уже отправил sendMessage). Результат — JSON в stdout.
+
+С `--broadcast N` в базе состояний N студентов, заглушка Telegram держит
+лимиты (`--send-rate` на бота, 1/с на чат, часть чатов заблокировала бота),
+админ запускает /broadcast, а апдейты идут параллельно с рассылкой:
+доставка в сообщениях/с, число 429 и задержка обычных ответов под рассылкой.
+Апдейты тогда идут ровным темпом `--update-rate`; p95 их ответов выше
+`--slo-ms` — прогон не пройден (код выхода 1).
+
+С `--students 10,50,200` — сценарии студентов вместо случайных апдейтов:
+каждый студент проходит свой сценарий (кнопки разделов, экзамен-режим с inline-кнопками карточек,
+вопросы с опечатками, вопросы мимо базы -> OpenAI), дожидаясь ответа на
+каждое сообщение и выдерживая паузу `--think`. Для каждого числа студентов —
+ответов в секунду, задержка ответа (от апдейта до первого sendMessage в чат)
+и лаг event loop. Транспорт — webhook или polling (getUpdates у заглушки);
+заглушки работают в том же процессе и loop, что и бот.
+
+Прогон не пройден (код выхода 1, причины — в `failures` и строками FAIL в stderr),
+если ответов меньше или больше, чем апдейтов (в сценариях — ответ не пришёл
+за `--reply-timeout`), вебхук ответил не 200, заглушки вернули ошибку сверх
+ожидаемых (429, 400, 403 не от заблокировавших бота, 5xx OpenAI) или до event
+loop дошло исключение задачи.
+"""
+import os
+import sys
+import json
+import gc
+import time
+import random
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+import importlib
+from typing import Dict, Any, List, Tuple
+
+import aiohttp
+from aiohttp import web
+
+from bench import percentile
+from fakes import FakeBotAPI, FakeResponsesAPI, text_update, callback_update
+
+FAKE_TOKEN = "123456:LOADTESTLOADTESTLOADTESTLOADTEST"
+ADMIN_ID = 1
+
+# типовой поток сообщений: кнопки, приветствия, ключевые слова с опечатками, вопросы мимо базы
+MESSAGES = [
+    "⚖️ Медицинские ошибки", "🏥 Жалобы пациента", "🔒 Врачебная тайна",
+    "привет", "жалоба", "жлба", "врач хамит", "информированое согласие", "тайна",
+    "ответственность", "как зафиксировать медицинскую ошибку",
+    "подскажите расписание автобусов", "где купить билеты в кино", "какая погода завтра в алматы",
+]
+
+
+# сценарии студентов: (название, вес, сообщения по порядку); "exam:..." — нажатие inline-кнопки
+SESSIONS = [
+    ("buttons", 3, ["/start", "⚖️ Медицинские ошибки", "🏥 Жалобы пациента", "🔒 Врачебная тайна", "📄 Нормативная база"]),
+    ("exam", 2, ["🧪 Мини-тесты", "ответственность", "ответственность", "exam:next", "exam:random",
+                 "врачебная тайна", "exam:sections", "exam:s0", "выход"]),
+    ("typos", 3, ["привет", "жлба", "информированое согласие", "врачебня тайна", "отвественость врача"]),
+    ("unmatched", 1, ["подскажите расписание автобусов", "где купить билеты в кино", "какая погода завтра в алматы"]),
+]
+
+
+def load_bot(api_url: str, openai_url: str, **env: str):
+    os.environ.update({
+        "TELEGRAM_TOKEN": FAKE_TOKEN,
+        "TELEGRAM_API_URL": api_url,
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": openai_url,
+        "ANSWER_CACHE_PATH": "",
+        "USER_STATE_PATH": "",
+        "REQUEST_LOG_PATH": "",
+        # меряем пропускную способность, а не флуд-контроль
+        "FLOOD_USER_RATE": "0",
+        "FLOOD_GLOBAL_RATE": "0",
+        "LLM_USER_PER_MIN": "0",
+        "LLM_GLOBAL_PER_MIN": "0",
+        "SEND_RATE": "0",
+        "SEND_CHAT_RATE": "0",
+        "KB_RELOAD_INTERVAL": "0",
+        "BOT_MODE": "webhook",
+        # заглушка + правки раз в секунду растягивают хэндлер; включается --stream
+        "LLM_STREAM": "0",
+        **env,
+    })
+    return importlib.import_module("bot")
+
+
+async def post_updates(url: str, updates: List[Dict[str, Any]], concurrency: int,
+                       rate: float = 0.0) -> Tuple[List[float], int]:
+    """
+    Задержки POST в мс и число ответов вебхука не 200 (их задержки не считаются);
+    с `rate` апдейт i уходит не раньше i/rate секунд от начала.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    failed = 0
+    start = time.perf_counter()
+
+    async with aiohttp.ClientSession() as session:
+        async def one(i: int, update: Dict[str, Any]) -> None:
+            if rate > 0:
+                await asyncio.sleep(max(0.0, start + i / rate - time.perf_counter()))
+            async with sem:
+                t0 = time.perf_counter()
+                async with session.post(url, json=update) as resp:
+                    await resp.read()
+                if resp.status != 200:
+                    nonlocal failed
+                    failed += 1
+                    print(f"webhook answered {resp.status} to update {update['update_id']}", file=sys.stderr)
+                    return
+                latencies.append((time.perf_counter() - t0) * 1000)
+
+        await asyncio.gather(*(one(i, u) for i, u in enumerate(updates)))
+    return latencies, failed
+
+
+def watch_loop_errors() -> List[str]:
+    """Исключения, дошедшие до event loop: задача упала, и её никто не дождался, незакрытая сессия и т.п."""
+    errors: List[str] = []
+
+    def handler(loop: asyncio.AbstractEventLoop, context: Dict[str, Any]) -> None:
+        errors.append(context.get("message", "") + (f": {context['exception']!r}" if "exception" in context else ""))
+        loop.default_exception_handler(context)
+
+    asyncio.get_running_loop().set_exception_handler(handler)
+    return errors
+
+
+def check_run(tg: FakeBotAPI, oa: FakeResponsesAPI, loop_errors: List[str], blocked: int = 0) -> List[str]:
+    """Общие критерии прогона: отказы заглушек сверх ожидаемых и исключения в loop."""
+    gc.collect()  # «Task exception was never retrieved» приходит, когда упавшую задачу собирает сборщик мусора
+    failures = [f"loop error: {e}" for e in loop_errors]
+    if tg.rejected["too_many_requests"]:
+        failures.append(f"fake Telegram answered 429 {tg.rejected['too_many_requests']} times")
+    if tg.rejected["not_modified"]:
+        failures.append(f"fake Telegram answered 400 (not modified) {tg.rejected['not_modified']} times")
+    if tg.rejected["blocked"] != blocked:
+        failures.append(f"fake Telegram answered 403 {tg.rejected['blocked']} times, expected {blocked}")
+    if oa.errors:
+        failures.append(f"fake OpenAI answered 5xx {oa.errors} times")
+    return failures
+
+
+async def sample_lag(samples: List[float], interval: float = 0.01) -> None:
+    """Опоздание таймера event loop — чем дольше loop занят, тем дольше ждут все апдейты."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+async def run_students(tg: FakeBotAPI, send, students: int, args: argparse.Namespace,
+                       first_uid: int) -> Dict[str, Any]:
+    """`students` сценариев одновременно; `send(update)` — доставить апдейт боту."""
+    rnd = random.Random(args.seed + students)
+    latencies: Dict[str, List[float]] = {name: [] for name, _, _ in SESSIONS}
+    timeouts = 0
+    update_ids = iter(range(first_uid * 100, first_uid * 100 + 10 ** 7))
+
+    async def student(uid: int) -> None:
+        nonlocal timeouts
+        name, _, steps = rnd.choices(SESSIONS, weights=[w for _, w, _ in SESSIONS])[0]
+        await asyncio.sleep(rnd.uniform(0, args.think))  # не все студенты приходят в одну миллисекунду
+        for text in steps:
+            if name == "unmatched":
+                text = f"{text} {uid}"  # свой вопрос у каждого: мимо кэша ответов
+            reply = tg.expect(uid)
+            t0 = time.perf_counter()
+            update_id = next(update_ids)
+            await send(callback_update(update_id, uid, text) if text.startswith("exam:")
+                       else text_update(update_id, uid, text))
+            try:
+                record = await asyncio.wait_for(reply, args.reply_timeout)
+            except asyncio.TimeoutError:
+                timeouts += 1
+                continue
+            latencies[name].append((record["at"] - t0) * 1000)
+            if args.think:
+                await asyncio.sleep(rnd.uniform(0.5, 1.5) * args.think)
+
+    lag: List[float] = []
+    lag_task = asyncio.create_task(sample_lag(lag))
+    t0 = time.perf_counter()
+    await asyncio.gather(*(student(first_uid + i) for i in range(students)))
+    wall = time.perf_counter() - t0
+    lag_task.cancel()
+
+    every = sorted(x for v in latencies.values() for x in v)
+    lag.sort()
+    return {
+        "students": students,
+        "replies": len(every),
+        "timeouts": timeouts,
+        "wall_s": round(wall, 3),
+        "replies_per_s": round(len(every) / wall, 1),
+        "p50_ms": round(percentile(every, 50), 2),
+        "p95_ms": round(percentile(every, 95), 2),
+        "p99_ms": round(percentile(every, 99), 2),
+        "p95_ms_by_session": {k: round(percentile(sorted(v), 95), 2) for k, v in latencies.items() if v},
+        "loop_lag_p50_ms": round(percentile(lag, 50) * 1000, 2),
+        "loop_lag_p99_ms": round(percentile(lag, 99) * 1000, 2),
+        "loop_lag_max_ms": round(lag[-1] * 1000, 2) if lag else 0.0,
+    }
+
+
+async def run_sweep(args: argparse.Namespace) -> Dict[str, Any]:
+    loop_errors = watch_loop_errors()
+    tg = FakeBotAPI(latency=args.telegram_latency)
+    oa = FakeResponsesAPI(latency=args.openai_latency, chunk_delay=0.02 if args.stream else 0.0)
+    api_url = await tg.start()
+    openai_url = await oa.start()
+    bot_module = load_bot(api_url, openai_url, LLM_STREAM="1" if args.stream else "0", BOT_MODE=args.transport)
+
+    if args.transport == "webhook":
+        runner = web.AppRunner(bot_module.make_webhook_app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}{bot_module.WEBHOOK_PATH}"
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        pending: set = set()
+
+        async def send(update: Dict[str, Any]) -> None:
+            # вебхук отвечает после хэндлера — ждём ответ фоном, задержку меряем по sendMessage
+            async def post() -> None:
+                async with session.post(url, json=update) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        raise RuntimeError(f"webhook answered {resp.status}")
+            task = asyncio.create_task(post())
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    else:
+        # как executor.start_polling: тот же dispatcher, апдейты — из getUpdates заглушки
+        dp = bot_module.dp
+        await bot_module.on_startup(dp)
+        polling = asyncio.create_task(dp.start_polling(timeout=1, reset_webhook=False))
+
+        async def send(update: Dict[str, Any]) -> None:
+            tg.push_update(update)
+
+    # прогрев: ленивые импорты, кэши поиска, соединения — не в замерах первого уровня
+    await run_students(tg, send, 5, args, first_uid=900_000)
+    levels = []
+    for i, students in enumerate(int(x) for x in args.students.split(",")):
+        # новые студенты на каждом уровне: своё состояние, экзамен-режим с нуля
+        levels.append(await run_students(tg, send, students, args, first_uid=(i + 1) * 1_000_000))
+        print(json.dumps(levels[-1], ensure_ascii=False), file=sys.stderr)
+
+    post_errors = 0
+    if args.transport == "webhook":
+        # хэндлеры (и потоковые правки) дорабатывают до конца, пока сессия и сервер ещё живы
+        for res in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(res, BaseException):
+                post_errors += 1
+                print(f"webhook POST failed: {res!r}", file=sys.stderr)
+        await session.close()
+        await runner.cleanup()
+    else:
+        dp.stop_polling()
+        await dp.wait_closed()
+        await polling
+        await bot_module.on_shutdown(dp)
+        # в webhook-режиме сессию бота закрывает приложение, здесь — сами, как executor.start_polling
+        await (await bot_module.bot.get_session()).close()
+    await tg.stop()
+    await oa.stop()
+
+    # сколько студентов держит воркер: последний уровень до первого нарушения SLO
+    within = 0
+    for lv in levels:
+        if lv["p95_ms"] > args.slo_ms or lv["timeouts"]:
+            break
+        within = lv["students"]
+    # SLO — мерило, а не критерий: провал — это ответ, который так и не пришёл, или ошибка
+    failures = check_run(tg, oa, loop_errors)
+    failures += [f"{lv['students']} students: {lv['timeouts']} replies timed out" for lv in levels if lv["timeouts"]]
+    if post_errors:
+        failures.append(f"{post_errors} webhook POSTs failed")
+    return {
+        "mode": args.transport,
+        "openai_latency_s": args.openai_latency,
+        "think_s": args.think,
+        "slo_p95_ms": args.slo_ms,
+        "max_students_within_slo": within,
+        "post_errors": post_errors,
+        "levels": levels,
+        "openai_calls": len(oa.requests),
+        "failures": failures,
+    }
+
+
+def make_user_db(path: str, users: int) -> None:
+    """Студенты 100000…: как после долгой работы бота."""
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, mode TEXT NOT NULL, "
+               "demo_used INTEGER NOT NULL, pro INTEGER NOT NULL)")
+    with db:
+        db.executemany("INSERT OR REPLACE INTO users VALUES (?, '', 0, 0)", ((100000 + i,) for i in range(users)))
+    db.close()
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    loop_errors = watch_loop_errors()
+    env = {"LLM_STREAM": "1" if args.stream else "0"}
+    blocked = range(0)
+    if args.broadcast:
+        # лимиты как у Telegram — и в заглушке, и в очереди бота
+        blocked = range(100000, 100000 + args.broadcast, 20)
+        tg = FakeBotAPI(latency=args.telegram_latency, send_rate=args.send_rate, chat_rate=1.0, blocked=blocked)
+        db_path = os.path.join(tempfile.mkdtemp(), "users.sqlite3")
+        make_user_db(db_path, args.broadcast)
+        env.update(USER_STATE_PATH=db_path, ADMIN_IDS=str(ADMIN_ID), SEND_RATE=str(args.send_rate),
+                   SEND_CHAT_RATE="1", FLOOD_USER_RATE="0")
+    else:
+        tg = FakeBotAPI(latency=args.telegram_latency)
+    oa = FakeResponsesAPI(latency=args.openai_latency, chunk_delay=0.02 if args.stream else 0.0)
+    api_url = await tg.start()
+    openai_url = await oa.start()
+
+    bot_module = load_bot(api_url, openai_url, **env)
+    runner = web.AppRunner(bot_module.make_webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    base = f"http://127.0.0.1:{port}"
+
+    rnd = random.Random(args.seed)
+    updates = [text_update(i + 1, 1000 + rnd.randrange(args.users), rnd.choice(MESSAGES)) for i in range(args.updates)]
+
+    broadcast: Dict[str, Any] = {}
+    if args.broadcast:
+        b0 = time.perf_counter()
+        _, failed = await post_updates(base + bot_module.WEBHOOK_PATH, [text_update(0, ADMIN_ID, "/broadcast Тест рассылки")], 1)
+        if failed:
+            raise RuntimeError("/broadcast was not accepted")
+    t0 = time.perf_counter()
+    # под рассылкой апдейты идут ровным темпом: пачка сама по себе упирается в SEND_RATE, и меряли бы не рассылку
+    latencies, post_errors = await post_updates(base + bot_module.WEBHOOK_PATH, updates, args.concurrency,
+                                                rate=args.update_rate if args.broadcast else 0.0)
+    wall = time.perf_counter() - t0
+    if args.broadcast:
+        # итог рассылки админу — последнее сообщение в его чат
+        while not any(m["chat_id"] == ADMIN_ID and m["text"].startswith("📣 Рассылка завершена") for m in tg.sent):
+            await asyncio.sleep(0.1)
+        took = time.perf_counter() - b0
+        delivered = sum(1 for m in tg.sent if m["text"] == "Тест рассылки")
+        broadcast = {
+            "recipients": args.broadcast,
+            "delivered": delivered,
+            "blocked": tg.rejected["blocked"],
+            "wall_s": round(took, 2),
+            "msgs_per_s": round(delivered / took, 1),
+            "too_many_requests": tg.rejected["too_many_requests"],
+            "queue": dict(bot_module.OUTBOX.stats),
+        }
+    async with aiohttp.ClientSession() as session:
+        async with session.get(base + "/healthz") as resp:
+            health = await resp.json()
+
+    await runner.cleanup()
+    await tg.stop()
+    await oa.stop()
+
+    latencies.sort()
+    # ответ на каждый апдейт: вебхук отвечает после хэндлера, так что все sendMessage уже в tg.sent
+    chats = {u["message"]["chat"]["id"] for u in updates}
+    replies = sum(1 for m in tg.sent if m["method"] == "sendMessage" and m["chat_id"] in chats)
+    failures = check_run(tg, oa, loop_errors, blocked=len(blocked))
+    if post_errors:
+        failures.append(f"webhook answered non-200 to {post_errors} updates")
+    if replies != len(updates):
+        failures.append(f"{replies} replies to {len(updates)} updates")
+    if args.broadcast and percentile(latencies, 95) > args.slo_ms:
+        failures.append(f"reply p95 {percentile(latencies, 95):.0f} ms during broadcast > {args.slo_ms:.0f} ms")
+    return {
+        "mode": "webhook",
+        "updates": len(updates),
+        "concurrency": args.concurrency,
+        "users": args.users,
+        "openai_latency_s": args.openai_latency,
+        "wall_s": round(wall, 3),
+        "updates_per_s": round(len(updates) / wall, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "replies": sum(1 for m in tg.sent if m["method"] == "sendMessage"),
+        "edits": sum(1 for m in tg.sent if m["method"] == "editMessageText"),
+        "openai_calls": len(oa.requests),
+        "health": health,
+        **({"broadcast": broadcast} if broadcast else {}),
+        "failures": failures,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=40, help="одновременных POST (как max_connections вебхука)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--stream", action="store_true", help="ответы модели потоком (заглушка + правки)")
+    parser.add_argument("--broadcast", type=int, default=0, help="студентов в рассылке /broadcast во время прогона")
+    parser.add_argument("--send-rate", type=float, default=30.0, help="лимит sendMessage в секунду для --broadcast")
+    parser.add_argument("--update-rate", type=float, default=10.0, help="апдейтов в секунду во время --broadcast")
+    parser.add_argument("--students", default="", help="числа одновременных студентов через запятую, например 10,50,200")
+    parser.add_argument("--transport", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--think", type=float, default=0.5, help="пауза студента между сообщениями, сек (±50%%)")
+    parser.add_argument("--reply-timeout", type=float, default=30.0)
+    parser.add_argument("--slo-ms", type=float, default=1000.0, help="допустимый p95 задержки ответа (и под --broadcast)")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_sweep(args) if args.students else run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    for failure in report.get("failures", ()):
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if report.get("failures") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
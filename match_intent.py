@@ -1,6 +1,14 @@
 import json
 import re
-from rapidfuzz import fuzz
+import heapq
+from typing import Optional, Dict, Any, List, Tuple
+
+from rapidfuzz import fuzz, process
+
+try:
+    import numpy as np
+except Exception:
+    np = None  # без numpy — process.extract вместо матрицы cdist
 
 def norm(text: str) -> str:
     text = text.lower().strip()
@@ -8,30 +16,78 @@ def norm(text: str) -> str:
     text = re.sub(r"\s+", " ", text)
     return text
 
+def token_set(text: str) -> str:
+    return " ".join(sorted(set(text.split())))
+
 class IntentMatcher:
+    """
+    Интенты из intents.json: фразы (examples + keywords одной строкой) нормализуются
+    один раз при загрузке и лежат плоским списком, сгруппированные по интентам.
+
+    Балл интента, как и раньше, — token_set_ratio лучшей фразы. Для фразы без общих
+    с запросом слов token_set_ratio равен обычному ratio отсортированных наборов слов,
+    поэтому наборы слов фраз готовятся заранее, все фразы считаются одним вызовом
+    cdist(ratio) с `score_cutoff`, и только фразы с общими словами (их находит
+    индекс слово -> фразы) пересчитываются настоящим token_set_ratio. Лучшая фраза
+    интента — максимум по его группе, top-k — без полной сортировки.
+    """
+
     def __init__(self, intents_path: str):
         with open(intents_path, "r", encoding="utf-8") as f:
-            self.intents = json.load(f)
+            self.intents: Dict[str, Dict[str, Any]] = json.load(f)
 
-        self.intent_phrases = {}
+        self.intent_phrases: Dict[str, List[str]] = {}
         for intent, data in self.intents.items():
             phrases = []
             phrases += data.get("examples", [])
             phrases.append(" ".join(data.get("keywords", [])))
             self.intent_phrases[intent] = [norm(p) for p in phrases if p]
 
-    def match(self, user_text: str):
-        t = norm(user_text)
-        scores = []
+        # плоский список: фразы интента i лежат в phrases[starts[i]:starts[i + 1]]
+        self.names: List[str] = [i for i, ps in self.intent_phrases.items() if ps]
+        self.phrases: List[str] = []
+        self.owner: List[int] = []
+        starts = []
+        for pos, intent in enumerate(self.names):
+            starts.append(len(self.phrases))
+            self.phrases += self.intent_phrases[intent]
+            self.owner += [pos] * len(self.intent_phrases[intent])
+        self._starts = np.array(starts, dtype=np.intp) if np is not None else starts
+        self._token_sets = [token_set(p) for p in self.phrases]
+        self._token_index: Dict[str, List[int]] = {}
+        for k, p in enumerate(self.phrases):
+            for tok in set(p.split()):
+                self._token_index.setdefault(tok, []).append(k)
 
-        for intent, phrases in self.intent_phrases.items():
-            best = 0
-            for p in phrases:
-                s = fuzz.token_set_ratio(t, p)
-                best = max(best, s)
-            scores.append((intent, best))
+    def scores(self, user_text: str, score_cutoff: float = 0) -> Dict[int, float]:
+        """Позиция интента в `names` -> балл лучшей фразы; интенты ниже `score_cutoff` не попадают."""
+        t = norm(user_text)
+        if not t or not self.phrases:
+            return {}
+        if np is not None:
+            row = process.cdist([token_set(t)], self._token_sets, scorer=fuzz.ratio, processor=None,
+                                score_cutoff=score_cutoff, dtype=np.float64)[0]
+            shared = sorted({k for tok in set(t.split()) for k in self._token_index.get(tok, ())})
+            if shared:
+                row[shared] = process.cdist([t], [self.phrases[k] for k in shared], scorer=fuzz.token_set_ratio,
+                                            processor=None, score_cutoff=score_cutoff, dtype=np.float64)[0]
+            # ratio и token_set_ratio по-разному нормируют одно и то же и расходятся в последнем бите
+            best = np.round(np.maximum.reduceat(row, self._starts), 6)
+            return {int(i): float(best[i]) for i in np.flatnonzero(best >= score_cutoff)}
+        out: Dict[int, float] = {}
+        for _, s, k in process.extract(t, self.phrases, scorer=fuzz.token_set_ratio, processor=None,
+                                       score_cutoff=score_cutoff, limit=None):
+            pos = self.owner[k]
+            if s > out.get(pos, -1):
+                out[pos] = round(s, 6)
+        return out
 
-        scores.sort(key=lambda x: x[1], reverse=True)
-        best_intent, best_score = scores[0]
-        return best_intent, best_score
+    def top(self, user_text: str, k: int = 3, score_cutoff: float = 0) -> List[Tuple[str, float]]:
+        """k лучших интентов по убыванию балла; при равенстве — в порядке intents.json."""
+        scored = self.scores(user_text, score_cutoff)
+        best = heapq.nsmallest(k, scored.items(), key=lambda x: (-x[1], x[0]))
+        return [(self.names[pos], s) for pos, s in best]
 
+    def match(self, user_text: str, score_cutoff: float = 0) -> Tuple[Optional[str], float]:
+        best = self.top(user_text, 1, score_cutoff)
+        return best[0] if best else (None, 0)
@@ -0,0 +1,181 @@
+import os
+import time
+import bisect
+import asyncio
+import resource
+from typing import Dict, List, Tuple, Callable, Union
+
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler, ctx_data
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# секунды: от быстрых ответов из кэша до вызовов OpenAI
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+# баллы best_match: пороги 0.8 (FAQ) и 1.0 (EXAM) — на границах корзин
+SCORE_BUCKETS = (0.0, 0.4, 0.8, 1.0, 1.6, 2.5, 3.0, 4.0, 6.0, 10.0)
+# нормированный балл BM25 (SparseIndex): порог RETRIEVAL_THRESHOLD 0.18
+RETRIEVAL_BUCKETS = (0.05, 0.1, 0.15, 0.18, 0.2, 0.25, 0.3, 0.4, 0.5, 0.7)
+
+
+class Histogram:
+    """Счётчики по корзинам `le`, как в Prometheus; запись — один bisect."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля: верхняя граница корзины, в которую он попал."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class Metrics:
+    """
+    Реестр метрик процесса: счётчики и гистограммы пишутся на горячем пути
+    (dict + bisect), всё остальное — «снимки» (`collect`), которые читают
+    уже существующие `stats` модулей только в момент выдачи /metrics или /stats.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._collectors: List[Tuple[str, str, Callable[[], Union[float, Dict[Labels, float]]]]] = []
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1.0) -> None:
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0.0) + value
+
+    def set_buckets(self, name: str, buckets: Tuple[float, ...]) -> None:
+        self._buckets[name] = buckets
+
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        series = self.histograms.setdefault(name, {})
+        h = series.get(labels)
+        if h is None:
+            h = series[labels] = Histogram(self._buckets.get(name, LATENCY_BUCKETS))
+        h.observe(value)
+
+    def collect(self, name: str, kind: str, fn: Callable[[], Union[float, Dict[Labels, float]]]) -> None:
+        """`kind` — gauge или counter; `fn` — число или {метки: число}, вызывается при выдаче."""
+        self._collectors.append((name, kind, fn))
+
+    def add_histogram(self, name: str, h: Histogram, labels: Labels = ()) -> None:
+        """Подключить гистограмму, которую ведёт сам модуль (например, LLMClient.latency)."""
+        self.histograms.setdefault(name, {})[labels] = h
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (text/plain; version=0.0.4)."""
+        out: List[str] = []
+        for name, kind, fn in self._collectors:
+            value = fn()
+            out.append(f"# TYPE {name} {kind}")
+            for labels, v in (value.items() if isinstance(value, dict) else [((), value)]):
+                out.append(f"{name}{_labels(labels)} {_num(v)}")
+        for name, series in sorted(self.counters.items()):
+            out.append(f"# TYPE {name} counter")
+            for labels, v in sorted(series.items()):
+                out.append(f"{name}{_labels(labels)} {_num(v)}")
+        for name, series in sorted(self.histograms.items()):
+            out.append(f"# TYPE {name} histogram")
+            for labels, h in sorted(series.items()):
+                cumulative = 0
+                for le, c in zip(h.buckets + (float("inf"),), h.counts):
+                    cumulative += c
+                    out.append(f"{name}_bucket{_labels(labels + (('le', _num(le)),))} {cumulative}")
+                out.append(f"{name}_sum{_labels(labels)} {_num(h.sum)}")
+                out.append(f"{name}_count{_labels(labels)} {h.count}")
+        return "\n".join(out) + "\n"
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels)
+    return "{" + inner + "}"
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+def rss_bytes() -> int:
+    """Текущий resident set; без /proc — пиковый (ru_maxrss, в Linux — килобайты)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class HandlerTimer(BaseMiddleware):
+    """Время хэндлеров сообщений и callback-кнопок — гистограмма `bot_handler_seconds{handler=...}`."""
+
+    def __init__(self, metrics: Metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        data["_timer"] = (current_handler.get().__name__, time.perf_counter())
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        started = data.get("_timer")
+        if started:
+            self.metrics.observe("bot_handler_seconds", time.perf_counter() - started[1], (("handler", started[0]),))
+
+    on_process_callback_query = on_process_message
+    on_post_process_callback_query = on_post_process_message
+
+
+def name_handler(name: str) -> None:
+    """Хэндлер-маршрутизатор: время апдейта записать под именем обработчика, куда он передал сообщение."""
+    data = ctx_data.get(None)
+    started = data.get("_timer") if data else None
+    if started:
+        data["_timer"] = (name, started[1])
+
+
+class LoopLag:
+    """Насколько event loop опаздывает разбудить таймер: показатель того, что его что-то держит."""
+
+    def __init__(self, metrics: Metrics, interval: float = 0.5):
+        self.interval = interval
+        self.last = 0.0
+        self.max = 0.0
+        self.metrics = metrics
+        metrics.set_buckets("bot_event_loop_lag_seconds", (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - started - self.interval)
+            self.max = max(self.max, self.last)
+            self.metrics.observe("bot_event_loop_lag_seconds", self.last)
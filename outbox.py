@@ -0,0 +1,202 @@
+import logging
+import asyncio
+from collections import deque
+from typing import Optional, Dict, Any, List, Tuple, Callable, Awaitable, AsyncIterator, Deque
+
+from aiogram.utils.exceptions import RetryAfter, Unauthorized, BadRequest
+
+from throttling import TokenBuckets
+
+HIGH, LOW = 0, 1  # ответы студентам раньше рассылки
+
+class _Item:
+    __slots__ = ("call", "future", "priority", "attempts")
+
+    def __init__(self, call: Callable[[], Awaitable[Any]], priority: int):
+        self.call = call
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.priority = priority
+        self.attempts = 0
+
+class SendQueue:
+    """
+    Все исходящие сообщения бота — через одну очередь с лимитами Telegram:
+    общее ведро `rate` (~30 сообщений/с на бота, без запаса — ровным темпом,
+    пачка в 30 сообщений разом сама по себе ловит 429) и ведро на чат
+    (`chat_rate`, `chat_burst`: ~1/с с небольшим запасом подряд).
+
+    У каждого чата своя очередь, и в полёте не больше одного его сообщения —
+    порядок внутри чата не меняется. Из чатов, чья очередь подошла, первым
+    идёт тот, у кого меньше (приоритет, время готовности, номер): ответ
+    студенту (HIGH) уходит раньше рассылки (LOW), даже поставленной давно.
+    LOW к тому же берёт не больше `low_share` общего темпа: остаток держит
+    ведро пустым не всегда, и пришедший ответ уходит сразу, а не ждёт токена
+    наравне с рассылкой.
+    Список готовых чатов не длиннее окна рассылки плюс активных студентов,
+    поэтому выбор — линейный проход.
+
+    RetryAfter останавливает всю очередь на `retry_after` секунд и возвращает
+    сообщение в голову его чата; сетевые и прочие временные ошибки повторяются
+    с экспоненциальной паузой, до `max_attempts` попыток. Unauthorized (бот
+    заблокирован) и BadRequest (нет чата, плохой текст) не повторяются —
+    исключение уходит тому, кто ждёт `send`.
+    """
+
+    def __init__(self, rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 max_attempts: int = 5, backoff: float = 1.0, max_chats: int = 10000, low_share: float = 0.8):
+        self.total = TokenBuckets(rate, 1)
+        self.low = TokenBuckets(rate * low_share, 1)
+        self.chats = TokenBuckets(chat_rate, chat_burst, max_keys=max_chats)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._pending: Dict[int, Deque[_Item]] = {}
+        self._busy: set = set()  # чаты, у которых сообщение в полёте
+        self._ready: List[Tuple[int, float, int, int]] = []  # (приоритет, готов с, номер, чат)
+        self._seq = 0
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {"sent": 0, "retry_after": 0, "retries": 0, "failed": 0}
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self._pending.values())
+
+    def backlog(self, priority: int = LOW) -> int:
+        return sum(1 for q in self._pending.values() for item in q if item.priority == priority)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def send(self, chat_id: int, call: Callable[[], Awaitable[Any]], priority: int = HIGH) -> Any:
+        """Выполнить `call()` (например, bot.send_message) в свою очередь; результат или исключение Telegram."""
+        self.start()
+        item = _Item(call, priority)
+        queue = self._pending.setdefault(chat_id, deque())
+        queue.append(item)
+        if len(queue) == 1 and chat_id not in self._busy:
+            self._schedule(chat_id, 0.0)
+        return await item.future
+
+    def _schedule(self, chat_id: int, at: float) -> None:
+        self._seq += 1
+        self._ready.append((self._pending[chat_id][0].priority, at, self._seq, chat_id))
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            # первый готовый чат с наивысшим приоритетом; неготовые — ждут своего времени
+            due = [e for e in self._ready if e[1] <= now]
+            if not due:
+                self._wakeup.clear()
+                timeout = min((e[1] for e in self._ready), default=now + 3600) - now
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            entry = min(due)
+            self._ready.remove(entry)
+            chat_id = entry[3]
+
+            if entry[0] == LOW:
+                # доля рассылки: не успела — в очередь за следующим своим токеном, ответы тем временем идут
+                wait = self.low.take(None)
+                if wait:
+                    self._schedule(chat_id, now + wait)
+                    continue
+            wait = self.chats.take(chat_id)
+            if wait:
+                self._schedule(chat_id, now + wait)
+                continue
+            wait = self.total.take(None)
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.total.take(None)
+
+            item = self._pending[chat_id].popleft()
+            self._busy.add(chat_id)
+            loop.create_task(self._deliver(chat_id, item))
+
+    async def _deliver(self, chat_id: int, item: _Item) -> None:
+        loop = asyncio.get_running_loop()
+        retry_at = None
+        try:
+            item.attempts += 1
+            result = await item.call()
+        except RetryAfter as e:
+            self.stats["retry_after"] += 1
+            logging.warning(f"Telegram flood control: pausing sends for {e.timeout}s")
+            self._paused_until = max(self._paused_until, loop.time() + e.timeout)
+            retry_at = loop.time() + e.timeout
+        except (Unauthorized, BadRequest) as e:
+            self.stats["failed"] += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+        except Exception as e:
+            if item.attempts >= self.max_attempts:
+                self.stats["failed"] += 1
+                logging.warning(f"Send to {chat_id} failed after {item.attempts} attempts: {e!r}")
+                if not item.future.done():
+                    item.future.set_exception(e)
+            else:
+                self.stats["retries"] += 1
+                retry_at = loop.time() + self.backoff * 2 ** (item.attempts - 1)
+        else:
+            self.stats["sent"] += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self._busy.discard(chat_id)
+            queue = self._pending[chat_id]
+            if retry_at is not None:
+                queue.appendleft(item)
+            if queue:
+                self._schedule(chat_id, retry_at or 0.0)
+            else:
+                del self._pending[chat_id]
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Дать уйти уже поставленным сообщениям, потом остановить очередь."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (self._pending or self._busy) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+
+async def broadcast(queue: SendQueue, recipients: AsyncIterator[int],
+                    send: Callable[[int], Callable[[], Awaitable[Any]]], window: int = 200) -> Dict[str, int]:
+    """
+    Рассылка с низким приоритетом: получатели читаются по мере отправки, в очереди
+    одновременно не больше `window` сообщений рассылки — память не зависит от числа студентов.
+    """
+    stats = {"sent": 0, "blocked": 0, "failed": 0}
+    slots = asyncio.Semaphore(window)
+    tasks = set()
+
+    async def one(uid: int) -> None:
+        try:
+            await queue.send(uid, send(uid), priority=LOW)
+            stats["sent"] += 1
+        except Unauthorized:
+            stats["blocked"] += 1
+        except Exception as e:
+            stats["failed"] += 1
+            logging.info(f"Broadcast to {uid} failed: {e!r}")
+        finally:
+            slots.release()
+
+    async for uid in recipients:
+        await slots.acquire()
+        task = asyncio.get_running_loop().create_task(one(uid))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    return stats
@@ -0,0 +1,74 @@
+from collections import deque
+from typing import Dict, List, Iterable, Set, Tuple
+
+
+class PhraseAutomaton:
+    """
+    Aho–Corasick по нормализованным фразам.
+
+    Строится один раз; `find(text)` за один проход по тексту возвращает id
+    всех фраз, которые входят в текст как подстроки (то же, что `kw in text`
+    для каждой фразы), за время O(len(text) + число совпадений).
+    """
+
+    def __init__(self, phrases: Iterable[Tuple[str, int]] = ()):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._own: List[Tuple[int, ...]] = [()]  # фразы, оканчивающиеся в состоянии
+        self._out: List[Tuple[int, ...]] = [()]  # + все фразы по цепочке fail
+        self._built = False
+        for phrase, pid in phrases:
+            self.add(phrase, pid)
+        self.build()
+
+    def add(self, phrase: str, pid: int) -> None:
+        if not phrase:
+            return
+        state = 0
+        for ch in phrase:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._own.append(())
+            state = nxt
+        self._own[state] += (pid,)
+        self._built = False
+
+    def build(self) -> None:
+        # BFS: fail-ссылка ребёнка = переход из fail родителя; выходы наследуются по fail
+        self._out = list(self._own)
+        queue = deque(self._goto[0].values())
+        for s in queue:
+            self._fail[s] = 0
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                if self._out[self._fail[nxt]]:
+                    self._out[nxt] += self._out[self._fail[nxt]]
+                queue.append(nxt)
+        self._built = True
+
+    def find(self, text: str) -> Set[int]:
+        if not self._built:
+            self.build()
+        goto, fail, out = self._goto, self._fail, self._out
+        found: Set[int] = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+    def __len__(self) -> int:
+        return len(self._goto)
@@ -0,0 +1,196 @@
+import re
+import math
+from typing import Dict, List, Tuple
+
+from content import DISCLAIMER
+from entries import Entry
+
+SYSTEM_PROMPT = (
+    "Ты — ассистент кафедры медицинского права Республики Казахстан.\n\n"
+    "Отвечай официально-деловым стилем, нейтрально, кратко и структурировано, "
+    "с учётом законодательства Республики Казахстан:\n"
+    "1) кратко объясни суть ситуации (1–2 предложения);\n"
+    "2) дай общий алгоритм действий по пунктам;\n"
+    "3) при необходимости упомяни нормативные акты, без цитирования статей.\n\n"
+    "Опирайся на материалы кафедры ниже, если они относятся к вопросу. "
+    "Не придумывай номера статей/приказов и точные реквизиты, если их нет в материалах. "
+    "Не давай персональных советов и категоричных выводов. "
+    "Если требуется уточнение — задай 2–3 коротких уточняющих вопроса. "
+    "Дисклеймер не добавляй: бот добавит его сам."
+)
+CONTEXT_HEADER = "\n\nМатериалы кафедры:"
+NO_CONTEXT = "\n\nМатериалов кафедры по этому вопросу нет — отвечай в общих чертах."
+
+# без токенизатора модели: для русского текста у GPT-4o ~3.5–4 символа на токен,
+# 3 — с запасом, чтобы оценка не была ниже настоящего числа токенов
+CHARS_PER_TOKEN = 3
+MIN_SNIPPET_TOKENS = 40  # обрезок короче почти ничего не даёт модели
+
+# последний абзац ответа модели, похожий на наш дисклеймер: модели его часто дописывают сами;
+# абзац длиннее двух DISCLAIMER — уже часть ответа, а не дисклеймер
+_DISCLAIMER_RE = re.compile(r"носит информационный характер|не является официальным юридическим", re.IGNORECASE)
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def trim_to_tokens(text: str, tokens: int) -> str:
+    """Не длиннее `tokens` по оценке estimate_tokens; режет по концу предложения или слова."""
+    limit = max(0, tokens) * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text[:max(0, limit - 1)]
+    end = max(cut.rfind(". "), cut.rfind(".\n"), cut.rfind("; "))
+    if end >= limit // 2:
+        return cut[:end + 1]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > 0 else cut).rstrip(" ,;:—-") + "…"
+
+def snippet_text(entry: Entry, dataset: str) -> str:
+    """Текст записи для модели: без оформления и дисклеймера готовых ответов."""
+    if entry.type == "intro":
+        return ""  # intro раздела — подсказки по кнопкам, модели в них ничего нет
+    parts = [entry.section]
+    if dataset == "exam":
+        parts += [entry.question, entry.ideal_answer]
+    else:
+        parts.append(entry.answer)
+    if entry.law:
+        parts.append(f"Нормативная база: {entry.law}")
+    return "\n".join(p for p in parts if p)
+
+def with_disclaimer(text: str) -> str:
+    """
+    Ответ модели + DISCLAIMER ровно один раз. С конца отрезаются наш DISCLAIMER
+    и похожий на него последний абзац; строки внутри абзацев ответа не трогаются.
+    """
+    text = (text or "").strip()
+    while text:
+        if text.endswith(DISCLAIMER):
+            text = text[:-len(DISCLAIMER)].rstrip()
+            continue
+        head, sep, last = text.rpartition("\n\n")
+        if sep and len(last) <= 2 * len(DISCLAIMER) and _DISCLAIMER_RE.search(last):
+            text = head.rstrip()
+            continue
+        break
+    return f"{text}\n\n{DISCLAIMER}" if text else DISCLAIMER
+
+class Prompt:
+    __slots__ = ("system", "user", "tokens", "sources")
+
+    def __init__(self, system: str, user: str, sources: List[Tuple[str, int]]):
+        self.system = system
+        self.user = user
+        self.tokens = estimate_tokens(system) + estimate_tokens(user)
+        self.sources = sources  # (набор, позиция) записей, попавших в контекст
+
+class PromptBuilder:
+    """
+    Один промпт для всех обращений к OpenAI: инструкция, несколько ближайших
+    записей FAQ/EXAM (BM25 из SparseIndex) и вопрос студента.
+
+    Всё вместе укладывается в `budget` токенов (оценка estimate_tokens):
+    вопрос — не больше `max_question` токенов, остальное — записям в порядке
+    балла; последняя запись обрезается, если остаток больше MIN_SNIPPET_TOKENS.
+    Размер запроса, а с ним и время ответа, не растут с длиной записей базы.
+    """
+
+    def __init__(self, budget: int = 1200, max_snippets: int = 3, min_score: float = 0.05,
+                 max_question: int = 300, system: str = SYSTEM_PROMPT):
+        self.budget = budget
+        self.max_snippets = max_snippets
+        self.min_score = min_score
+        self.max_question = max_question
+        self.system = system
+        self.stats: Dict[str, int] = {"prompts": 0, "snippets": 0, "trimmed": 0, "dropped": 0}
+
+    def candidates(self, kb, user_text: str) -> List[Tuple[float, str, int]]:
+        """(балл, набор, позиция) из FAQ и EXAM по убыванию балла."""
+        found = [(s, "faq", pos) for pos, s in kb.faq_search.top(user_text, self.max_snippets)]
+        found += [(s, "exam", pos) for pos, s in kb.exam_search.top(user_text, self.max_snippets)]
+        found = [c for c in found if c[0] >= self.min_score]
+        found.sort(key=lambda c: (-c[0], c[1], c[2]))
+        return found[:self.max_snippets]
+
+    def build(self, kb, user_text: str) -> Prompt:
+        system_tokens = estimate_tokens(self.system)
+        question = trim_to_tokens(user_text.strip(), min(self.max_question, self.budget - system_tokens))
+        left = self.budget - system_tokens - estimate_tokens(question) - estimate_tokens(CONTEXT_HEADER)
+
+        blocks: List[str] = []
+        sources: List[Tuple[str, int]] = []
+        seen = set()
+        for _, dataset, pos in self.candidates(kb, user_text):
+            text = snippet_text((kb.faq if dataset == "faq" else kb.exam)[pos], dataset)
+            if not text or text in seen:
+                continue
+            block = f"\n\n[{len(blocks) + 1}] {text}"
+            cost = estimate_tokens(block)
+            if cost > left:
+                if left < MIN_SNIPPET_TOKENS:
+                    self.stats["dropped"] += 1
+                    break
+                block = trim_to_tokens(block, left)
+                cost = estimate_tokens(block)
+                self.stats["trimmed"] += 1
+            seen.add(text)
+            blocks.append(block)
+            sources.append((dataset, pos))
+            left -= cost
+
+        system = self.system + (CONTEXT_HEADER + "".join(blocks) if blocks else NO_CONTEXT)
+        if not blocks and estimate_tokens(system) + estimate_tokens(question) > self.budget:
+            system = self.system  # даже строка «материалов нет» не помещается
+        self.stats["prompts"] += 1
+        self.stats["snippets"] += len(blocks)
+        return Prompt(system, question, sources)
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import sys
+    import random
+
+    parser = argparse.ArgumentParser(description="Проверка бюджетов PromptBuilder на faq.json/exam.json")
+    parser.add_argument("--budgets", default="300,600,1200,2400")
+    args = parser.parse_args()
+
+    # та же сборка базы, что в боте: индексы SparseIndex внутри KnowledgeBase
+    from kb import KnowledgeBase, read_json_list
+
+    base = os.path.dirname(os.path.abspath(__file__))
+    kb = KnowledgeBase(read_json_list(os.path.join(base, "faq.json"), "FAQ"),
+                       read_json_list(os.path.join(base, "exam.json"), "EXAM"))
+    rnd = random.Random(42)
+    words = " ".join(snippet_text(e, "exam") for e in kb.exam).split()
+    queries = [e.question for e in kb.exam] + [" ".join(e.keywords) for e in kb.faq]
+    queries += ["", "погода в алматы", "а" * 5000, " ".join(rnd.choice(words) for _ in range(2000))]
+
+    failed = 0
+    for budget in (int(b) for b in args.budgets.split(",")):
+        builder = PromptBuilder(budget=budget, max_question=min(300, budget // 4))
+        sizes = []
+        for q in queries:
+            p = builder.build(kb, q)
+            sizes.append(p.tokens)
+            if p.tokens > budget:
+                failed += 1
+                print(f"OVER budget={budget}: {p.tokens} tokens for {q[:60]!r}")
+        grounded = sum(1 for q in queries[:len(kb.exam)] if builder.build(kb, q).sources)
+        print(f"budget {budget}: {len(queries)} prompts, max {max(sizes)} tokens, "
+              f"exam questions with context {grounded}/{len(kb.exam)}, stats {builder.stats}")
+
+    # дисклеймер ровно один раз, даже если модель дописала свой
+    for reply in ("Ответ.", f"Ответ.\n\n{DISCLAIMER}", "Ответ.\n\nОтвет носит информационный характер и не является "
+                  "официальным юридическим заключением.", ""):
+        out = with_disclaimer(reply)
+        if out.count("информационный характер") != 1:
+            failed += 1
+            print(f"DISCLAIMER x{out.count('информационный характер')}: {reply!r}")
+    # похожая строка внутри ответа — часть ответа, не дисклеймер
+    for reply in ("Ответ.\nСправка из клиники не является официальным юридическим документом.",
+                  "Ответ.\n\nСправка носит информационный характер, поэтому " + "её стоит заверить " * 20 + "у нотариуса."):
+        if with_disclaimer(reply) != f"{reply}\n\n{DISCLAIMER}":
+            failed += 1
+            print(f"DISCLAIMER cut the answer: {reply[:60]!r}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import logging
+import asyncio
+from collections import deque
+from typing import Optional, Dict, Any, List
+
+
+class RequestTrace:
+    """Разметка одного сообщения: какая ветка сработала и сколько мс заняла каждая стадия."""
+
+    __slots__ = ("started", "stages", "fields", "_last")
+
+    def __init__(self, **fields: Any):
+        self.started = self._last = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = fields
+
+    def mark(self, stage: str) -> None:
+        """Время с прошлой отметки — в стадию `stage` (повторная отметка складывается)."""
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self._last) * 1000
+        self._last = now
+
+    def record(self) -> Dict[str, Any]:
+        ms = {k: round(v, 3) for k, v in self.stages.items()}
+        ms["total"] = round((time.perf_counter() - self.started) * 1000, 3)
+        return {"ts": round(time.time(), 3), **self.fields, "ms": ms}
+
+
+class RequestLog:
+    """
+    Журнал запросов в JSONL: `write` только кладёт запись в буфер, фоновая задача
+    раз в `flush_interval` секунд пишет накопленное одной пачкой в пуле потоков.
+    Файл ротируется по размеру: request_log.jsonl -> .1 -> .2 ... (`backups` штук).
+    Если диск не успевает, буфер ограничен `max_buffer` записями — старые
+    отбрасываются и считаются в stats["dropped"].
+    """
+
+    def __init__(self, path: Optional[str], max_bytes: int = 10 * 2 ** 20, backups: int = 3,
+                 flush_interval: float = 1.0, max_buffer: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self._buffer: "deque[Dict[str, Any]]" = deque(maxlen=max_buffer)
+        self._flush_lock = asyncio.Lock()
+        self.stats: Dict[str, int] = {"written": 0, "dropped": 0, "rotations": 0, "errors": 0}
+
+    def write(self, record: Dict[str, Any]) -> None:
+        if not self.path:
+            return
+        if len(self._buffer) == self._buffer.maxlen:
+            self.stats["dropped"] += 1
+        self._buffer.append(record)
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._buffer:
+                return 0
+            batch = list(self._buffer)
+            self._buffer.clear()
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self._append, batch)
+            except OSError as e:
+                self.stats["errors"] += 1
+                logging.warning(f"Request log write failed, {len(batch)} records lost: {e}")
+                return 0
+            self.stats["written"] += len(batch)
+            return len(batch)
+
+    def _append(self, batch: List[Dict[str, Any]]) -> None:
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch).encode("utf-8")
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size and size + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "ab") as f:
+            f.write(data)
+
+    def _rotate(self) -> None:
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.stats["rotations"] += 1
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception("Request log flusher error: %s", e)
+
+    async def close(self) -> None:
+        await self.flush()
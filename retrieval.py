@@ -0,0 +1,198 @@
+import re
+import math
+import heapq
+from functools import lru_cache
+from typing import Optional, Dict, List, Tuple, Iterable
+
+from knowledge import STOP_WORDS, normalize_query, clean_text
+
+# numpy — опционально: без него те же баллы считаются словарём
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+_WORD_RE = re.compile(r"[a-zа-я0-9]+")
+
+# поле записи -> вес; keywords тоже текст записи, вопрос — самое «запросное» поле
+FIELDS = (("question", 2.0), ("keywords", 2.0), ("answer", 1.0), ("ideal_answer", 1.0), ("law", 0.5))
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# окончания для лёгкого стемминга; ленивая основа — отрезается самое длинное подходящее
+_ENDINGS = (
+    "остью", "ости", "ость", "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией",
+    "ешь", "ишь", "ться", "тся", "ия", "ие", "ий", "ый", "ой", "ая", "яя", "ое", "ее", "ые", "ых", "их",
+    "ам", "ям", "ах", "ях", "ом", "ем", "ей", "ов", "ев", "ию", "ью", "ую", "юю", "ть", "ет", "ют",
+    "ит", "ят", "ут", "ал", "ил", "ла", "ли", "а", "я", "о", "е", "и", "ы", "у", "ю", "ь", "й",
+)
+MIN_STEM = 4
+_STEM_RE = re.compile(r"^(.{%d,}?)(?:%s)?$" % (MIN_STEM, "|".join(_ENDINGS)))
+
+@lru_cache(maxsize=65536)
+def stem(word: str) -> str:
+    """Отрезать самое длинное окончание, оставив не меньше MIN_STEM букв: «жалобу»/«жалобы» -> «жалоб»."""
+    m = _STEM_RE.match(word)
+    return m.group(1) if m else word
+
+def terms(text: str) -> List[str]:
+    return [stem(w) for w in _WORD_RE.findall(clean_text(text)) if w not in STOP_WORDS]
+
+def entry_text(entry: "Entry", field: str) -> str:
+    value = getattr(entry, field)
+    return " ".join(value) if isinstance(value, tuple) else value
+
+class SparseIndex:
+    """
+    BM25 по полным текстам записей (question, keywords, answer, ideal_answer, law):
+    второй этап поиска для вопросов, сформулированных не словами из keywords.
+
+    При загрузке тексты разбиваются на стеммированные слова, частоты полей
+    складываются с весами FIELDS, и для каждой пары (слово, запись) заранее
+    считается готовый вклад BM25. Матрица хранится по столбцам (CSC: для слова —
+    отрезок `indptr[t]:indptr[t + 1]` в `indices`/`data`), так что запрос — это
+    одно произведение разреженной матрицы на вектор слов запроса: отрезки
+    столбцов склеиваются и суммируются `np.bincount` по записям, top-k —
+    `np.partition` без полной сортировки. Время — O(суммы длин столбцов слов
+    запроса), а не размера базы.
+
+    Балл `match` нормирован на максимум, достижимый для этого запроса
+    (каждое слово — с бесконечной частотой), и лежит в [0, 1): порог
+    не зависит от длины вопроса. Незнакомые базе слова входят в максимум
+    с наибольшим idf — вопрос «не про то» не набирает балл на паре общих слов.
+    """
+
+    def __init__(self, entries: List["Entry"], fields: Iterable[Tuple[str, float]] = FIELDS,
+                 k1: float = BM25_K1, b: float = BM25_B):
+        self.size = len(entries)
+        self.k1 = k1
+        self.vocab: Dict[str, int] = {}
+        doc_tf: List[Dict[int, float]] = []
+        lengths: List[float] = []
+        for e in entries:
+            tf: Dict[int, float] = {}
+            length = 0.0
+            for field, weight in fields:
+                for t in terms(entry_text(e, field)):
+                    tid = self.vocab.setdefault(t, len(self.vocab))
+                    tf[tid] = tf.get(tid, 0.0) + weight
+                    length += weight
+            doc_tf.append(tf)
+            lengths.append(length)
+
+        avg = (sum(lengths) / len(lengths)) if lengths and sum(lengths) else 1.0
+        postings: List[List[Tuple[int, float]]] = [[] for _ in self.vocab]
+        for pos, tf in enumerate(doc_tf):
+            norm = k1 * (1 - b + b * lengths[pos] / avg)
+            for tid, f in tf.items():
+                postings[tid].append((pos, f * (k1 + 1) / (f + norm)))
+
+        n = self.size
+        # idf из BM25+ (всегда > 0): слово в каждой записи не штрафует её
+        self.idf = [math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for p in postings]
+        self.max_idf = math.log(1 + (n + 0.5) / 0.5)
+
+        indptr = [0]
+        indices: List[int] = []
+        data: List[float] = []
+        for tid, plist in enumerate(postings):
+            idf = self.idf[tid]
+            for pos, w in plist:
+                indices.append(pos)
+                data.append(w * idf)
+            indptr.append(len(indices))
+        if np is not None:
+            self.indptr = np.array(indptr, dtype=np.int64)
+            self.indices = np.array(indices, dtype=np.int32)
+            self.data = np.array(data, dtype=np.float32)
+        else:
+            self.indptr, self.indices, self.data = indptr, indices, data
+
+    def query_terms(self, user_text: str) -> Tuple[List[int], float]:
+        """(id слов запроса из словаря, максимум балла для запроса)."""
+        ids: List[int] = []
+        ceiling = 0.0
+        for t in set(terms(normalize_query(user_text))):
+            tid = self.vocab.get(t)
+            if tid is None:
+                ceiling += self.max_idf
+            else:
+                ids.append(tid)
+                ceiling += self.idf[tid]
+        return ids, ceiling * (self.k1 + 1)
+
+    def scores(self, tids: List[int]):
+        """Баллы всех записей: матрица (записи × слова) на вектор из единиц по `tids`."""
+        if np is not None:
+            cols = [slice(self.indptr[t], self.indptr[t + 1]) for t in tids]
+            idx = np.concatenate([self.indices[c] for c in cols])
+            val = np.concatenate([self.data[c] for c in cols])
+            return np.bincount(idx, weights=val, minlength=self.size)
+        out: Dict[int, float] = {}
+        for t in tids:
+            for k in range(self.indptr[t], self.indptr[t + 1]):
+                out[self.indices[k]] = out.get(self.indices[k], 0.0) + self.data[k]
+        return out
+
+    def top(self, user_text: str, k: int = 5) -> List[Tuple[int, float]]:
+        """k лучших (позиция, нормированный балл) по убыванию; при равенстве — раньше в базе."""
+        tids, ceiling = self.query_terms(user_text)
+        if not tids or k <= 0:
+            return []
+        sc = self.scores(tids)
+        if np is not None:
+            nz = np.flatnonzero(sc)
+            if len(nz) > k:
+                # порог k-го балла, затем добираем равные ему — порядок при равенстве как без numpy
+                kth = np.partition(sc[nz], len(nz) - k)[len(nz) - k]
+                nz = nz[sc[nz] >= kth]
+            order = np.lexsort((nz, -sc[nz]))[:k]
+            best = [(int(nz[i]), float(sc[nz[i]])) for i in order]
+        else:
+            best = heapq.nsmallest(k, sc.items(), key=lambda x: (-x[1], x[0]))
+        return [(pos, round(s / ceiling, 6)) for pos, s in best]
+
+    def match(self, user_text: str) -> Tuple[Optional[int], float]:
+        """(позиция лучшей записи или None, нормированный балл 0…1) — как KnowledgeIndex.match."""
+        best = self.top(user_text, 1)
+        return best[0] if best else (None, 0.0)
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import os
+    import sys
+    import time
+    import random
+
+    parser = argparse.ArgumentParser(description="Задержка SparseIndex на синтетической базе против бюджета")
+    parser.add_argument("--dataset", default="faq.json")
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--budget-ms", type=float, default=5.0, help="допустимый p99 одного запроса")
+    args = parser.parse_args()
+
+    from entries import load_entries
+
+    base = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(base, args.dataset), "r", encoding="utf-8") as f:
+        templates = load_entries(json.load(f), args.dataset)
+    rnd = random.Random(42)
+    entries = [templates[i % len(templates)] for i in range(args.size)]
+    texts = [entry_text(e, fld) for e in templates for fld, _ in FIELDS if entry_text(e, fld)]
+    words = [w for t in texts for w in t.split()]
+    queries = [" ".join(rnd.choice(words) for _ in range(rnd.randint(2, 12))) for _ in range(args.queries)]
+
+    t0 = time.perf_counter()
+    idx = SparseIndex(entries)
+    build_ms = (time.perf_counter() - t0) * 1000
+    lat = []
+    for q in queries:
+        t0 = time.perf_counter()
+        idx.top(q, 5)
+        lat.append((time.perf_counter() - t0) * 1000)
+    lat.sort()
+    p50, p99 = lat[len(lat) // 2], lat[min(len(lat) - 1, int(len(lat) * 0.99))]
+    print(f"{args.dataset} x{args.size}: vocab {len(idx.vocab)}, nnz {len(idx.data)}, build {build_ms:.0f}ms, "
+          f"p50 {p50:.3f}ms, p99 {p99:.3f}ms (budget {args.budget_ms}ms)")
+    sys.exit(0 if p99 <= args.budget_ms else 1)
@@ -0,0 +1,136 @@
+from typing import Optional, Dict, Iterable
+
+# фразы сравниваются с текстом после strip().lower(); приветствия — ещё и без знаков по краям
+GREETINGS = frozenset({"привет", "прив", "hello", "hi", "здарова", "здрасьте", "ку", "салам", "салем", "здравствуйте"})
+PRO_PHRASES = frozenset({"хочу pro-доступ", "хочу pro доступ", "pro-доступ", "pro доступ"})
+EXIT_WORDS = frozenset({"выход", "выйти", "exit"})
+GREETING_PUNCT = " .,!?:;"
+
+class Route:
+    """Куда идёт сообщение: `kind` — имя маршрута, `text` — текст без пробелов по краям, `lower` — он же строчными."""
+
+    __slots__ = ("kind", "text", "lower")
+
+    def __init__(self, kind: str, text: str, lower: str):
+        self.kind = kind
+        self.text = text
+        self.lower = lower
+
+    def __repr__(self) -> str:
+        return f"Route({self.kind!r}, {self.text!r})"
+
+class Router:
+    """
+    Один проход по тексту сообщения вместо цепочки фильтров-лямбд aiogram:
+    текст нормализуется один раз, дальше — поиск в заранее собранных словарях.
+
+    Порядок как у прежних хэндлеров: команда (`/...`, обрабатывается своими
+    хэндлерами) -> кнопка (точный текст) -> просьба о PRO -> приветствие ->
+    слово выхода -> обычный текст для поиска. `exit` — только разметка:
+    выход из экзамен-режима решает хэндлер, он знает режим студента.
+    """
+
+    def __init__(self, buttons: Dict[str, str], greetings: Iterable[str] = GREETINGS,
+                 pro_phrases: Iterable[str] = PRO_PHRASES, exit_words: Iterable[str] = EXIT_WORDS):
+        self.buttons = dict(buttons)  # текст кнопки -> маршрут
+        self.phrases: Dict[str, str] = {}
+        for w in exit_words:
+            self.phrases[w] = "exit"
+        for p in pro_phrases:
+            self.phrases[p] = "pro"
+        self.greetings = frozenset(greetings)
+
+    def route(self, text: Optional[str]) -> Route:
+        text = (text or "").strip()
+        if not text:
+            return Route("empty", text, text)
+        if text[0] == "/":
+            return Route("command", text, text)
+        kind = self.buttons.get(text)
+        if kind is not None:
+            return Route(kind, text, text)
+        lower = text.lower()
+        kind = self.phrases.get(lower)
+        if kind is not None:
+            return Route(kind, text, lower)
+        if lower.strip(GREETING_PUNCT) in self.greetings:
+            return Route("greeting", text, lower)
+        return Route("text", text, lower)
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import random
+
+    SECTIONS = [
+        "⚖️ Медицинские ошибки", "🚨 Инциденты", "🏥 Жалобы пациента", "✍️ Информированное согласие",
+        "🔒 Врачебная тайна", "👮 Ответственность медработников", "📄 Нормативная база",
+        "✉️ Задать вопрос преподавателю", "🧪 Мини-тесты",
+    ]
+    router = Router({**{s: "section" for s in SECTIONS}, "📄 Нормативная база": "law_base",
+                     "✉️ Задать вопрос преподавателю": "ask_teacher", "🧪 Мини-тесты": "mini_tests"})
+
+    # (текст сообщения, ожидаемый маршрут) — поведение прежней цепочки фильтров bot.py
+    CASES = [
+        ("📄 Нормативная база", "law_base"),
+        ("  📄 Нормативная база ", "law_base"),
+        ("✉️ Задать вопрос преподавателю", "ask_teacher"),
+        ("🧪 Мини-тесты", "mini_tests"),
+        ("⚖️ Медицинские ошибки", "section"),
+        ("🔒 Врачебная тайна\n", "section"),
+        ("🔒 врачебная тайна", "text"),  # кнопки — только точный текст
+        ("Хочу PRO-доступ", "pro"),
+        ("  pro доступ ", "pro"),
+        ("хочу pro-доступ!", "text"),
+        ("Привет", "greeting"),
+        ("привет!!!", "greeting"),
+        ("Здравствуйте.", "greeting"),
+        ("hi", "greeting"),
+        ("привет, как подать жалобу", "text"),
+        ("выход", "exit"),
+        ("Выйти", "exit"),
+        ("выход.", "text"),
+        ("жалоба", "text"),
+        ("врач хамит", "text"),
+        ("/start", "command"),
+        ("/broadcast текст", "command"),
+        ("", "empty"),
+        (None, "empty"),
+        ("   ", "empty"),
+    ]
+    failed = 0
+    for text, expected in CASES:
+        got = router.route(text).kind
+        if got != expected:
+            failed += 1
+            print(f"FAIL {text!r}: {got} != {expected}")
+    print(f"{len(CASES) - failed}/{len(CASES)} cases")
+
+    # цена маршрутизации против прежней цепочки: каждый фильтр заново strip()/lower()
+    greetings = set(GREETINGS)
+    chain = [
+        lambda m: (m or "").strip() == "📄 Нормативная база",
+        lambda m: (m or "").strip() == "✉️ Задать вопрос преподавателю",
+        lambda m: (m or "").strip() == "🧪 Мини-тесты",
+        lambda m: (m or "").strip().lower() in {"хочу pro-доступ", "хочу pro доступ", "pro-доступ", "pro доступ"},
+        lambda m: (m or "").strip() in SECTIONS,
+        lambda m: m and (not m.startswith("/")) and ((m or "").strip() not in SECTIONS),
+    ]
+
+    def legacy(m):
+        for f in chain:
+            if f(m):
+                break
+        raw = (m or "").strip()
+        greets = {"привет", "прив", "hello", "hi", "здарова", "здрасьте", "ку", "салам", "салем", "здравствуйте"}
+        return raw.lower().strip(" .,!?:;") in greets or raw.lower() in ("выход", "выйти", "exit")
+
+    rnd = random.Random(1)
+    sample = [rnd.choice([t for t, _ in CASES if t] + ["как зафиксировать медицинскую ошибку"] * 10)
+              for _ in range(20000)]
+    for name, fn in (("legacy chain", legacy), ("Router.route", router.route)):
+        t0 = time.perf_counter()
+        for m in sample:
+            fn(m)
+        print(f"{name}: {(time.perf_counter() - t0) / len(sample) * 1e6:.2f} µs/message")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,187 @@
+import os
+import pickle
+import shutil
+import logging
+import asyncio
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, List, Tuple
+
+from knowledge import KnowledgeIndex
+
+# воркеры только через fork (см. MatchPool); без него поиск идёт в процессе бота
+HAS_FORK = "fork" in multiprocessing.get_all_start_methods()
+
+Match = Tuple[Optional[int], float]
+
+# ---------- процесс-воркер ----------
+# индексы версии _VERSION: первая унаследована при fork (copy-on-write), следующие — из снимка на диске
+_INDEXES: Dict[str, KnowledgeIndex] = {}
+_VERSION: Optional[int] = None
+
+
+def _load(version: int, path: str) -> None:
+    global _VERSION
+    with open(path, "rb") as f:
+        faq, exam = pickle.load(f)
+    _INDEXES.update(faq=faq, exam=exam)
+    _VERSION = version
+
+
+def _match_batch(version: int, path: Optional[str], items: List[Tuple[str, str]]) -> List[Match]:
+    # новая версия базы — один раз на воркер, готовыми индексами из снимка; по трубе ходят только тексты и позиции
+    if _VERSION != version:
+        _load(version, path)
+    return [_INDEXES[dataset].match(text) for dataset, text in items]
+
+
+def _ready() -> int:
+    return os.getpid()
+
+
+# ---------- сторона event loop ----------
+class MatchPool:
+    """
+    Поиск по базе в пуле процессов: event loop не ждёт `best_match`.
+
+    Воркеры форкаются один раз — в конструкторе, пока процесс бота ещё
+    однопоточный (до пулов потоков SQLite, журнала и перезагрузки базы), — и
+    наследуют уже построенные индексы `kb` copy-on-write. spawn/forkserver
+    не подходят: они заново выполнили бы в каждом воркере `bot.py` как
+    __main__ (Bot, SQLite, сборка базы).
+
+    Новую версию базы (`start`, из `KnowledgeStore.on_reload`) пул не форкает
+    заново: индексы, уже построенные при перезагрузке, пишутся снимком во
+    временный каталог, и каждый воркер читает его перед первой пачкой новой
+    версии. Запросы, пришедшие вместе, уходят в воркер одной пачкой (до `max_batch`):
+    пока все воркеры заняты, очередь копится и следующая пачка выходит больше.
+    Запрос к версии, которой в пуле нет, `match` не ждёт: вернёт None, и
+    вызывающий посчитает его сам. Умерший воркер ломает пул — дальше поиск
+    идёт в процессе бота (поднять пул заново значило бы форкать многопоточный процесс).
+    """
+
+    def __init__(self, kb, workers: int = 2, max_batch: int = 32):
+        self.workers = max(1, workers)
+        self.max_batch = max(1, max_batch)
+        self.version: Optional[int] = None
+        self._path: Optional[str] = None  # снимок индексов текущей версии; None — унаследованы при fork
+        self._dir = tempfile.mkdtemp(prefix="match-pool-")
+        self._queue: "asyncio.Queue[Tuple[int, str, str, asyncio.Future]]" = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._collector: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {"requests": 0, "batches": 0, "max_batch": 0, "stale": 0, "errors": 0}
+
+        global _VERSION
+        if threading.active_count() > 1:
+            logging.warning(f"Match pool forks a process with {threading.active_count()} threads")
+        _INDEXES.update(faq=kb.faq_index, exam=kb.exam_index)
+        _VERSION = kb.version
+        self._executor: Optional[ProcessPoolExecutor] = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("fork"))
+        # с fork все воркеры запускаются на первом submit — здесь, а не из event loop
+        self._executor.submit(_ready).result()
+        _INDEXES.clear()  # у воркеров свои копии; боту индексы — из kb
+        _VERSION = None
+        self.version = kb.version
+        logging.info(f"Match pool: {self.workers} workers for knowledge base v{kb.version}")
+
+    def _snapshot(self, kb) -> str:
+        path = os.path.join(self._dir, f"kb-v{kb.version}.pickle")
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump((kb.faq_index, kb.exam_index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+        # снимок прошлой версии могут ещё читать пачки, ушедшие до переключения; старше — нет
+        keep = {os.path.basename(path), os.path.basename(self._path or "")}
+        for name in os.listdir(self._dir):
+            if name not in keep:
+                os.remove(os.path.join(self._dir, name))
+        return path
+
+    async def start(self, kb) -> None:
+        """Перевести воркеры на версию `kb`: снимок индексов и загрузка в воркерах до первого запроса."""
+        if self._executor is None or kb.version == self.version:
+            return
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(None, self._snapshot, kb)
+        self.version, self._path = kb.version, path
+        self._ensure_collector()
+        # прогрев: пустые пачки новой версии; какой воркер возьмёт какую — не гарантировано, остальные загрузят на первой
+        warm = [loop.run_in_executor(self._executor, _match_batch, kb.version, path, []) for _ in range(self.workers)]
+        for res in await asyncio.gather(*warm, return_exceptions=True):
+            if isinstance(res, BaseException):
+                self._failed(res)
+                break
+        logging.info(f"Match pool: knowledge base v{kb.version} loaded from snapshot")
+
+    def _failed(self, e: BaseException) -> None:
+        self.stats["errors"] += 1
+        if isinstance(e, BrokenProcessPool) and self._executor is not None:
+            logging.error(f"Match pool broken, matching in-process from now on: {e!r}")
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self.version = None
+        else:
+            logging.warning(f"Match pool batch failed: {e!r}")
+
+    def _ensure_collector(self) -> None:
+        if self._collector is None or self._collector.done():
+            self._collector = asyncio.get_running_loop().create_task(self._collect())
+
+    async def match(self, kb, dataset: str, text: str) -> Optional[Match]:
+        """(позиция, балл) как у KnowledgeIndex.match; None — посчитать локально."""
+        if kb.version != self.version:
+            # хэндлер начал со старой версией, снимок новой ещё пишется или пул сломан
+            self.stats["stale"] += 1
+            return None
+        self._ensure_collector()
+        fut = asyncio.get_running_loop().create_future()
+        self.stats["requests"] += 1
+        self._queue.put_nowait((kb.version, dataset, text, fut))
+        return await fut
+
+    async def _collect(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            await self._slots.acquire()
+            # пока ждали свободный воркер, могли подойти ещё запросы
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            asyncio.get_running_loop().create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[int, str, str, asyncio.Future]]) -> None:
+        try:
+            version, path, executor = self.version, self._path, self._executor
+            fresh = [item for item in batch if item[0] == version]
+            for item in batch:
+                if item[0] != version and not item[3].done():
+                    self.stats["stale"] += 1
+                    item[3].set_result(None)
+            if not fresh:
+                return
+            self.stats["batches"] += 1
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(fresh))
+            loop = asyncio.get_running_loop()
+            try:
+                results = await loop.run_in_executor(executor, _match_batch, version, path,
+                                                     [(d, t) for _, d, t, _ in fresh])
+            except Exception as e:
+                # упавший/убитый воркер, нечитаемый снимок: эти запросы посчитает сам хэндлер
+                results = [None] * len(fresh)
+                if self._executor is executor:
+                    self._failed(e)
+            for (_, _, _, fut), res in zip(fresh, results):
+                if not fut.done():
+                    fut.set_result(res)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        if self._collector is not None:
+            self._collector.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        shutil.rmtree(self._dir, ignore_errors=True)
@@ -0,0 +1,108 @@
+import hmac
+import logging
+import asyncio
+from typing import Optional, Dict, Any, Callable, Awaitable
+
+from aiohttp import web
+from aiogram import Dispatcher
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.webhook import WebhookRequestHandler, BOT_DISPATCHER_KEY
+
+Callback = Callable[[Dispatcher], Awaitable[None]]
+
+
+class InFlightTracker(BaseMiddleware):
+    """
+    Считает апдейты, которые сейчас обрабатываются, чтобы при остановке дождаться их.
+    Висит на уровне update: CancelHandler из message-мидлварей (например, флуд-контроль)
+    не мешает парному post_process_update.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.total = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def on_pre_process_update(self, update, data: dict):
+        self.count += 1
+        self.total += 1
+        self._idle.clear()
+
+    async def on_post_process_update(self, update, results, data: dict):
+        self.count = max(0, self.count - 1)
+        if not self.count:
+            self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """True, если все начатые апдейты успели завершиться за `timeout` секунд."""
+        if not self.count:
+            return True
+        logging.info(f"Draining {self.count} in-flight updates (timeout {timeout}s)")
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logging.warning(f"Shutdown with {self.count} updates still in flight")
+            return False
+
+
+class SecretWebhookHandler(WebhookRequestHandler):
+    """WebhookRequestHandler + проверка X-Telegram-Bot-Api-Secret-Token, если секрет задан."""
+
+    async def post(self):
+        secret = self.request.app.get("WEBHOOK_SECRET")
+        if secret:
+            got = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(got, secret):
+                return web.Response(status=401, text="bad secret")
+        return await super().post()
+
+
+def build_webhook_app(dp: Dispatcher, path: str, on_startup: Optional[Callback] = None,
+                      on_shutdown: Optional[Callback] = None, health: Optional[Callable[[], Dict[str, Any]]] = None,
+                      secret: Optional[str] = None, metrics: Optional[Callable[[], str]] = None) -> web.Application:
+    """
+    aiohttp-приложение: POST `path` — апдейты Telegram, GET /healthz — состояние,
+    GET /metrics — метрики в формате Prometheus (если передан `metrics`).
+    То же, что executor.start_webhook, но без собственного event loop,
+    поэтому его можно поднять и внутри теста/нагрузочного прогона.
+    """
+    app = web.Application()
+    app[BOT_DISPATCHER_KEY] = dp
+    app["WEBHOOK_SECRET"] = secret
+    app.router.add_route("*", path, SecretWebhookHandler, name="webhook_handler")
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", **(health() if health else {})})
+
+    app.router.add_get("/healthz", healthz)
+
+    if metrics:
+        async def metrics_handler(request: web.Request) -> web.Response:
+            return web.Response(body=metrics().encode("utf-8"),
+                                headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+        app.router.add_get("/metrics", metrics_handler)
+
+    async def _startup(_: web.Application):
+        if on_startup:
+            await on_startup(dp)
+
+    async def _shutdown(_: web.Application):
+        # aiohttp вызывает on_shutdown до ожидания открытых запросов — дренаж внутри on_shutdown бота
+        if on_shutdown:
+            await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(_startup)
+    app.on_shutdown.append(_shutdown)
+    return app
+
+
+def run_webhook(app: web.Application, host: str, port: int, shutdown_timeout: float = 30.0) -> None:
+    web.run_app(app, host=host, port=port, shutdown_timeout=shutdown_timeout)
@@ -0,0 +1,141 @@
+import time
+import logging
+import asyncio
+from typing import Optional, List, Callable, Awaitable
+
+from aiogram import types
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+
+MAX_MESSAGE_LEN = 4096  # предел Telegram на текст сообщения
+CURSOR = " ▌"
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LEN) -> List[str]:
+    """Куски не длиннее `limit`, по возможности по границе абзаца или строки."""
+    out = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        out.append(text[:cut].rstrip())
+        text = text[cut:].lstrip("\n")
+    out.append(text)
+    return out
+
+class StreamingReply:
+    """
+    Ответ модели по мере генерации: сразу — заглушка, дальше тот же текст
+    дописывается правками (`edit_message_text`).
+
+    Куски из потока (`feed`) только копятся в буфере и будят фоновую задачу;
+    она правит сообщение не чаще раза в `interval` секунд, так что всё, что
+    пришло между правками, уходит одной правкой — Telegram ограничивает частоту
+    правок, а поток модели от этого не тормозит. На 429 задача ждёт retry_after
+    и пропускает промежуточный текст; финальная правка (`finish`) повторяется
+    до `attempts` раз, а не прошла — итог уходит новым сообщением.
+
+    Новые сообщения (заглушка, продолжение длинного ответа) уходят через `send`
+    (по умолчанию — `message.answer`), правки — напрямую: у них свой темп.
+    """
+
+    def __init__(self, message: types.Message, placeholder: str = "⏳ Готовлю ответ…",
+                 interval: float = 1.0, reply_markup=None,
+                 send: Optional[Callable[..., Awaitable[types.Message]]] = None):
+        self.message = message
+        self.send = send or (lambda message, text, **kwargs: message.answer(text, **kwargs))
+        self.placeholder = placeholder
+        self.interval = interval
+        self.reply_markup = reply_markup
+        self.sent: Optional[types.Message] = None
+        self.first_content_at: Optional[float] = None  # perf_counter первой правки с текстом модели
+        self.stats = {"deltas": 0, "edits": 0, "retry_after": 0}
+        self._parts: List[str] = []
+        self._shown = ""
+        self._next_edit = 0.0
+        self._dirty = asyncio.Event()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def started(self) -> bool:
+        return self.sent is not None
+
+    async def start(self) -> None:
+        self.sent = await self.send(self.message, self.placeholder, reply_markup=self.reply_markup)
+        self._shown = self.placeholder
+        self._next_edit = asyncio.get_running_loop().time() + self.interval
+        self._task = asyncio.create_task(self._run())
+
+    def feed(self, delta: str) -> None:
+        self._parts.append(delta)
+        self.stats["deltas"] += 1
+        self._dirty.set()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._dirty.wait()
+            if self._closed:
+                return
+            # пока ждём своей очереди на правку, куски продолжают копиться
+            wait = self._next_edit - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if self._closed:
+                return
+            self._dirty.clear()
+            text = "".join(self._parts).strip()
+            if text:
+                if len(text) + len(CURSOR) > MAX_MESSAGE_LEN:
+                    text = text[:MAX_MESSAGE_LEN - len(CURSOR) - 1] + "…"
+                await self._edit(text + CURSOR)
+
+    async def _edit(self, text: str) -> bool:
+        loop = asyncio.get_running_loop()
+        if text == self._shown:
+            return True
+        try:
+            await self.sent.edit_text(text)
+        except MessageNotModified:
+            return True
+        except RetryAfter as e:
+            self.stats["retry_after"] += 1
+            self._next_edit = loop.time() + e.timeout
+            return False
+        except Exception as e:  # TelegramAPIError, а также таймаут и сетевые ошибки — их aiogram не оборачивает
+            logging.warning(f"Streaming edit failed: {e!r}")
+            self._next_edit = loop.time() + self.interval
+            return False
+        self.stats["edits"] += 1
+        self._shown = text
+        self._next_edit = loop.time() + self.interval
+        if self.first_content_at is None and text != self.placeholder:
+            self.first_content_at = time.perf_counter()
+        return True
+
+    async def finish(self, text: str, attempts: int = 5) -> None:
+        """
+        Итоговый текст вместо заглушки/черновика; не влезающее в одно сообщение — следующими.
+        Если правка так и не прошла, итог уходит новым сообщением: ответ уже готов, студент должен его получить.
+        """
+        self._closed = True
+        self._dirty.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception as e:  # упавший черновик не мешает итоговой правке
+                logging.warning(f"Streaming draft task failed: {e!r}")
+        chunks = split_message(text)
+        loop = asyncio.get_running_loop()
+        for _ in range(attempts):
+            wait = self._next_edit - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if await self._edit(chunks[0]):
+                break
+        else:
+            logging.warning("Streaming final edit failed, sending the answer as a new message")
+            await self.send(self.message, chunks[0], reply_markup=self.reply_markup)
+        for chunk in chunks[1:]:
+            await self.send(self.message, chunk, reply_markup=self.reply_markup)
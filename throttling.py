@@ -0,0 +1,249 @@
+import math
+import time
+import logging
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple, Hashable, Iterable, Callable, Awaitable, Any
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+class TokenBuckets:
+    """
+    Token bucket на ключ: `rate` токенов в секунду, не больше `burst` про запас.
+
+    Хранится только (токены, время) — кортеж на ключ. Полное ведро и
+    отсутствующее ведро равнозначны, поэтому при переполнении `max_keys`
+    выкидываются давно не писавшие (они почти всегда уже полные).
+    `rate <= 0` — ограничение выключено.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets: "OrderedDict[Hashable, Tuple[float, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def peek(self, key: Hashable, cost: float = 1.0) -> float:
+        """Как `take`, но токены не списываются: проверить несколько вёдер до того, как тратить из любого."""
+        if self.rate <= 0:
+            return 0.0
+        item = self._buckets.get(key)
+        tokens = self.burst if item is None else min(self.burst, item[0] + (self._clock() - item[1]) * self.rate)
+        return 0.0 if tokens >= cost else (cost - tokens) / self.rate
+
+    def take(self, key: Hashable, cost: float = 1.0) -> float:
+        """0.0 — можно; иначе сколько секунд ждать до нужного числа токенов."""
+        if self.rate <= 0:
+            return 0.0
+        now = self._clock()
+        item = self._buckets.get(key)
+        if item is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, item[0] + (now - item[1]) * self.rate)
+            self._buckets.move_to_end(key)
+        if tokens >= cost:
+            self._buckets[key] = (tokens - cost, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return 0.0
+        self._buckets[key] = (tokens, now)
+        return (cost - tokens) / self.rate
+
+
+class FloodControl(BaseMiddleware):
+    """
+    Флуд-контроль входящих сообщений: ведро на студента + общее ведро на бота.
+
+    Лишнее сообщение или нажатие inline-кнопки не доходит до хэндлеров (ни поиска, ни OpenAI); студенту —
+    короткое «подождите», но не чаще раза в `notice_interval` секунд, чтобы
+    на спам не отвечать спамом. Висит на уровне message: CancelHandler
+    не ломает учёт апдейтов в InFlightTracker. `notify(message, text)` —
+    как отправить «подождите» (по умолчанию `message.answer`; бот шлёт через
+    очередь исходящих с низким приоритетом).
+
+    Отдельные вёдра для OpenAI (`allow_llm`) — вызов модели дороже сообщения.
+    """
+
+    def __init__(self, user: TokenBuckets, total: TokenBuckets, llm_user: TokenBuckets, llm_total: TokenBuckets,
+                 notice_interval: float = 10.0, exempt: Iterable[int] = (),
+                 notify: Optional[Callable[[types.Message, str], Awaitable[Any]]] = None):
+        super().__init__()
+        self.notify = notify or (lambda message, text: message.answer(text))
+        self.user = user
+        self.total = total
+        self.llm_user = llm_user
+        self.llm_total = llm_total
+        self.exempt = set(exempt)
+        self._notices = TokenBuckets(1.0 / notice_interval, 1, max_keys=user.max_keys, clock=user._clock)
+        self.stats: Dict[str, int] = {"passed": 0, "dropped": 0, "notices": 0, "llm_passed": 0, "llm_limited": 0}
+
+    def _wait(self, uid: int) -> float:
+        """0.0 — пропустить; иначе через сколько секунд у студента снова будет токен."""
+        if uid in self.exempt:
+            return 0.0
+        # токен списывается, только если есть в обоих: спамер не тратит общий запас,
+        # а отказ по общему ведру не съедает запас студента
+        wait = self.user.peek(uid) or self.total.peek(None)
+        if not wait:
+            self.user.take(uid)
+            self.total.take(None)
+        self.stats["dropped" if wait else "passed"] += 1
+        return wait
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        uid = message.from_user.id if message.from_user else message.chat.id
+        wait = self._wait(uid)
+        if not wait:
+            return
+        if not self._notices.take(uid):
+            self.stats["notices"] += 1
+            await self.notify(message, f"⏳ Слишком много сообщений. Подождите {math.ceil(wait)} сек.")
+        raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        """
+        Нажатия inline-кнопок — из тех же вёдер, что и сообщения: каждое пишет
+        состояние и ставит ответ в очередь исходящих. Отказ — всплывающей
+        подсказкой на кнопке (answerCallbackQuery, не сообщение в чат).
+        """
+        wait = self._wait(call.from_user.id)
+        if not wait:
+            return
+        await call.answer(f"⏳ Слишком часто. Подождите {math.ceil(wait)} сек.")
+        raise CancelHandler()
+
+    def allow_llm(self, uid: Optional[int]) -> bool:
+        if uid in self.exempt:
+            return True
+        if (uid is not None and self.llm_user.peek(uid)) or self.llm_total.peek(None):
+            self.stats["llm_limited"] += 1
+            logging.info(f"OpenAI fallback rate-limited for {uid}")
+            return False
+        if uid is not None:
+            self.llm_user.take(uid)
+        self.llm_total.take(None)
+        self.stats["llm_passed"] += 1
+        return True
+
+if __name__ == "__main__":
+    import sys
+    import asyncio
+    from types import SimpleNamespace
+
+    # ведра и флуд-контроль на ручных часах
+    now = [0.0]
+    clock = lambda: now[0]
+    failed = []
+    checks = 0
+
+    def check(name: str, ok: bool) -> None:
+        global checks
+        checks += 1
+        if not ok:
+            failed.append(name)
+            print(f"FAIL {name}")
+
+    b = TokenBuckets(rate=2.0, burst=3, clock=clock)
+    check("burst", [b.take("u") for _ in range(4)][:3] == [0.0, 0.0, 0.0])
+    check("wait after burst", abs(b.take("u") - 0.5) < 1e-9)
+    now[0] = 0.5
+    check("refill one token", b.take("u") == 0.0 and b.take("u") > 0)
+    now[0] = 100.0
+    check("refill capped at burst", [b.take("u") for _ in range(4)].count(0.0) == 3)
+    check("keys independent", b.take("v") == 0.0)
+    check("rate <= 0 disabled", all(TokenBuckets(0, 1).take("u") == 0.0 for _ in range(100)))
+    small = TokenBuckets(rate=1.0, burst=1, max_keys=2, clock=clock)
+    for k in ("a", "b", "c"):
+        small.take(k)
+    check("max_keys evicts oldest", len(small) == 2 and small.take("a") == 0.0)
+    p = TokenBuckets(rate=1.0, burst=1, clock=clock)
+    check("peek does not spend", p.peek("u") == 0.0 and p.peek("u") == 0.0 and p.take("u") == 0.0 and p.peek("u") > 0)
+
+    def message(uid: int):
+        return SimpleNamespace(from_user=SimpleNamespace(id=uid), chat=SimpleNamespace(id=uid))
+
+    notices = []
+
+    async def notify(msg, text):
+        notices.append((msg.chat.id, text))
+
+    def flood(user_rate=1.0, user_burst=2, total_rate=100.0, total_burst=100) -> FloodControl:
+        return FloodControl(
+            user=TokenBuckets(user_rate, user_burst, clock=clock),
+            total=TokenBuckets(total_rate, total_burst, clock=clock),
+            llm_user=TokenBuckets(1.0, 1, clock=clock),
+            llm_total=TokenBuckets(1.0, 1, clock=clock),
+            notice_interval=10.0, exempt={7}, notify=notify,
+        )
+
+    async def passes(fc: FloodControl, uid: int) -> bool:
+        try:
+            await fc.on_pre_process_message(message(uid), {})
+            return True
+        except CancelHandler:
+            return False
+
+    answers = []
+
+    def callback(uid: int):
+        async def answer(text: str = None, **kwargs) -> None:
+            answers.append((uid, text))
+        return SimpleNamespace(from_user=SimpleNamespace(id=uid), answer=answer)
+
+    async def presses(fc: FloodControl, uid: int) -> bool:
+        try:
+            await fc.on_pre_process_callback_query(callback(uid), {})
+            return True
+        except CancelHandler:
+            return False
+
+    async def run() -> None:
+        now[0] = 0.0
+        fc = flood()
+        check("user burst then drop", [await passes(fc, 1) for _ in range(4)] == [True, True, False, False])
+        check("one notice per interval", len(notices) == 1 and notices[0][0] == 1)
+        check("other user unaffected", await passes(fc, 2))
+        check("exempt never dropped", all([await passes(fc, 7) for _ in range(20)]))
+        now[0] = 1.0
+        check("user refill", await passes(fc, 1) and not await passes(fc, 1))
+        now[0] = 10.5
+        await passes(fc, 1), await passes(fc, 1), await passes(fc, 1)
+        check("notice again after interval", len(notices) == 2)
+
+        now[0] = 0.0
+        notices.clear()
+        fc = flood(user_rate=10.0, user_burst=10, total_rate=1.0, total_burst=3)
+        check("global bucket shared", [await passes(fc, uid) for uid in (1, 2, 3, 4, 5)] == [True] * 3 + [False] * 2)
+        check("global drop notices each user", sorted(u for u, _ in notices) == [4, 5])
+        check("stats", fc.stats["passed"] == 3 and fc.stats["dropped"] == 2 and fc.stats["notices"] == 2)
+        # отказ по общему ведру не тратит ведро студента: у 4 и 5 весь запас 10
+        check("user bucket full after global drop", fc.user.peek(4, 10) == 0.0 and fc.user.peek(5, 10) == 0.0)
+
+        # то же для OpenAI: студент с запасом не теряет его на общем лимите
+        now[0] = 0.0
+        fc = flood()
+        check("llm global spent", fc.allow_llm(1) and not fc.allow_llm(2))
+        check("llm user bucket full after global limit", fc.llm_user.peek(2) == 0.0)
+        now[0] = 1.0
+        check("llm allowed after global refill", fc.allow_llm(2) and not fc.allow_llm(2))
+
+        # кнопки: тот же запас, что у сообщений; отказ — ответом на нажатие, без сообщения в чат
+        now[0] = 0.0
+        notices.clear()
+        fc = flood()
+        check("callback burst then drop", [await presses(fc, 1) for _ in range(5)] == [True, True, False, False, False])
+        check("callback drop answers the press", len(answers) == 3 and not notices)
+        check("callbacks and messages share the bucket", not await passes(fc, 1))
+        check("callback exempt", all([await presses(fc, 7) for _ in range(20)]))
+
+    asyncio.run(run())
+    print(f"throttling: {checks - len(failed)}/{checks} checks")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,204 @@
+import logging
+import sqlite3
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Tuple, Iterable, AsyncIterator
+
+
+class UserState:
+    """
+    Состояние одного студента: режим ("exam" или ""), выданные демо-карточки, PRO,
+    просмотренные экзамен-карточки (битсет по позициям, `deck` — отпечаток банка, к которому он относится).
+    Тема экзамен-сессии (`topic`, `cursor`, `query`) живёт только в памяти: после рестарта — весь банк.
+    """
+
+    __slots__ = ("mode", "demo_used", "pro", "seen", "deck", "topic", "cursor", "query")
+
+    def __init__(self, mode: str = "", demo_used: int = 0, pro: bool = False,
+                 seen: Optional[bytearray] = None, deck: str = ""):
+        self.mode = mode
+        self.demo_used = demo_used
+        self.pro = pro
+        self.seen = seen if seen is not None else bytearray()
+        self.deck = deck
+        self.topic = ""
+        self.cursor = -1
+        self.query = ""
+
+    def row(self, uid: int) -> Tuple[int, str, int, int, bytes, str]:
+        return uid, self.mode, self.demo_used, int(self.pro), bytes(self.seen), self.deck
+
+
+class UserStateStore:
+    """
+    Состояние студентов: LRU в памяти на `max_users` записей, на диске — SQLite.
+
+    Чтение промаха и запись идут в отдельном потоке, event loop диск не ждёт.
+    Изменения копятся в `_dirty` и пишутся пачкой раз в `flush_interval` секунд
+    (или сразу, как наберётся `flush_batch`). Пока запись не на диске, она
+    держится в `_dirty`, даже если LRU её уже вытеснил, — поэтому вытеснение
+    ничего не теряет. Без `path` — только память: вытесненные состояния забываются.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_users: int = 10000, flush_interval: float = 2.0,
+                 flush_batch: int = 500, pro_users: Iterable[int] = ()):
+        self.max_users = max_users
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.pro_users = set(pro_users)  # PRO из окружения; выданные командой хранятся в базе
+        self._mem: "OrderedDict[int, UserState]" = OrderedDict()
+        self._dirty: Dict[int, UserState] = {}
+        self._flush_lock = asyncio.Lock()
+        self.stats: Dict[str, int] = {"hits": 0, "loads": 0, "evictions": 0, "flushes": 0, "written": 0}
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, mode TEXT NOT NULL, "
+                    "demo_used INTEGER NOT NULL, pro INTEGER NOT NULL, "
+                    "seen BLOB NOT NULL DEFAULT x'', deck TEXT NOT NULL DEFAULT '')"
+                )
+                # база от прежней версии бота: новые колонки с пустыми значениями
+                columns = {r[1] for r in self._db.execute("PRAGMA table_info(users)")}
+                for name, decl in (("seen", "BLOB NOT NULL DEFAULT x''"), ("deck", "TEXT NOT NULL DEFAULT ''")):
+                    if name not in columns:
+                        self._db.execute(f"ALTER TABLE users ADD COLUMN {name} {decl}")
+                self._db.commit()
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-state")
+            except sqlite3.Error as e:
+                logging.warning(f"User state disk store disabled ({path}): {e}")
+                self._db = None
+
+    def __len__(self) -> int:
+        return len(self._mem)
+
+    def is_pro(self, uid: int, state: UserState) -> bool:
+        return state.pro or uid in self.pro_users
+
+    def _remember(self, uid: int, state: UserState) -> None:
+        self._mem[uid] = state
+        self._mem.move_to_end(uid)
+        while len(self._mem) > self.max_users:
+            self._mem.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def get(self, uid: int) -> UserState:
+        """Состояние студента; новое (пустое), если его ещё нигде нет. Менять — и звать `save`."""
+        state = self._mem.get(uid)
+        if state is not None:
+            self._mem.move_to_end(uid)
+            self.stats["hits"] += 1
+            return state
+        state = self._dirty.get(uid)
+        if state is None and self._db is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                row = await loop.run_in_executor(self._executor, self._db_get, uid)
+            except sqlite3.Error as e:
+                logging.warning(f"User state read failed: {e}")
+                row = None
+            # пока ждали диск, другой апдейт того же студента мог уже создать состояние
+            state = self._mem.get(uid) or self._dirty.get(uid)
+            if state is None and row is not None:
+                state = UserState(row[0], row[1], bool(row[2]), bytearray(row[3]), row[4])
+            self.stats["loads"] += 1
+        if state is None:
+            state = UserState()
+            # новый студент — сразу в очередь на диск: рассылка должна дойти и до тех, кто только написал /start
+            if self._db is not None:
+                self._dirty[uid] = state
+        self._remember(uid, state)
+        return state
+
+    def save(self, uid: int, state: UserState) -> None:
+        """Пометить изменённым; на диск уйдёт со следующей пачкой."""
+        self._remember(uid, state)
+        if self._db is None:
+            return
+        self._dirty[uid] = state
+        if len(self._dirty) >= self.flush_batch and not self._flush_lock.locked():
+            asyncio.get_running_loop().create_task(self.flush())
+
+    async def set_pro(self, uid: int, pro: bool) -> None:
+        state = await self.get(uid)
+        state.pro = pro
+        self.save(uid, state)
+
+    async def flush(self) -> int:
+        """Записать накопленные изменения одной транзакцией; вернуть число записей."""
+        async with self._flush_lock:
+            if not self._dirty or self._db is None:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            rows = [state.row(uid) for uid, state in batch.items()]
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(self._executor, self._db_put, rows)
+            except sqlite3.Error as e:
+                logging.warning(f"User state flush failed ({len(rows)} users), will retry: {e}")
+                # более свежие изменения, пришедшие во время записи, не перетираем
+                for uid, state in batch.items():
+                    self._dirty.setdefault(uid, state)
+                return 0
+            self.stats["flushes"] += 1
+            self.stats["written"] += len(rows)
+            return len(rows)
+
+    async def iter_user_ids(self, batch: int = 500) -> AsyncIterator[int]:
+        """
+        Все известные студенты для рассылки, пачками по `batch` из SQLite по возрастанию id
+        (keyset: `user_id > последний`), — в памяти не больше одной пачки. Без диска — кто в LRU.
+        """
+        if self._db is None:
+            for uid in list(self._mem):
+                yield uid
+            return
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        last = None
+        while True:
+            rows = await loop.run_in_executor(self._executor, self._db_ids, last, batch)
+            for (uid,) in rows:
+                yield uid
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception("User state flusher error: %s", e)
+
+    def _db_get(self, uid: int) -> Optional[Tuple[str, int, int, bytes, str]]:
+        return self._db.execute(
+            "SELECT mode, demo_used, pro, seen, deck FROM users WHERE user_id = ?", (uid,)
+        ).fetchone()
+
+    def _db_ids(self, after: Optional[int], limit: int) -> List[Tuple[int]]:
+        if after is None:
+            return self._db.execute("SELECT user_id FROM users ORDER BY user_id LIMIT ?", (limit,)).fetchall()
+        return self._db.execute(
+            "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after, limit)
+        ).fetchall()
+
+    def _db_put(self, rows: List[Tuple[int, str, int, int, bytes, str]]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO users (user_id, mode, demo_used, pro, seen, deck) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        if self._db is not None:
+            self._db.close()
+            self._db = None